@@ -0,0 +1,60 @@
+"""
+compare the corner refinement methods on synthetic scenes with known corners
+
+    python -m aprilgrid.benchmark --family t16h5b1 --scenes 20
+"""
+import argparse
+import numpy as np
+from .detector import Detector
+from .synthetic import corner_errors, render_scene
+
+
+def benchmark(tag_family_name: str = 't16h5b1', scenes: int = 20, size=(1280, 960), blur: float = 0.8,
+              noise: float = 2.0, seed: int = 0) -> dict:
+    """
+    :return: {method: {'found', 'total', 'mean_px', 'median_px', 'p95_px', 'refine_ms', 'detect_ms'}}
+    """
+    rng = np.random.default_rng(seed)
+    data = [render_scene(tag_family_name, size, rng=rng, blur=blur, noise=noise) for _ in range(scenes)]
+
+    results = {}
+    for method, refine_edges in (('edges', True), ('cornerSubPix', False)):
+        detector = Detector(tag_family_name, refine_edges=refine_edges)
+        errors, missed, total, refine_s, detect_s = [], 0, 0, 0.0, 0.0
+        for image, truth in data:
+            detections = detector.detect(image)
+            refine_s += detector.timings['refine']
+            detect_s += sum(detector.timings.values())
+            e, m = corner_errors(detections, truth)
+            errors.append(e)
+            missed += m
+            total += len(truth)
+        errors = np.concatenate(errors)
+        results[method] = {
+            'found': total - missed,
+            'total': total,
+            'mean_px': float(errors.mean()) if errors.size else float('nan'),
+            'median_px': float(np.median(errors)) if errors.size else float('nan'),
+            'p95_px': float(np.percentile(errors, 95)) if errors.size else float('nan'),
+            'refine_ms': refine_s / scenes * 1000,
+            'detect_ms': detect_s / scenes * 1000,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--family', default='t16h5b1')
+    parser.add_argument('--scenes', type=int, default=20)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=960)
+    parser.add_argument('--blur', type=float, default=0.8)
+    parser.add_argument('--noise', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = benchmark(args.family, args.scenes, (args.width, args.height), args.blur, args.noise, args.seed)
+    print(f'{"method":<14}{"found":>10}{"mean px":>10}{"median px":>11}{"p95 px":>9}{"refine ms":>11}{"detect ms":>11}')
+    for method, r in results.items():
+        print(f'{method:<14}{r["found"]:>5}/{r["total"]:<4}{r["mean_px"]:>10.3f}{r["median_px"]:>11.3f}'
+              f'{r["p95_px"]:>9.3f}{r["refine_ms"]:>11.2f}{r["detect_ms"]:>11.2f}')
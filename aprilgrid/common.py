@@ -30,3 +30,36 @@ def max_pool(arr, block_size: int, _max=True):
         return pooled.max((1, 3))
     else:
         return pooled.min((1, 3))
+
+
+def homographies(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """
+    perspective transforms of many 4 point correspondences at once, like cv2.getPerspectiveTransform
+    :param src: (n, 4, 2) or (4, 2) points
+    :param dst: (n, 4, 2) points
+    :return: (n, 3, 3) matrices mapping src to dst
+    """
+    dst = np.asarray(dst, np.float64).reshape(-1, 4, 2)
+    src = np.broadcast_to(np.asarray(src, np.float64).reshape(-1, 4, 2), dst.shape)
+    n = dst.shape[0]
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zero, one = np.zeros_like(x), np.ones_like(x)
+    a = np.empty((n, 8, 8))
+    a[:, 0::2] = np.stack([x, y, one, zero, zero, zero, -x * u, -y * u], -1)
+    a[:, 1::2] = np.stack([zero, zero, zero, x, y, one, -x * v, -y * v], -1)
+    b = np.empty((n, 8))
+    b[:, 0::2] = u
+    b[:, 1::2] = v
+    h = np.linalg.solve(a, b[..., None])[..., 0]
+    return np.concatenate([h, np.ones((n, 1))], -1).reshape(n, 3, 3)
+
+
+def project(H: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """
+    :param H: (n, 3, 3) homographies
+    :param points: (m, 2) points
+    :return: (n, m, 2) points mapped by every homography
+    """
+    p = H[:, None, :, :2] @ points[None, :, :, None] + H[:, None, :, 2:]
+    return p[..., :2, 0] / p[..., 2:, 0]
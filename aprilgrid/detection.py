@@ -7,3 +7,4 @@ import numpy as np
 class Detection:
     tag_id: int
     corners: List[np.ndarray]
+    family: str = ''  # TAG_FAMILY_DICT key of the family the tag was decoded with
@@ -1,73 +1,167 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 import numpy as np
 import cv2
-from typing import List
+from typing import List, Optional, Sequence, Union
 from .tag_family import TAG_FAMILY_DICT
 from .detection import Detection
 from .common import max_pool, random_color
-import time 
+from .refine import refine_quads
+from time import perf_counter
 
 @dataclass
 class Detector:
-    tag_family_name: str
+    # one family, or several as a list or comma separated names, e.g. 't36h11,t16h5b1'
+    tag_family_name: Union[str, Sequence[str]]
     quad_decimate = 2.0
     quad_sigma = 0.0
     refine_edges: bool = True
+    border_prefilter: bool = True
     decode_sharpening: float = 0.25
     min_white_black_diff: int = 5
+    # quad search, see apriltag_quad_thresh
+    blur_sigma: float = 1.0
+    threshold_block_size: int = 11
+    threshold_c: int = 5
+    min_cluster_pixels: Optional[int] = None  # default: area of the smallest family in bits
+    min_fill_ratio: float = 0.8  # contour area / convex hull area
+    approx_epsilon: float = 8.0
+    min_quad_ratio: float = 0.8  # quad area / convex hull area
+    # cornerSubPix refinement, used with refine_edges=False
+    subpix_window: int = 10
+    subpix_iterations: int = 40
+    # a bit is white if brighter than the tag average plus this
+    bit_threshold: float = 20.0
     debug_level: int = 0
 
+    @classmethod
+    def from_preset(cls, tag_family_name: Union[str, Sequence[str]], preset: Union[str, dict], **kwargs):
+        """
+        :param preset: name of a preset in presets.PRESETS or the preset directory, a JSON file, or a dict
+        :param kwargs: parameters overriding the preset
+        """
+        from .presets import load_preset
+        params = load_preset(preset) if isinstance(preset, str) else dict(preset)
+        params.update(kwargs)
+        return cls(tag_family_name, **params)
+
+    def parameters(self) -> dict:
+        # tunable settings, as stored in a preset
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.name not in ('tag_family_name', 'debug_level')}
+
     def __post_init__(self):
-        self.tag_family = TAG_FAMILY_DICT[self.tag_family_name]
-        self.min_cluster_pixels = self.tag_family.marker_edge_bit**2
+        names = self.tag_family_name
+        if isinstance(names, str):
+            names = names.split(',')
+        self.tag_family_names = [name.strip() for name in names]
+        self.tag_families = [TAG_FAMILY_DICT[name] for name in self.tag_family_names]
+        self.tag_family = self.tag_families[0]
+        # families with the same border geometry share the border check and the bit sampling of a quad,
+        # only the code lookup is done per family
+        self.family_groups = {}
+        for name, family in zip(self.tag_family_names, self.tag_families):
+            self.family_groups.setdefault((family.marker_edge, family.border_bit), []).append((name, family))
+        if self.threshold_block_size < 3 or self.threshold_block_size % 2 == 0:
+            raise ValueError(f"threshold_block_size must be odd and at least 3, not {self.threshold_block_size}")
+        if self.min_cluster_pixels is None:
+            self.min_cluster_pixels = min(family.marker_edge_bit for family in self.tag_families)**2
+        # seconds spent per stage in the last detect() call
+        self.timings = {}
+        # seconds spent in the border prefilter during the last decode_families() call
+        self.prefilter_time = 0.0
+        # quads found, rejected by the border prefilter and decoded, in the last detect() call and in total
+        self.counts = {}
+        self.total_counts = {'quads': 0, 'rejected': 0, 'detections': 0}
+
+    def to_uint8(self, img: np.ndarray) -> np.ndarray:
+        """
+        stretch a high bit depth image into 8 bit
+        the range is taken from a decimated copy so dark scenes keep their full contrast
+        :param img: gray image of any unsigned integer type
+        :return: uint8 image
+        """
+        sample = img[::8, ::8]
+        lo, hi = np.percentile(sample, (0.5, 99.5))
+        scale = 255.0 / max(hi - lo, 1.0)
+        return cv2.convertScaleAbs(img, alpha=scale, beta=-lo * scale)
 
     def detect(self, img: np.ndarray) -> List[Detection]:
-        # step 1 resize
-        # max_size = np.max(img.shape)
-        #start_time = time.time()
-        im_blur = cv2.GaussianBlur(img, (3, 3), 1)
-        #blur_time = time.time() - start_time
-        #print(blur_time)
-        # im_blur_resize = im_blur.copy()
-        # new_size_ratio = 1
-        # if max_size > 6000:
-        #     new_size_ratio = 1000.0 / max_size
-        #     im_blur_resize = cv2.resize(
-        #         im_blur_resize, None, None, new_size_ratio, new_size_ratio)
-        # im_blur_resize = cv2.resize(im_blur_resize, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR)
+        # step 0 bring 10/12/16 bit images into 8 bit, the stages below need uint8
+        t0 = perf_counter()
+        if img.dtype != np.uint8:
+            img = self.to_uint8(img)
+        # step 1 blur
+        t_blur = perf_counter()
+        im_blur = cv2.GaussianBlur(img, (3, 3), self.blur_sigma) if self.blur_sigma > 0 else img
+        t1 = perf_counter()
 
         # detect quads
-        #start_time = time.time()
         quads = self.apriltag_quad_thresh(im_blur)
-        #quads_time = time.time() - start_time
-        #print(quads_time)
+        t2 = perf_counter()
         # refine corner
-        winSize = (10, 10)
+        winSize = (self.subpix_window, self.subpix_window)
         zeroZone = (-1, -1)
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TermCriteria_COUNT, 40, 0.001)
-
-        # refine on small image
-        # if new_size_ratio < 1:
-        #     quads = [cv2.cornerSubPix(im_blur_resize, quad.astype(
-        #         np.float32), winSize, zeroZone, criteria) for quad in quads]
-        #     quads = [quad/new_size_ratio for quad in quads]
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TermCriteria_COUNT, self.subpix_iterations, 0.001)
 
         # refine on oringinal image
-        quads = [cv2.cornerSubPix(img, quad.astype(
-            np.float32), winSize, zeroZone, criteria) for quad in quads]
-        detections = self.tag_family.decodeQuad(quads, img)
+        if self.refine_edges:
+            # line fits through gradient samples along the edges, intersected into corners
+            quads = refine_quads(img, quads)
+        else:
+            quads = [cv2.cornerSubPix(img, quad.astype(
+                np.float32), winSize, zeroZone, criteria) for quad in quads]
+        t3 = perf_counter()
+        candidates = len(quads)
+        detections, accepted = self.decode_families(quads, img)
+        t4 = perf_counter()
+        self.timings = {'convert': t_blur - t0, 'blur': t1 - t_blur, 'quads': t2 - t1,
+                        'refine': t3 - t2, 'prefilter': self.prefilter_time, 'decode': t4 - t3 - self.prefilter_time}
+        self.counts = {'quads': candidates, 'rejected': candidates - accepted, 'detections': len(detections)}
+        for key, value in self.counts.items():
+            self.total_counts[key] += value
         return detections
 
+    def decode_families(self, quads: list, img: np.ndarray):
+        """
+        decode quads against every family, one border geometry after the other;
+        a quad decoded by one family is not tried with the others
+        :return: detections, number of quads that passed the border prefilter of any geometry
+        """
+        detections = []
+        remaining = list(range(len(quads)))
+        passed = set()
+        self.prefilter_time = 0.0
+        for group in self.family_groups.values():
+            if not remaining:
+                break
+            geometry = group[0][1]
+            candidates = remaining
+            if self.border_prefilter:
+                # drop quads without a dark border in a bright surround before the per quad decoding
+                t = perf_counter()
+                keep = geometry.border_check([quads[i] for i in remaining], img)
+                candidates = [i for i, k in zip(remaining, keep) if k]
+                self.prefilter_time += perf_counter() - t
+            passed.update(candidates)
+
+            decoded = set()
+            for i in candidates:
+                code = geometry.sample_code(quads[i], img, self.bit_threshold)
+                for name, family in group:
+                    if family.decode(code, quads[i], detections):
+                        detections[-1].family = name
+                        decoded.add(i)
+                        break
+            remaining = [i for i in remaining if i not in decoded]
+        return detections, len(passed)
+
+    def reject_rate(self) -> float:
+        # share of all quads so far that the border prefilter rejected
+        return self.total_counts['rejected'] / max(self.total_counts['quads'], 1)
+
     def apriltag_quad_thresh(self, im: np.ndarray):
         # step 1. threshold the image, creating the edge image.
-
-       # im_copy = im.copy()
-        #start_time = time.time()
-        # threshim = self.threshold(im)
-        threshim = cv2.adaptiveThreshold(im, 255, cv2.ADAPTIVE_THRESH_MEAN_C, 
-                                          cv2.THRESH_BINARY, 11, 5) 
-        #thresh_time = time.time() - start_time
-        #print(thresh_time)
+        threshim = cv2.adaptiveThreshold(im, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                          cv2.THRESH_BINARY, self.threshold_block_size, self.threshold_c)
         (cnts, _) = cv2.findContours(threshim,
                                      cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -93,12 +187,12 @@ class Detector:
                     cv2.drawContours(output, [c], -1, random_color(), 2)
                     cv2.imshow("debug", output)
                     cv2.waitKey(0)
-                if (area / areahull > 0.8):
+                if (area / areahull > self.min_fill_ratio):
                     # maximum_area_inscribed
-                    quad = cv2.approxPolyDP(hull, 8, True)
+                    quad = cv2.approxPolyDP(hull, self.approx_epsilon, True)
                     if (len(quad) == 4):
                         areaqued = cv2.contourArea(quad)
-                        if areaqued / areahull > 0.8 and areahull >= areaqued:
+                        if areaqued / areahull > self.min_quad_ratio and areahull >= areaqued:
                             # Calculate the refined corner locations
                             quads.append(quad)
         return quads
@@ -107,34 +201,19 @@ class Detector:
         h, w = im.shape
 
         tilesz = 4
-        #start_time = time.time()
         im_max = max_pool(im, tilesz, True)
         im_min = max_pool(im, tilesz, False)
-        #pool_time = time.time() - start_time
-        #print(pool_time)
         kernel0 = np.ones((3, 3), dtype=np.uint8)
         im_max = cv2.dilate(im_max, kernel0)
         im_min = cv2.erode(im_min, kernel0)
-        #start_time = time.time()
         im_min = np.repeat(np.repeat(im_min, tilesz, axis=1), tilesz, axis=0)
         im_max = np.repeat(np.repeat(im_max, tilesz, axis=1), tilesz, axis=0)
-        #upsampling_time = time.time() - start_time
-        #print(upsampling_time)
         edge = max(h % tilesz, w % tilesz)
-        #start_time = time.time()
         im_min = np.pad(im_min, (0, edge), 'edge')[:h, :w]
         im_max = np.pad(im_max, (0, edge), 'edge')[:h, :w]
-        #padding_time = time.time() - start_time
-        #print(padding_time)
-        #start_time = time.time()
         im_diff = im_max-im_min
-        #dif_time = time.time() - start_time
-        #print(dif_time)
-        #start_time = time.time()
         threshim = np.where(im_diff < self.min_white_black_diff, np.uint8(0),
                             np.where(im > (im_min + im_diff // 2), np.uint8(255), np.uint8(0)))
-        #where_time = time.time() - start_time
-        #print(where_time)
         # hi-res img can try dilate twice
         threshim = cv2.dilate(threshim, kernel0)
         return threshim
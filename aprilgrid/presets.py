@@ -0,0 +1,45 @@
+import json
+import os
+from typing import Optional
+
+# user presets are JSON files named <preset>.json in this directory
+PRESET_DIR = os.path.join(os.path.expanduser('~'), '.config', 'aprilgrid', 'presets')
+
+# built in presets, parameters of Detector; missing parameters keep the Detector defaults
+PRESETS = {
+    'default': {},
+    # cornerSubPix as before the edge refinement, no border prefilter
+    'legacy': {'refine_edges': False, 'border_prefilter': False},
+}
+
+
+def preset_path(name: str, directory: Optional[str] = None) -> str:
+    return os.path.join(directory or PRESET_DIR, f'{name}.json')
+
+
+def load_preset(preset: str, directory: Optional[str] = None) -> dict:
+    """
+    :param preset: a built in preset name, the name of a file in the preset directory, or a JSON file path
+    :return: Detector parameters
+    """
+    if preset in PRESETS:
+        return dict(PRESETS[preset])
+    path = preset if preset.endswith('.json') else preset_path(preset, directory)
+    if not os.path.exists(path):
+        raise ValueError(f"unknown detector preset '{preset}'")
+    with open(path) as f:
+        data = json.load(f)
+    # files written by save_preset also record how the preset was found
+    return dict(data.get('parameters', data))
+
+
+def save_preset(name: str, parameters: dict, directory: Optional[str] = None, metadata: Optional[dict] = None) -> str:
+    """
+    :param metadata: stored next to the parameters, e.g. the tuning dataset and scores
+    :return: path of the written file
+    """
+    path = preset_path(name, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'name': name, 'parameters': parameters, **(metadata or {})}, f, indent=2)
+    return path
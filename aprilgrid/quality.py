@@ -0,0 +1,131 @@
+from dataclasses import dataclass, field
+import threading
+import numpy as np
+import cv2
+from typing import List, Optional, Tuple
+
+DETECT = 'detect'
+REUSE = 'reuse'
+SKIP = 'skip'
+
+
+@dataclass
+class Keyframe:
+    """
+    the last detected frame of a camera: its decimated image, and its detections once they are known
+    """
+    small: np.ndarray
+    detections: Optional[List] = None
+
+
+@dataclass
+class QualityGate:
+    """
+    decides per frame of one camera whether detection is worth running
+    both measures are taken on a decimated copy, in 8 bit gray levels:
+    - change, the mean absolute difference to the last detected frame after averaging over
+      blocks of block x block pixels of the copy, which suppresses sensor noise; below
+      max_change the last detections are reused, but at most max_reuse frames in a row
+    - sharpness, the variance of the Laplacian; a frame is skipped when it is below
+      min_sharpness, or below relative_sharpness times the slowly decaying peak of recent
+      frames, i.e. motion blurred compared to what this camera usually sees. After max_skip
+      skips in a row the next frame is detected regardless and the peak is reset
+    the reference image and its detections are kept together in one Keyframe, so with frames of
+    one camera checked on several threads a reused result always belongs to the reference it
+    was compared with
+    """
+    decimation: int = 4
+    block: int = 8
+    max_change: float = 1.0
+    max_reuse: int = 35
+    min_sharpness: float = 10.0
+    relative_sharpness: float = 0.35
+    peak_decay: float = 0.99
+    max_skip: int = 35
+
+    counts: dict = field(default_factory=lambda: {DETECT: 0, REUSE: 0, SKIP: 0})
+
+    def __post_init__(self):
+        self.keyframe: Optional[Keyframe] = None
+        self.reused = 0
+        self.skipped = 0
+        self.peak = 0.0
+        self.change = 0.0
+        self.sharpness = 0.0
+        self.lock = threading.Lock()
+
+    def small(self, img: np.ndarray, bits: int = 8) -> np.ndarray:
+        small = np.ascontiguousarray(img[::self.decimation, ::self.decimation])
+        if small.dtype == np.uint8:
+            return small
+        return (small >> max(bits - 8, 0)).astype(np.uint8)
+
+    @property
+    def detections(self) -> Optional[List]:
+        keyframe = self.keyframe
+        return None if keyframe is None else keyframe.detections
+
+    def check(self, img: np.ndarray, bits: int = 8) -> str:
+        """
+        :param img: gray image, uint8 or uint16 with the given number of significant bits
+        :return: DETECT, REUSE or SKIP
+        """
+        return self.decide(img, bits)[0]
+
+    def decide(self, img: np.ndarray, bits: int = 8) -> Tuple[str, Optional[Keyframe]]:
+        """
+        :param img: gray image, uint8 or uint16 with the given number of significant bits
+        :return: DETECT, REUSE or SKIP, and the keyframe: for DETECT the new one to pass to update(),
+            for REUSE the one whose detections to reuse
+        """
+        small = self.small(img, bits)
+        keyframe = None
+        with self.lock:
+            reference = self.keyframe
+            if reference is not None and reference.small.shape == small.shape:
+                diff = cv2.subtract(small, reference.small, dtype=cv2.CV_16S)
+                h, w = diff.shape
+                blocks = cv2.resize(diff.astype(np.float32), (max(w // self.block, 1), max(h // self.block, 1)),
+                                    interpolation=cv2.INTER_AREA)
+                self.change = float(np.abs(blocks).mean())
+            else:
+                self.change = float('inf')
+
+            if self.change < self.max_change and reference.detections is not None and self.reused < self.max_reuse:
+                self.reused += 1
+                keyframe = reference
+                decision = REUSE
+            else:
+                self.sharpness = float(cv2.Laplacian(small, cv2.CV_32F).var())
+                self.peak = max(self.sharpness, self.peak * self.peak_decay)
+                blurred = self.sharpness < max(self.min_sharpness, self.relative_sharpness * self.peak)
+                if blurred and self.skipped < self.max_skip:
+                    self.skipped += 1
+                    decision = SKIP
+                else:
+                    if blurred:
+                        self.peak = self.sharpness
+                    self.skipped = 0
+                    # compare the following frames with this one, small drifts must add up to a change
+                    keyframe = self.keyframe = Keyframe(small)
+                    self.reused = 0
+                    decision = DETECT
+            self.counts[decision] += 1
+        return decision, keyframe
+
+    def update(self, detections: List, keyframe: Optional[Keyframe] = None):
+        """
+        :param detections: detections of a frame check() returned DETECT for
+        :param keyframe: the keyframe decide() returned for that frame; None for the newest one,
+            only right when frames are checked and detected one at a time
+        """
+        with self.lock:
+            if keyframe is None:
+                keyframe = self.keyframe
+            if keyframe is not None:
+                keyframe.detections = detections
+
+    def skip_rate(self) -> float:
+        # share of frames that were not detected, reused or skipped
+        total = sum(self.counts.values())
+        return (self.counts[REUSE] + self.counts[SKIP]) / max(total, 1)
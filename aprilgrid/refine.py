@@ -0,0 +1,111 @@
+import numpy as np
+from typing import List
+
+EDGE_SAMPLES = 16  # sample points per quad edge
+SEARCH_STEPS = 3  # profile points on each side of the coarse edge
+SEARCH_RANGE = 3.0  # minimum search distance in pixels on each side of the coarse edge
+SEARCH_FRACTION = 0.01  # search distance relative to the edge length, the coarse fit of long edges is worse
+MAX_CORNER_SHIFT = 2.0  # refined corners further than this many search distances from the coarse ones are rejected
+
+
+def bilinear(img: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    sample a gray image at subpixel positions, pixel centers are at integer coordinates
+    :param img: 2d image
+    :param x, y: float32 arrays of the same shape
+    :return: float32 array of the shape of x
+    """
+    h, w = img.shape
+    x = np.clip(x, 0, w - 1.001)
+    y = np.clip(y, 0, h - 1.001)
+    x0 = x.astype(np.int32)
+    y0 = y.astype(np.int32)
+    fx = x - x0
+    fy = y - y0
+    flat = img.reshape(-1)
+    i = y0 * w + x0
+    top = flat[i] * (1 - fx) + flat[i + 1] * fx
+    bottom = flat[i + w] * (1 - fx) + flat[i + w + 1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+def fit_lines(px: np.ndarray, py: np.ndarray, weight: np.ndarray):
+    """
+    weighted total least squares line fit along the last axis
+    :return: centroid x, centroid y, direction x, direction y, total weight
+    """
+    total = weight.sum(-1)
+    safe = np.maximum(total, 1e-9)
+    mx = (weight * px).sum(-1) / safe
+    my = (weight * py).sum(-1) / safe
+    dx = px - mx[..., None]
+    dy = py - my[..., None]
+    cxx = (weight * dx * dx).sum(-1)
+    cxy = (weight * dx * dy).sum(-1)
+    cyy = (weight * dy * dy).sum(-1)
+    # direction of the largest eigenvector of the weighted covariance
+    phi = 0.5 * np.arctan2(2 * cxy, cxx - cyy)
+    return mx, my, np.cos(phi), np.sin(phi), total
+
+
+def refine_quads(gray: np.ndarray, quads: list, samples: int = EDGE_SAMPLES, steps: int = SEARCH_STEPS,
+                 search_range: float = SEARCH_RANGE, search_fraction: float = SEARCH_FRACTION) -> List[np.ndarray]:
+    """
+    AprilTag style edge refinement of all quads in one vectorized pass.
+    Points are sampled along every edge; at each point the intensity gradient across the
+    edge is evaluated over max(search_range, search_fraction * edge length) on both sides
+    and its gradient weighted mean gives the edge position. A weighted line fit through these points per edge, and the intersection
+    of neighbouring lines, gives the corners.
+    :param gray: gray image the quads were found in, dark tag border on a bright surround
+    :param quads: coarse quads as returned by apriltag_quad_thresh
+    :return: list of refined quads, (4, 1, 2) float32 each
+    """
+    if not len(quads):
+        return []
+    q = np.asarray([np.asarray(quad, np.float32).reshape(4, 2) for quad in quads])
+
+    p0 = q
+    p1 = np.roll(q, -1, axis=1)  # edge i runs from corner i to corner i + 1
+    d = p1 - p0
+    length = np.linalg.norm(d, axis=-1, keepdims=True)
+    d /= np.maximum(length, 1e-6)
+    normal = np.stack([-d[..., 1], d[..., 0]], -1)
+    # let every normal point away from the quad center, i.e. from the dark border to the surround
+    outward = ((p0 + p1) / 2 - q.mean(1, keepdims=True)) * normal
+    normal *= np.where(outward.sum(-1, keepdims=True) < 0, -1, 1).astype(np.float32)
+
+    # (quad, edge, sample) base points, skipping the corners where the neighbouring edge interferes
+    t = np.linspace(0.1, 0.9, samples, dtype=np.float32)
+    base = p0[:, :, None, :] + (p1 - p0)[:, :, None, :] * t[None, None, :, None]
+
+    # intensity profile across the edge at half step positions; neighbouring differences are the
+    # gradient at the offsets, positive from dark to bright
+    step = np.maximum(length * search_fraction, search_range)[:, :, None] / steps  # (quad, edge, 1, 1)
+    offsets = np.arange(-steps, steps + 1, dtype=np.float32) * step
+    edges = np.arange(-steps - 0.5, steps + 1, dtype=np.float32) * step
+    nx = normal[:, :, None, None, 0]
+    ny = normal[:, :, None, None, 1]
+    profile = bilinear(gray, base[..., 0, None] + nx * edges, base[..., 1, None] + ny * edges)
+    gradient = np.maximum(np.diff(profile, axis=-1), 0)
+
+    # edge position along the normal per sample, weighted by the gradient
+    weight = gradient.sum(-1)
+    position = (gradient * offsets).sum(-1) / np.maximum(weight, 1e-9)
+    px = base[..., 0] + normal[:, :, None, 0] * position
+    py = base[..., 1] + normal[:, :, None, 1] * position
+
+    mx, my, ux, uy, total = fit_lines(px, py, weight)
+
+    # corner i is where edge i - 1 meets edge i
+    ax, ay, aux, auy = (np.roll(v, 1, axis=1) for v in (mx, my, ux, uy))
+    det = aux * (-uy) - auy * (-ux)
+    ok = np.abs(det) > 1e-6
+    safe = np.where(ok, det, 1.0)
+    s = ((mx - ax) * (-uy) - (my - ay) * (-ux)) / safe
+    corners = np.stack([ax + s * aux, ay + s * auy], -1)
+
+    ok &= (total > 0) & (np.roll(total, 1, axis=1) > 0)
+    reach = step[:, :, 0, 0] * steps
+    ok &= np.linalg.norm(corners - q, axis=-1) < MAX_CORNER_SHIFT * np.maximum(reach, np.roll(reach, 1, axis=1))
+    corners = np.where(ok[..., None], corners, q)
+    return [c.reshape(4, 1, 2).astype(np.float32) for c in corners]
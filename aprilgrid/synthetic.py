@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+import numpy as np
+import cv2
+from typing import List, Optional, Sequence, Tuple, Union
+from .tag_family import TAG_FAMILY_DICT, TagFamily
+
+CELL_PIXELS = 16  # texture resolution of one tag bit
+SUPERSAMPLE = 4  # scenes are rendered at this scale and area-downsampled for anti aliasing
+
+
+@dataclass
+class GroundTruth:
+    tag_id: int
+    corners: np.ndarray  # (4, 2) outer corners of the black border, pixel centers at integer coordinates
+    family: str = ''
+
+
+def tag_texture(tag_family: TagFamily, tag_id: int, cell_pixels: int = CELL_PIXELS) -> np.ndarray:
+    """
+    image of a tag with a one bit white margin around the black border
+    :return: uint8 image, (marker_edge_bit + 2) * cell_pixels wide
+    """
+    edge = tag_family.marker_edge
+    border = tag_family.border_bit
+    cells = np.full((tag_family.marker_edge_bit + 2,) * 2, 255, np.uint8)
+    cells[1:-1, 1:-1] = 0
+    bits = tag_family.tag_bit_list[tag_id].reshape(edge, edge)
+    cells[1 + border:1 + border + edge, 1 + border:1 + border + edge] = np.where(bits, 255, 0)
+    return np.kron(cells, np.ones((cell_pixels, cell_pixels), np.uint8))
+
+
+def texture_corners(tag_family: TagFamily, cell_pixels: int = CELL_PIXELS) -> np.ndarray:
+    # outer border corners in texture pixel coordinates, clockwise from the top left
+    lo = cell_pixels - 0.5
+    hi = (tag_family.marker_edge_bit + 1) * cell_pixels - 0.5
+    return np.array([[lo, lo], [hi, lo], [hi, hi], [lo, hi]], np.float32)
+
+
+def render_tag(image: np.ndarray, tag_family: TagFamily, tag_id: int, corners: np.ndarray):
+    """
+    draw a tag into a supersampled canvas
+    :param corners: (4, 2) target border corners in canvas coordinates
+    """
+    texture = tag_texture(tag_family, tag_id)
+    H = cv2.getPerspectiveTransform(texture_corners(tag_family), corners.astype(np.float32))
+    warped = cv2.warpPerspective(texture, H, image.shape[::-1], flags=cv2.INTER_LINEAR)
+    mask = cv2.warpPerspective(np.full_like(texture, 255), H, image.shape[::-1], flags=cv2.INTER_NEAREST)
+    np.copyto(image, warped, where=mask > 0)
+
+
+def render_scene(tag_family_name: Union[str, Sequence[str]], size: Tuple[int, int] = (1280, 960),
+                 grid: Tuple[int, int] = (4, 3), rng: Optional[np.random.Generator] = None, blur: float = 0.8, noise: float = 2.0,
+                 min_fill: float = 0.35, max_fill: float = 0.8, perspective: float = 0.15,
+                 background: int = 120) -> Tuple[np.ndarray, List[GroundTruth]]:
+    """
+    render one tag per grid cell with random family, id, scale, rotation and perspective
+    :param tag_family_name: one family, or several as a list or comma separated names
+    :param size: image width, height
+    :param min_fill, max_fill: tag size as a fraction of the cell
+    :param perspective: random corner displacement as a fraction of the tag size
+    :return: uint8 image and the ground truth corners of every tag
+    """
+    rng = rng or np.random.default_rng()
+    names = tag_family_name.split(',') if isinstance(tag_family_name, str) else list(tag_family_name)
+    width, height = size
+    ss = SUPERSAMPLE
+    canvas = np.full((height * ss, width * ss), background, np.uint8)
+    cell_w, cell_h = width / grid[0], height / grid[1]
+
+    truth = []
+    for gy in range(grid[1]):
+        for gx in range(grid[0]):
+            name = names[int(rng.integers(len(names)))]
+            tag_family = TAG_FAMILY_DICT[name]
+            # the margin makes the tag bigger than its border, keep the whole texture inside the cell
+            margin = (tag_family.marker_edge_bit + 2) / tag_family.marker_edge_bit
+            side = rng.uniform(min_fill, max_fill) * min(cell_w, cell_h) / margin / (1 + perspective)
+            center = np.array([(gx + 0.5) * cell_w, (gy + 0.5) * cell_h])
+            angle = rng.uniform(0, 2 * np.pi)
+            rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            square = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * side / 2
+            corners = square @ rotation.T + center + rng.uniform(-1, 1, (4, 2)) * perspective * side / 2
+
+            tag_id = int(rng.integers(len(tag_family.tag_bit_list)))
+            render_tag(canvas, tag_family, tag_id, (corners + 0.5) * ss - 0.5)
+            truth.append(GroundTruth(tag_id, corners.astype(np.float32), name))
+
+    image = cv2.resize(canvas, size, interpolation=cv2.INTER_AREA)
+    if blur > 0:
+        image = cv2.GaussianBlur(image, (0, 0), blur)
+    if noise > 0:
+        image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+    return image, truth
+
+
+def corner_errors(detections: list, truth: List[GroundTruth]) -> Tuple[np.ndarray, int]:
+    """
+    match detections to ground truth tags by id and position
+    :return: per corner distances of all matched tags in pixels, number of unmatched ground truth tags
+    """
+    errors = []
+    missed = 0
+    for gt in truth:
+        best = None
+        for detection in detections:
+            if detection.tag_id != gt.tag_id or (gt.family and detection.family and detection.family != gt.family):
+                continue
+            c = np.asarray(detection.corners, np.float64).reshape(4, 2)
+            # the corner order depends on the decoded rotation, compare with the best cyclic order
+            for candidate in (c, c[::-1]):
+                for r in range(4):
+                    e = np.linalg.norm(np.roll(candidate, r, axis=0) - gt.corners, axis=1)
+                    if best is None or e.mean() < best.mean():
+                        best = e
+        if best is None or best.mean() > 5.0:
+            missed += 1
+        else:
+            errors.append(best)
+    return (np.concatenate(errors) if errors else np.zeros(0)), missed
@@ -3,9 +3,14 @@ import numpy as np
 from typing import List
 from .tag_codes import APRILTAG_CODE_DICT
 from .detection import Detection
+from .common import homographies, project
+from .refine import bilinear
 import cv2
 import re  
 
+BORDER_MIN_CONTRAST = 10  # gray levels the surround must be brighter than the border
+BORDER_MIN_FRACTION = 0.75  # share of border samples that must show that contrast
+
 
 @dataclass
 class TagFamily:
@@ -39,9 +44,21 @@ class TagFamily:
         edge_position = self.marker_edge_bit - 0.5
         self.tag_corners = np.expand_dims(np.array(
             [[-0.5, -0.5], [edge_position, -0.5], [edge_position, edge_position], [-0.5, edge_position]], np.float32), 1)
+
+        # pairs of sample points in tag coordinates, cell centers are integers:
+        # the middle of the black border ring and the middle of the white cell just outside it
+        last = self.marker_edge_bit - 1
+        ring = (self.border_bit - 1) / 2
+        along = np.arange(1, last, dtype=np.float32)
+        border, surround = [], []
+        for inner, outer in ((ring, -1.0), (last - ring, last + 1.0)):
+            border += [np.stack([along, np.full_like(along, inner)], -1), np.stack([np.full_like(along, inner), along], -1)]
+            surround += [np.stack([along, np.full_like(along, outer)], -1), np.stack([np.full_like(along, outer), along], -1)]
+        self.border_points = np.concatenate(border)
+        self.surround_points = np.concatenate(surround)
         
 
-    def decode(self, detect_code: np.ndarray, quad, detections: List[Detection]):
+    def decode(self, detect_code: np.ndarray, quad, detections: List[Detection]) -> bool:
         code_mat = detect_code.copy()
         for r in range(4):
             scores = np.count_nonzero(
@@ -54,9 +71,27 @@ class TagFamily:
                 detections.append(Detection(best_score_idx, new_quad))
                 if self.debug_level > 0:
                     print(f"detect {best_score_idx} rotate {r} time")
-                return
+                return True
             else:
                 code_mat = np.rot90(code_mat)
+        return False
+
+    def border_check(self, quads, gray: np.ndarray, min_contrast: float = BORDER_MIN_CONTRAST,
+                     min_fraction: float = BORDER_MIN_FRACTION) -> np.ndarray:
+        """
+        cheap test of all quads at once for a dark border ring inside a bright surround
+        :param quads: array of quad which have four points
+        :param gray: gray picture
+        :return: bool mask of the quads worth decoding
+        """
+        if not len(quads):
+            return np.zeros(0, bool)
+        H = homographies(self.tag_corners, np.asarray(quads, np.float32).reshape(-1, 4, 2))
+        points = project(H, np.concatenate([self.border_points, self.surround_points])).astype(np.float32)
+        values = bilinear(gray, points[..., 0], points[..., 1])
+        n = len(self.border_points)
+        contrast = values[:, n:] - values[:, :n]
+        return np.mean(contrast > min_contrast, axis=1) >= min_fraction
 
     def decodeQuad(self, quads, gray: np.ndarray) -> List[Detection]:
         """
@@ -71,21 +106,27 @@ class TagFamily:
         # h, w = gray.shape
 
         for quad in quads:
-            H, _ = cv2.findHomography(quad, self.tag_corners)
-
-            tag_img = cv2.warpPerspective(
-                gray, H, (self.marker_edge_bit, self.marker_edge_bit))
-            if self.debug_level > 0:
-                cv2.imshow("debug single tag", tag_img)
-                cv2.waitKey(0)
-
-            avg_brightness = np.average(tag_img)
-            # TODO add some filter
-            detect_code = np.where(tag_img[self.border_bit:-self.border_bit,
-                                   self.border_bit: -self.border_bit] > avg_brightness+20, True, False)
-            self.decode(detect_code, quad, detections)
+            self.decode(self.sample_code(quad, gray), quad, detections)
         return detections
 
+    def sample_code(self, quad, gray: np.ndarray, bit_threshold: float = 20) -> np.ndarray:
+        """
+        read the data bits of a quad, depends only on marker_edge and border_bit
+        :param bit_threshold: a bit is white if brighter than the tag average plus this
+        :return: bool matrix of marker_edge x marker_edge
+        """
+        H, _ = cv2.findHomography(quad, self.tag_corners)
+
+        tag_img = cv2.warpPerspective(
+            gray, H, (self.marker_edge_bit, self.marker_edge_bit))
+        if self.debug_level > 0:
+            cv2.imshow("debug single tag", tag_img)
+            cv2.waitKey(0)
+
+        avg_brightness = np.average(tag_img)
+        # TODO add some filter
+        return np.where(tag_img[self.border_bit:-self.border_bit,
+                        self.border_bit: -self.border_bit] > avg_brightness+bit_threshold, True, False)
 
 TAG_FAMILY_DICT = {
     "t36h11": TagFamily(6, 2, 11, 3),
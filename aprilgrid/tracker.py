@@ -0,0 +1,230 @@
+from dataclasses import dataclass, field
+import threading
+import numpy as np
+import cv2
+from typing import List, Optional, Tuple
+from time import perf_counter
+from .detection import Detection
+from .detector import Detector
+from .refine import refine_quads
+
+DETECT = 'detect'
+TRACK = 'track'
+ROI = 'roi'
+
+
+@dataclass
+class TagTracker:
+    """
+    follows the corners of detected tags from frame to frame with pyramidal lucas kanade flow,
+    so most frames get corners without finding and decoding quads
+
+    every frame gets one image pyramid, which serves as the target of the flow from the last
+    frame and as the source of the flow to the next one. opencv's python binding cannot take
+    prebuilt pyramids and would rebuild both, with derivatives of the whole image, on every call;
+    instead the flow runs coarse to fine over the stored levels, on small windows around the
+    corners of the large levels, so the cost follows the number of corners and not the image size. A tag is kept when all four corners
+    were found forward and backward within max_flow_error pixels, its quad is still convex and
+    neither its size nor its shape changed more than a smooth motion can explain; the kept
+    corners are refined on the edges like fresh detections.
+    a full detection runs every redetect_interval frames, or when less than min_tracked of the
+    tags survive; lost tags below that are searched for in a region around their last position
+    frames must be passed in order; callers sharing a tracker between threads hold self.lock
+    """
+    detector: Detector
+    redetect_interval: int = 10
+    min_tracked: float = 0.8
+    win_size: int = 21
+    max_level: int = 3
+    max_flow_error: float = 0.5  # forward backward distance in pixels
+    max_scale_change: float = 1.25  # of the quad area between two frames
+    max_shape_change: float = 0.15  # of any edge length relative to the mean edge change
+    roi_margin: float = 0.5  # search region around a lost tag, as a fraction of its size
+    refine: bool = True
+
+    counts: dict = field(default_factory=lambda: {DETECT: 0, TRACK: 0, ROI: 0})
+
+    def __post_init__(self):
+        self.pyramid: Optional[list] = None
+        self.tags: List[Detection] = []
+        self.since_detect = 0
+        self.mode = DETECT
+        self.timings = {}
+        self.criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.01)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        # forget the tracked tags, the next frame is detected
+        self.pyramid = None
+        self.tags = []
+
+    def build_pyramid(self, gray: np.ndarray) -> list:
+        pyramid = [gray]
+        for _ in range(self.max_level):
+            pyramid.append(cv2.pyrDown(pyramid[-1]))
+        return pyramid
+
+    def flow(self, source: list, target: list, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        lucas kanade flow of corners from the source to the target pyramid, coarse to fine
+        a level is processed in one call when the windows around the corners would cover much of it,
+        otherwise in one call per window, so the cost on the large levels follows the number of corners
+        :param points: (n, 2) corners in the source image
+        :return: (n, 2) corners in the target image, (n,) bool found
+        """
+        top = len(source) - 1
+        result = (points / 2 ** top).astype(np.float32)
+        found = np.ones(len(points), bool)
+        margin = self.win_size // 2 + 2
+        size = (self.win_size, self.win_size)
+        for level in range(top, -1, -1):
+            src, dst = source[level], target[level]
+            h, w = src.shape[:2]
+            p = (points / 2 ** level).astype(np.float32)
+            # windows covering each corner in both images plus the search window around it
+            lo = np.floor(np.minimum(p, result)).astype(int) - margin
+            hi = np.ceil(np.maximum(p, result)).astype(int) + margin
+            lo = np.maximum(lo, 0)
+            hi = np.minimum(hi, (w, h))
+            area = np.prod(np.maximum(hi - lo, 0), axis=1)
+            if area[found].sum() * 4 > w * h:
+                new, status, _ = cv2.calcOpticalFlowPyrLK(src, dst, p.reshape(-1, 1, 2), result.reshape(-1, 1, 2),
+                                                          winSize=size, maxLevel=0, criteria=self.criteria,
+                                                          flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+                result = new.reshape(-1, 2)
+                found &= status.ravel() == 1
+            else:
+                for i in np.flatnonzero(found):
+                    (x0, y0), (x1, y1) = lo[i], hi[i]
+                    if x1 - x0 < self.win_size or y1 - y0 < self.win_size:
+                        found[i] = False
+                        continue
+                    offset = np.array([x0, y0], np.float32)
+                    new, status, _ = cv2.calcOpticalFlowPyrLK(
+                        src[y0:y1, x0:x1], dst[y0:y1, x0:x1], (p[i] - offset).reshape(1, 1, 2),
+                        (result[i] - offset).reshape(1, 1, 2), winSize=size, maxLevel=0, criteria=self.criteria,
+                        flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+                    result[i] = new.reshape(2) + offset
+                    found[i] = status[0, 0] == 1
+            if level:
+                result *= 2
+        h, w = target[0].shape[:2]
+        found &= (result >= 0).all(1) & (result[:, 0] <= w - 1) & (result[:, 1] <= h - 1)
+        return result, found
+
+    def track(self, img: np.ndarray) -> List[Detection]:
+        """
+        :param img: gray image, uint8 or higher bit depth like Detector.detect
+        :return: detections of this frame, tracked or detected; self.mode tells which
+        """
+        t0 = perf_counter()
+        gray = img if img.dtype == np.uint8 else self.detector.to_uint8(img)
+        pyramid = self.build_pyramid(gray)
+        t1 = perf_counter()
+
+        self.mode = DETECT
+        if self.pyramid is not None and self.tags and self.since_detect + 1 < self.redetect_interval:
+            tags, lost = self.follow(pyramid, gray)
+            if len(tags) >= self.min_tracked * len(self.tags):
+                self.mode = TRACK
+                if lost:
+                    self.mode = ROI
+                    tags += self.search(gray, lost, tags)
+        if self.mode == DETECT:
+            tags = self.detector.detect(img)
+            self.since_detect = 0
+        else:
+            self.since_detect += 1
+        t2 = perf_counter()
+
+        self.counts[self.mode] += 1
+        self.timings = {'pyramid': t1 - t0, self.mode: t2 - t1}
+        self.pyramid = pyramid
+        self.tags = tags
+        return tags
+
+    def follow(self, pyramid: list, gray: np.ndarray) -> Tuple[List[Detection], List[Detection]]:
+        """
+        flow the corners of the last frame into this one
+        :return: tags that passed the checks, tags that were lost
+        """
+        old = np.array([np.asarray(tag.corners, np.float32).reshape(4, 2) for tag in self.tags]).reshape(-1, 2)
+        new, found = self.flow(self.pyramid, pyramid, old)
+        back, found_back = self.flow(pyramid, self.pyramid, new)
+        error = np.linalg.norm(back - old, axis=1)
+        good = found & found_back & (error < self.max_flow_error)
+        old, new = old.reshape(-1, 4, 2), new.reshape(-1, 4, 2)
+        good = good.reshape(-1, 4).all(1) & self.consistent(old, new)
+
+        kept = [i for i in range(len(self.tags)) if good[i]]
+        quads = [new[i].reshape(4, 1, 2) for i in kept]
+        if self.refine and quads:
+            quads = refine_quads(gray, quads)
+        tags = [Detection(self.tags[i].tag_id, quad, self.tags[i].family) for i, quad in zip(kept, quads)]
+        lost = [self.tags[i] for i in range(len(self.tags)) if not good[i]]
+        return tags, lost
+
+    def consistent(self, old: np.ndarray, new: np.ndarray) -> np.ndarray:
+        """
+        geometric checks of tracked quads against their previous corners
+        :param old, new: (n, 4, 2) corners
+        :return: bool mask
+        """
+        def area(q):
+            x, y = q[..., 0], q[..., 1]
+            return 0.5 * (x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(1)
+
+        a_old, a_new = area(old), area(new)
+        # the same winding and a bounded change of size
+        ratio = a_new / np.where(np.abs(a_old) > 1e-6, a_old, 1e-6)
+        ok = (ratio > 1 / self.max_scale_change) & (ratio < self.max_scale_change)
+        # convex: all cross products of consecutive edges have the sign of the area
+        e = np.roll(new, -1, axis=1) - new
+        cross = e[..., 0] * np.roll(e[..., 1], -1, axis=1) - e[..., 1] * np.roll(e[..., 0], -1, axis=1)
+        ok &= (cross * np.sign(a_new)[:, None] > 0).all(1)
+        # every edge scales like the whole tag, i.e. no corner slid along an edge
+        l_old = np.linalg.norm(np.roll(old, -1, axis=1) - old, axis=-1)
+        l_new = np.linalg.norm(e, axis=-1)
+        scale = l_new / np.maximum(l_old, 1e-6)
+        ok &= (np.abs(scale / scale.mean(1, keepdims=True) - 1) < self.max_shape_change).all(1)
+        return ok
+
+    def search(self, img: np.ndarray, lost: List[Detection], tracked: List[Detection]) -> List[Detection]:
+        """
+        detect in a region around the last position of every lost tag, shifted by the mean
+        motion of the tracked tags
+        :return: the lost tags that were found again
+        """
+        shift = np.zeros(2, np.float32)
+        if tracked:
+            moved = {(tag.family, tag.tag_id): np.asarray(tag.corners, np.float32).reshape(4, 2) for tag in tracked}
+            motions = [moved[(tag.family, tag.tag_id)] - np.asarray(tag.corners, np.float32).reshape(4, 2)
+                       for tag in self.tags if (tag.family, tag.tag_id) in moved]
+            if motions:
+                shift = np.mean(motions, axis=(0, 1))
+
+        h, w = img.shape[:2]
+        wanted = {(tag.family, tag.tag_id) for tag in lost}
+        found = []
+        for tag in lost:
+            corners = np.asarray(tag.corners, np.float32).reshape(4, 2) + shift
+            lo, hi = corners.min(0), corners.max(0)
+            if (lo < 0).any() or hi[0] > w - 1 or hi[1] > h - 1:
+                continue  # leaving the image, a partial tag cannot be decoded
+            margin = self.roi_margin * (hi - lo).max()
+            x0, y0 = np.maximum(np.floor(lo - margin), 0).astype(int)
+            x1, y1 = np.minimum(np.ceil(hi + margin), (w, h)).astype(int)
+            if x1 - x0 < 8 or y1 - y0 < 8:
+                continue
+            for detection in self.detector.detect(img[y0:y1, x0:x1]):
+                key = (detection.family, detection.tag_id)
+                if key in wanted:
+                    wanted.discard(key)
+                    corners = np.asarray(detection.corners, np.float32) + np.array([x0, y0], np.float32)
+                    found.append(Detection(detection.tag_id, corners, detection.family))
+        return found
+
+    def track_rate(self) -> float:
+        # share of frames that were not fully detected
+        total = sum(self.counts.values())
+        return (self.counts[TRACK] + self.counts[ROI]) / max(total, 1)
@@ -0,0 +1,237 @@
+"""
+3d corner positions from the detections of several calibrated cameras
+
+every corner is identified by a key, tag id * 4 + corner index (plus a family offset when
+several families are in use). detections are joined across views on these keys with sorted
+array operations, and all joined corners are triangulated in one batched linear solve over
+all views; the reprojection errors come out of the same arrays and the worst view of points
+with large errors is dropped before a second solve. no python loop runs per tag or per corner
+"""
+from dataclasses import dataclass, field
+import numpy as np
+import cv2
+from typing import Dict, List, Optional, Sequence, Tuple
+
+FAMILY_STRIDE = 1 << 24  # key offset between families, above any tag id * 4 + corner
+MAX_ERROR = 2.0  # reprojection error in pixels above which an observation is an outlier
+
+
+@dataclass
+class CameraModel:
+    """
+    pinhole camera with opencv distortion, world to camera transform x_cam = R x_world + t
+    """
+    K: np.ndarray
+    dist: np.ndarray = field(default_factory=lambda: np.zeros(5))
+    R: np.ndarray = field(default_factory=lambda: np.eye(3))
+    t: np.ndarray = field(default_factory=lambda: np.zeros(3))
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'CameraModel':
+        # {'K': 3x3, 'dist': [k1, k2, p1, p2, k3], 'R': 3x3 or rvec, 't': [x, y, z]}
+        R = np.asarray(values.get('R', np.eye(3)), np.float64)
+        if R.size == 3:
+            R = cv2.Rodrigues(R.reshape(3, 1))[0]
+        return cls(np.asarray(values['K'], np.float64), np.asarray(values.get('dist', np.zeros(5)), np.float64),
+                   R, np.asarray(values.get('t', np.zeros(3)), np.float64).reshape(3))
+
+    @property
+    def projection(self) -> np.ndarray:
+        return self.K @ np.hstack([self.R, self.t.reshape(3, 1)])
+
+    def undistort(self, points: np.ndarray) -> np.ndarray:
+        """
+        :param points: (n, 2) pixel coordinates
+        :return: (n, 2) pixel coordinates of an ideal pinhole camera with the same K
+        """
+        if not len(points) or not np.any(self.dist):
+            return np.asarray(points, np.float64).reshape(-1, 2)
+        return cv2.undistortPoints(np.asarray(points, np.float64).reshape(-1, 1, 2), self.K, self.dist,
+                                   P=self.K).reshape(-1, 2)
+
+
+def corner_keys(tag_ids: np.ndarray, families: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    :param tag_ids: (n,) tag ids
+    :param families: (n,) small integer family codes, if several families share ids
+    :return: (n * 4,) int64 keys in the order of corners.reshape(-1, 2)
+    """
+    keys = (np.asarray(tag_ids, np.int64)[:, None] * 4 + np.arange(4)).ravel()
+    if families is not None:
+        keys += np.repeat(np.asarray(families, np.int64), 4) * FAMILY_STRIDE
+    return keys
+
+
+def join(keys: Sequence[np.ndarray], points: Sequence[np.ndarray], min_views: int = 2):
+    """
+    join the corners of several views on their keys
+    :param keys: per view (n_v,) corner keys; a key seen twice in a view is used once
+    :param points: per view (n_v, 2) corner positions
+    :return: (m,) keys seen in at least min_views views, (v, m, 2) positions, (v, m) bool seen
+    """
+    views = len(keys)
+    unique = []
+    for k in keys:
+        k, first = np.unique(np.asarray(k, np.int64), return_index=True)
+        unique.append((k, first))
+    all_keys, counts = np.unique(np.concatenate([k for k, _ in unique]), return_counts=True)
+    joined = all_keys[counts >= min_views]
+
+    positions = np.zeros((views, len(joined), 2))
+    seen = np.zeros((views, len(joined)), bool)
+    for v, ((k, first), p) in enumerate(zip(unique, points)):
+        # position of every joined key in the sorted keys of this view
+        index = np.minimum(np.searchsorted(k, joined), max(len(k) - 1, 0))
+        hit = k[index] == joined if len(k) else np.zeros(len(joined), bool)
+        seen[v] = hit
+        positions[v, hit] = np.asarray(p, np.float64).reshape(-1, 2)[first[index[hit]]]
+    return joined, positions, seen
+
+
+def _normalization(points: np.ndarray, seen: np.ndarray) -> np.ndarray:
+    # per view similarity moving the observed points to the origin with unit mean distance, (v, 3, 3)
+    T = np.tile(np.eye(3), (len(points), 1, 1))
+    for v in range(len(points)):
+        p = points[v, seen[v]]
+        if len(p):
+            center = p.mean(0)
+            scale = np.sqrt(2) / max(np.linalg.norm(p - center, axis=1).mean(), 1e-9)
+            T[v, :2, :2] *= scale
+            T[v, :2, 2] = -scale * center
+    return T
+
+
+def dlt(projections: np.ndarray, points: np.ndarray, seen: np.ndarray) -> np.ndarray:
+    """
+    linear triangulation of all points at once
+    :param projections: (v, 3, 4) camera matrices
+    :param points: (v, m, 2) undistorted pixel positions
+    :param seen: (v, m) which views observe which point; unseen rows are zero and do not count
+    :return: (m, 3) points
+    """
+    T = _normalization(points, seen)
+    P = T @ projections  # (v, 3, 4)
+    x = np.einsum('vij,vmj->vmi', T[:, :2, :2], points) + T[:, None, :2, 2]  # (v, m, 2)
+    # two equations per view: x * P3 - P1 and y * P3 - P2
+    rows = x[..., None] * P[:, None, 2:3, :] - P[:, None, :2, :]  # (v, m, 2, 4)
+    rows *= seen[..., None, None]
+    A = rows.transpose(1, 0, 2, 3).reshape(points.shape[1], -1, 4)  # (m, 2v, 4)
+    _, _, vt = np.linalg.svd(A)
+    X = vt[:, -1]
+    return X[:, :3] / X[:, 3:]
+
+
+def reproject(projections: np.ndarray, X: np.ndarray) -> np.ndarray:
+    # (v, 3, 4), (m, 3) -> (v, m, 2)
+    h = np.einsum('vij,mj->vmi', projections[:, :, :3], X) + projections[:, None, :, 3]
+    return h[..., :2] / h[..., 2:]
+
+
+@dataclass
+class Triangulation:
+    keys: np.ndarray  # (m,) corner keys
+    points: np.ndarray  # (m, 3)
+    errors: np.ndarray  # (v, m) reprojection errors in pixels, nan where not observed
+    inliers: np.ndarray  # (v, m) observations used for points
+
+    @property
+    def tag_ids(self) -> np.ndarray:
+        return (self.keys % FAMILY_STRIDE) // 4
+
+    @property
+    def corner_index(self) -> np.ndarray:
+        return self.keys % 4
+
+    def rms(self) -> np.ndarray:
+        # (m,) rms reprojection error over the inlier views
+        e = np.where(self.inliers, self.errors, 0.0)
+        return np.sqrt((e ** 2).sum(0) / np.maximum(self.inliers.sum(0), 1))
+
+
+def triangulate(cameras: Sequence[CameraModel], keys: Sequence[np.ndarray], points: Sequence[np.ndarray],
+                max_error: float = MAX_ERROR, min_views: int = 2) -> Triangulation:
+    """
+    :param cameras: one model per view
+    :param keys: per view (n_v,) corner keys, see corner_keys
+    :param points: per view (n_v, 2) or (n_v / 4, 4, 2) corners in distorted pixels
+    :param max_error: the worst view of a point reprojecting further than this is dropped and the point
+        solved again; points left with fewer than min_views views within max_error are removed
+    """
+    projections = np.array([camera.projection for camera in cameras])
+    points = [camera.undistort(np.asarray(p).reshape(-1, 2)) for camera, p in zip(cameras, points)]
+    joined, positions, seen = join(keys, points, min_views)
+    if not len(joined):
+        return Triangulation(joined, np.zeros((0, 3)), np.zeros((len(cameras), 0)), seen)
+
+    X = dlt(projections, positions, seen)
+    errors = np.linalg.norm(reproject(projections, X) - positions, axis=-1)
+    # one bad view pulls the linear solution away from all views; drop the worst view of every
+    # point that has a view to spare and solve those points again
+    inliers = seen.copy()
+    worst = np.argmax(np.where(seen, errors, -1.0), axis=0)
+    redo = (errors[worst, np.arange(len(joined))] > max_error) & (seen.sum(0) > min_views)
+    if redo.any():
+        inliers[worst[redo], np.flatnonzero(redo)] = False
+        X[redo] = dlt(projections, positions[:, redo], inliers[:, redo])
+        errors[:, redo] = np.linalg.norm(reproject(projections, X[redo]) - positions[:, redo], axis=-1)
+    inliers &= errors <= max_error
+    keep = inliers.sum(0) >= min_views
+    errors = np.where(seen, errors, np.nan)
+    return Triangulation(joined[keep], X[keep], errors[:, keep], inliers[:, keep])
+
+
+class FrameSetSynchronizer:
+    """
+    groups per camera results into sets of one result per camera taken at the same time
+
+    results are added as they arrive; a set is complete when every camera has a result within
+    tolerance of the oldest pending one. results that can no longer be part of a set are dropped
+    """
+
+    def __init__(self, cam_ids: Sequence[str], tolerance: float, max_pending: int = 8):
+        """
+        :param tolerance: largest timestamp difference within a set, in timestamp units
+        :param max_pending: results kept per camera while waiting for the others
+        """
+        self.cam_ids = list(cam_ids)
+        self.tolerance = tolerance
+        self.max_pending = max_pending
+        self.pending: Dict[str, List[Tuple[float, object]]] = {cam_id: [] for cam_id in self.cam_ids}
+        self.dropped = 0
+
+    def add(self, cam_id: str, timestamp: float, item) -> List[Dict[str, object]]:
+        """
+        :return: the frame sets completed by this result, {cam_id: item}, oldest first
+        """
+        queue = self.pending[cam_id]
+        queue.append((timestamp, item))
+        if len(queue) > self.max_pending:
+            queue.pop(0)
+            self.dropped += 1
+
+        sets = []
+        while all(self.pending.values()):
+            heads = [self.pending[c][0][0] for c in self.cam_ids]
+            newest = max(heads)
+            # everything older than the newest head minus the tolerance has missed its set
+            stale = [c for c, t in zip(self.cam_ids, heads) if t < newest - self.tolerance]
+            if stale:
+                for c in stale:
+                    self.pending[c].pop(0)
+                    self.dropped += 1
+                continue
+            sets.append({c: self.pending[c].pop(0)[1] for c in self.cam_ids})
+        return sets
+
+
+def triangulate_set(cameras: Dict[str, CameraModel], frame_set: Dict[str, object],
+                    max_error: float = MAX_ERROR, min_views: int = 2) -> Triangulation:
+    """
+    :param frame_set: {cam_id: result with ids (n,), families (n,) and corners (n, 4, 2)}, e.g. decoded
+        detection stream messages as grouped by FrameSetSynchronizer. families may be missing or None when
+        only one family is in use
+    """
+    cam_ids = [cam_id for cam_id in cameras if cam_id in frame_set]
+    keys = [corner_keys(frame_set[c].ids, getattr(frame_set[c], 'families', None)) for c in cam_ids]
+    return triangulate([cameras[c] for c in cam_ids], keys,
+                       [frame_set[c].corners for c in cam_ids], max_error, min_views)
@@ -0,0 +1,205 @@
+"""
+search detector parameters for the fastest configuration that still meets a recall and
+corner error target, without more false positives than the defaults, and store it as a preset
+
+    python -m aprilgrid.tune --family t16h5b1 --trials 200 --name lab_fast
+    python -m aprilgrid.tune --family t16h5b1 --labels data/ --name cam3_lens8
+
+a labeled dataset is a directory of images with a labels.json:
+    {"image.png": [{"id": 3, "family": "t16h5b1", "corners": [[x, y], [x, y], [x, y], [x, y]]}, ...], ...}
+"""
+import argparse
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from typing import List, Optional, Tuple
+import numpy as np
+import cv2
+from .detector import Detector
+from .presets import save_preset
+from .synthetic import GroundTruth, corner_errors, render_scene
+
+# values tried per parameter; random combinations of these are evaluated
+SEARCH_SPACE = {
+    'blur_sigma': [0.0, 0.8, 1.0, 1.5],
+    'threshold_block_size': [5, 7, 9, 11, 15, 21, 31],
+    'threshold_c': [2, 3, 5, 7, 10],
+    'min_cluster_pixels': [None, 64, 144, 256, 400],
+    'min_fill_ratio': [0.6, 0.7, 0.8, 0.9],
+    'approx_epsilon': [2.0, 4.0, 6.0, 8.0, 12.0],
+    'min_quad_ratio': [0.6, 0.7, 0.8, 0.9],
+    'refine_edges': [True, False],
+    'subpix_window': [3, 5, 7, 10],
+    'subpix_iterations': [10, 20, 40],
+    'border_prefilter': [True, False],
+    'bit_threshold': [5.0, 10.0, 20.0, 30.0],
+}
+
+_dataset: List[Tuple[np.ndarray, List[GroundTruth]]] = []
+
+
+def synthetic_dataset(tag_family_name: str, scenes: int, size: Tuple[int, int], seed: int = 0,
+                      blur: float = 0.8, noise: float = 2.0) -> list:
+    rng = np.random.default_rng(seed)
+    return [render_scene(tag_family_name, size, rng=rng, blur=blur, noise=noise) for _ in range(scenes)]
+
+
+def synthetic_spec(tag_family_name: str, scenes: int = 12, size: Tuple[int, int] = (1280, 960), seed: int = 0,
+                   blur: float = 0.8, noise: float = 2.0) -> dict:
+    # dataset spec of tune() for synthetic_dataset
+    return {'labels': None, 'family': tag_family_name, 'scenes': scenes, 'size': size, 'seed': seed,
+            'blur': blur, 'noise': noise}
+
+
+def labeled_dataset(directory: str) -> list:
+    with open(os.path.join(directory, 'labels.json')) as f:
+        labels = json.load(f)
+    data = []
+    for name, tags in sorted(labels.items()):
+        image = cv2.imread(os.path.join(directory, name), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError(f'cannot read {name}')
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        truth = [GroundTruth(int(t['id']), np.array(t['corners'], np.float32).reshape(4, 2), t.get('family', ''))
+                 for t in tags]
+        data.append((image, truth))
+    return data
+
+
+def _init_worker(spec: dict):
+    global _dataset
+    cv2.setNumThreads(1)  # one evaluation per process, timings stay comparable
+    if spec.get('labels'):
+        _dataset = labeled_dataset(spec['labels'])
+    else:
+        _dataset = synthetic_dataset(spec['family'], spec['scenes'], spec['size'], spec['seed'],
+                                     spec['blur'], spec['noise'])
+
+
+def evaluate(tag_family_name: str, params: dict, repeats: int = 2) -> dict:
+    """
+    run one configuration over the dataset of this process
+    :return: params with recall, mean and p95 corner error, false positives and ms per image
+    """
+    detector = Detector(tag_family_name, **params)
+    errors, missed, total, false_positives = [], 0, 0, 0
+    best_time = float('inf')
+    for repeat in range(repeats):
+        elapsed = 0.0
+        for image, truth in _dataset:
+            start = perf_counter()
+            detections = detector.detect(image)
+            elapsed += perf_counter() - start
+            if repeat == 0:
+                e, m = corner_errors(detections, truth)
+                errors.append(e)
+                missed += m
+                total += len(truth)
+                false_positives += max(len(detections) - (len(truth) - m), 0)
+        best_time = min(best_time, elapsed)
+    errors = np.concatenate(errors) if errors else np.zeros(0)
+    return {
+        'params': params,
+        'recall': (total - missed) / max(total, 1),
+        'mean_error': float(errors.mean()) if errors.size else float('inf'),
+        'p95_error': float(np.percentile(errors, 95)) if errors.size else float('inf'),
+        'false_positives': false_positives,
+        'ms': best_time / max(len(_dataset), 1) * 1000,
+    }
+
+
+def sample_params(rng: random.Random) -> dict:
+    params = {name: rng.choice(values) for name, values in SEARCH_SPACE.items()}
+    if params['refine_edges']:
+        # the cornerSubPix settings do not matter then
+        del params['subpix_window'], params['subpix_iterations']
+    return params
+
+
+def meets(result: dict, target_recall: float, max_error: float, max_false_positives: int) -> bool:
+    return (result['recall'] >= target_recall and result['mean_error'] <= max_error
+            and result['false_positives'] <= max_false_positives)
+
+
+def tune(tag_family_name: str, trials: int = 100, target_recall: float = 0.98, max_error: float = 0.25,
+         max_false_positives: Optional[int] = None, workers: Optional[int] = None, spec: Optional[dict] = None,
+         seed: int = 0) -> Tuple[Optional[dict], list]:
+    """
+    :param max_false_positives: over the whole dataset, default: as many as the default parameters produce
+    :param spec: dataset, {'labels': directory} or the synthetic_dataset arguments, see synthetic_spec;
+        default: synthetic scenes of tag_family_name rendered with seed
+    :return: the fastest result meeting the targets (None if none does), and all results, the defaults first
+    """
+    if spec is None:
+        spec = synthetic_spec(tag_family_name, seed=seed)
+    rng = random.Random(seed)
+    candidates = [{}]  # the current defaults are always a candidate
+    seen = {json.dumps({})}
+    while len(candidates) < trials:
+        params = sample_params(rng)
+        key = json.dumps(params, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            candidates.append(params)
+
+    results = []
+    with ProcessPoolExecutor(workers or os.cpu_count() or 1, initializer=_init_worker, initargs=(spec,)) as pool:
+        futures = [pool.submit(evaluate, tag_family_name, params) for params in candidates]
+        for i, future in enumerate(futures):
+            results.append(future.result())
+            if (i + 1) % 10 == 0 or i + 1 == len(futures):
+                print(f'{i + 1}/{len(futures)} configurations evaluated', flush=True)
+
+    if max_false_positives is None:
+        max_false_positives = results[0]['false_positives']
+    passing = [r for r in results if meets(r, target_recall, max_error, max_false_positives)]
+    best = min(passing, key=lambda r: r['ms']) if passing else None
+    return best, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--family', default='t16h5b1')
+    parser.add_argument('--labels', metavar='DIR', help='labeled dataset instead of synthetic scenes')
+    parser.add_argument('--scenes', type=int, default=12, help='number of synthetic scenes')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=960)
+    parser.add_argument('--blur', type=float, default=0.8)
+    parser.add_argument('--noise', type=float, default=2.0)
+    parser.add_argument('--trials', type=int, default=100, help='configurations to evaluate')
+    parser.add_argument('--target-recall', type=float, default=0.98)
+    parser.add_argument('--max-error', type=float, default=0.25, help='mean corner error in pixels')
+    parser.add_argument('--max-false-positives', type=int,
+                        help='over the dataset (default: as many as the default parameters produce)')
+    parser.add_argument('--workers', type=int, help='evaluation processes (default: one per core)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--name', help='save the best configuration as this preset')
+    parser.add_argument('--preset-dir', help='where to save the preset (default: presets.PRESET_DIR)')
+    args = parser.parse_args()
+
+    spec = synthetic_spec(args.family, args.scenes, (args.width, args.height), args.seed, args.blur, args.noise)
+    spec['labels'] = args.labels
+    best, results = tune(args.family, args.trials, args.target_recall, args.max_error, args.max_false_positives,
+                         args.workers, spec, args.seed)
+    default = results[0]
+    max_false_positives = default['false_positives'] if args.max_false_positives is None else args.max_false_positives
+
+    print(f'{"ms":>8}{"recall":>8}{"mean px":>9}{"p95 px":>8}{"false":>7}  parameters')
+    for r in sorted(results, key=lambda r: (not meets(r, args.target_recall, args.max_error, max_false_positives),
+                                            r['ms']))[:10]:
+        print(f'{r["ms"]:>8.2f}{r["recall"]:>8.3f}{r["mean_error"]:>9.3f}{r["p95_error"]:>8.3f}'
+              f'{r["false_positives"]:>7}  {json.dumps(r["params"])}')
+    if best is None:
+        print('no configuration meets the targets')
+    else:
+        print(f'best: {best["ms"]:.2f} ms per image, defaults: {default["ms"]:.2f} ms')
+        if args.name:
+            path = save_preset(args.name, best['params'], args.preset_dir, {
+                'family': args.family,
+                'dataset': args.labels or f'synthetic {args.scenes} x {args.width}x{args.height} seed {args.seed}',
+                'score': {k: best[k] for k in ('recall', 'mean_error', 'p95_error', 'false_positives', 'ms')},
+            })
+            print(f'saved preset {args.name!r} to {path}')
@@ -1,12 +1,21 @@
 ## Based on the example code from the Vimba Python API
+import os
 import sys
 from typing import Optional
 from queue import Queue
 from vmbpy import *
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'src'))
+from camera_profile import CameraProfile, CameraProfileError, apply_profile
+from pixel_format import MONO_BITS, frame_to_image, to_display
 
 # All frames will either be recorded in this format, or transformed to it before being displayed
 opencv_display_format = PixelFormat.Bgr8
 
+# Pixel format is chosen by setup_pixel_format, so it is not part of the profile. The main
+# application's default profile is saved in UserSet1, this one gets a set of its own.
+camera_profile = CameraProfile(exposure_time=20000, gain=16, frame_rate=35.0, binning=1, pixel_format=None,
+                               user_set='UserSet2')
+
 
 def print_usage():
     print('Usage:')
@@ -54,21 +63,9 @@ def get_camera(camera_id: Optional[str]) -> Camera:
 def setup_camera(cam: Camera):
     with cam:
         try:
-            # Set camera setting here
-            cam.ExposureAuto.set('Off')
-            cam.ExposureTime.set(20000) 
-            cam.Gain.set(16)
-            cam.AcquisitionFrameRateEnable.set(True)
-            cam.AcquisitionFrameRate.set(35.0)
-            cam.AcquisitionFrameRateMode.set('Basic')
-            cam.BinningHorizontal.set(1)
-            cam.BinningVertical.set(1)
-        except (AttributeError, VmbFeatureError):
-            pass
-        except (AttributeError, VmbFeatureError):
-            pass
-        except (AttributeError, VmbFeatureError):
-            pass
+            apply_profile(cam, camera_profile)
+        except CameraProfileError as e:
+            print('Error configuring camera: {}'.format(e))
 
 
 def setup_pixel_format(cam: Camera):
@@ -103,14 +100,20 @@ class Handler:
         if frame.get_status() == FrameStatus.Complete:
             print('{} acquired {}'.format(cam, frame), flush=True)
             print("FPS:", cam.AcquisitionFrameRate.get_range()[1])
+            bits = MONO_BITS.get(frame.get_pixel_format())
+            if bits is not None:
+                # Mono frames, packed Mono10p/Mono12p included, are shown without a BGR conversion.
+                # Mono8 is a view on the frame buffer, copy it so the frame can be requeued
+                image = to_display(frame_to_image(frame), bits)
+                display = image.copy() if bits == 8 else image
             # Convert frame if it is not already the correct format
-            if frame.get_pixel_format() == opencv_display_format:
-                display = frame
+            elif frame.get_pixel_format() == opencv_display_format:
+                display = frame.as_opencv_image()
             else:
                 # This creates a copy of the frame. The original `frame` object can be requeued
                 # safely while `display` is used
-                display = frame.convert_pixel_format(opencv_display_format)
-            self.display_queue.put(display.as_opencv_image(), True)
+                display = frame.convert_pixel_format(opencv_display_format).as_opencv_image()
+            self.display_queue.put(display, True)
         cam.queue_frame(frame)
 
 
@@ -1,62 +1,98 @@
 import queue
-import threading
 from vmbpy import *
+from camera_lifecycle import CameraLifecycle
 from frame_producer import FrameProducer
-from frame_consumer import FrameConsumer
+from frame_trace import LatencyTracker
+from metrics import REGISTRY
+# The preview window (OpenCV), the camera and simulated sources and the scheduling plan are
+# imported where they are used, so a headless or replay start does not load what it never runs
 FRAME_QUEUE_SIZE = 10
 
+QUEUE_DEPTH = REGISTRY.gauge('coopercam_queue_depth', 'Frames waiting in a queue', ('queue',))
+RECORDER_FRAMES = REGISTRY.gauge('coopercam_recorder_frames', 'FrameRecorder counters', ('state',))
+LATENCY_MS = REGISTRY.gauge('coopercam_latency_ms', 'Frame latency percentiles since start',
+                            ('camera', 'segment', 'quantile'))
+
 
 class Application:
-    def __init__(self):
+    def __init__(self, source: 'FrameSource' = None, recorder=None, profiles: dict = None,
+                 tracker: LatencyTracker = None, display_rate: float = None,
+                 consumer_factory=None, scheduling: 'SchedulingPlan' = None):
         self.frame_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
-        self.producers = {}
-        self.producers_lock = threading.Lock()
-
-    def __call__(self, cam: Camera, event: CameraEvent):
-        # New camera was detected. Create FrameProducer, add it to active FrameProducers
-        if event == CameraEvent.Detected:
-            with self.producers_lock:
-                self.producers[cam.get_id()] = FrameProducer(cam, self.frame_queue)
-                self.producers[cam.get_id()].start()
-
-        # An existing camera was disconnected, stop associated FrameProducer.
-        elif event == CameraEvent.Missing:
-            with self.producers_lock:
-                producer = self.producers.pop(cam.get_id())
-                producer.stop()
-                producer.join()
+        self.display_rate = display_rate  # None for the FrameConsumer default
+        # Builds the consumer from (frame_queue, tracker), the preview window by default
+        self.consumer_factory = consumer_factory
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self.source = source
+        self.recorder = recorder
+        self.profiles = profiles or {}
+        self.scheduling = scheduling
+        self.lifecycle = None
+
+    def collect_metrics(self):
+        QUEUE_DEPTH.labels('frames').set(self.frame_queue.qsize())
+        if self.recorder is not None:
+            stats = self.recorder.stats()
+            QUEUE_DEPTH.labels('recorder').set(stats['queue_depth'])
+            for state in ('submitted', 'written', 'dropped'):
+                RECORDER_FRAMES.labels(state).set(stats[state])
+        for cam_id, segments in self.tracker.summary().items():
+            for segment, values in segments.items():
+                LATENCY_MS.labels(cam_id, segment, '0.5').set(values['p50'])
+                LATENCY_MS.labels(cam_id, segment, '0.99').set(values['p99'])
+
+    def create_producer(self, cam: Camera) -> FrameProducer:
+        profile = self.profiles.get(cam.get_id(), self.profiles.get('default'))
+        return FrameProducer(cam, self.frame_queue, self.recorder, profile, self.scheduling)
 
     def run(self):
         log = Log.get_instance()
-        consumer = FrameConsumer(self.frame_queue)
+        log.enable(LOG_CONFIG_INFO_CONSOLE_ONLY)
+        if self.consumer_factory is not None:
+            consumer = self.consumer_factory(self.frame_queue, self.tracker)
+        else:
+            from frame_consumer import FrameConsumer, DISPLAY_RATE
+            consumer = FrameConsumer(self.frame_queue, self.tracker,
+                                     self.display_rate if self.display_rate is not None else DISPLAY_RATE)
 
-        vmb = VmbSystem.get_instance()
-        vmb.enable_log(LOG_CONFIG_INFO_CONSOLE_ONLY)
+        # Real cameras unless the pipeline is fed from a simulated source
+        if self.source is not None:
+            source = self.source
+        else:
+            from frame_source import VmbSource
+            source = VmbSource()
 
         log.info('\'Application\' started.')
+        if self.scheduling is not None:
+            detection_workers = getattr(consumer, 'detection_workers', None)
+            self.scheduling.report(detection_workers.workers if detection_workers is not None else None)
 
-        with vmb:
-            # Construct FrameProducer threads for all detected cameras
-            for cam in vmb.get_all_cameras():
-                self.producers[cam.get_id()] = FrameProducer(cam, self.frame_queue)
+        if self.recorder is not None:
+            self.recorder.start()
+        REGISTRY.register_collector(self.collect_metrics)
 
-            # Start FrameProducer threads
-            with self.producers_lock:
-                for producer in self.producers.values():
-                    producer.start()
+        with source:
+            # The lifecycle thread starts, stops and restarts the FrameProducers of all cameras,
+            # camera change events are only queued to it
+            self.lifecycle = CameraLifecycle(self.create_producer)
+            self.lifecycle.start()
+            source.register_camera_change_handler(self.lifecycle)
+            for cam in source.get_all_cameras():
+                self.lifecycle.add(cam)
 
-            # Run the frame consumer to display the recorded images
-            vmb.register_camera_change_handler(self)
+            # Run the frame consumer to display (or detect) the recorded images
+            if self.scheduling is not None:
+                from scheduling import CONSUMER
+                self.scheduling.apply(CONSUMER)
             consumer.run()
-            vmb.unregister_camera_change_handler(self)
+            source.unregister_camera_change_handler(self.lifecycle)
 
             # Stop all FrameProducer threads
-            with self.producers_lock:
-                # Initiate concurrent shutdown
-                for producer in self.producers.values():
-                    producer.stop()
-
-                # Wait for shutdown to complete
-                for producer in self.producers.values():
-                    producer.join()
+            self.lifecycle.stop()
+            self.lifecycle.join()
+
+        REGISTRY.unregister_collector(self.collect_metrics)
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.recorder.join()
         log.info('\'Application\' terminated.')
\ No newline at end of file
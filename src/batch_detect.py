@@ -0,0 +1,309 @@
+# batch_detect.py
+"""
+Offline tag detection over image directories and video files.
+
+    python batch_detect.py OUTPUT_DIR INPUT [INPUT ...] [--workers N] [--family t16h5b1]
+
+Inputs are split into work units (a run of image files or a frame range of a video)
+that are detected in a process pool. Every finished unit is written as one columnar
+npz shard and appended to OUTPUT_DIR/checkpoint.jsonl, so running the same command
+again after an interruption only processes the units that are missing.
+Image units are identified by the names of their files and split where the file names
+say so, not by position, so files added to a directory later only invalidate the units
+they fall into; every image is a source of its own, with frame number 0. OUTPUT_DIR/batch.json records the family and preset, a run with other
+ones is refused, and the units of the last plan, whose shards make up the results.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Optional, Tuple
+import numpy
+import cv2
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+from aprilgrid import Detector
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.pgm')
+UNIT_IMAGES = 200  # Image files per work unit
+UNIT_FRAMES = 1000  # Video frames per work unit
+PREFETCH = 4  # Decoded frames buffered ahead of the detector in every worker
+CHECKPOINT = 'checkpoint.jsonl'
+MANIFEST = 'batch.json'
+
+# Work unit: (source path, first frame/file, end frame/file, file names of an image unit)
+Unit = Tuple[str, int, int, Tuple[str, ...]]
+
+
+def unit_key(unit: Unit) -> str:
+    path, start, stop, files = unit
+    if files:
+        return f'{os.path.abspath(path)}:' + hashlib.sha1('\n'.join(files).encode()).hexdigest()
+    return f'{os.path.abspath(path)}:{start}:{stop}'
+
+
+def shard_name(unit: Unit) -> str:
+    return hashlib.sha1(unit_key(unit).encode()).hexdigest()[:16] + '.npz'
+
+
+def list_images(path: str) -> List[str]:
+    return sorted(f for f in glob.glob(os.path.join(path, '*')) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def split_images(names: List[str], unit_images: int) -> List[Tuple[int, int]]:
+    # (start, stop) runs of about unit_images files. A run starts at a file whose name hash says so,
+    # so the boundaries do not move when files are added elsewhere; runs are cut at twice the size.
+    runs, start = [], 0
+    for i, name in enumerate(names):
+        boundary = int(hashlib.sha1(name.encode()).hexdigest()[:8], 16) % unit_images == 0
+        if i > start and (boundary or i - start >= 2 * unit_images):
+            runs.append((start, i))
+            start = i
+    if start < len(names):
+        runs.append((start, len(names)))
+    return runs
+
+
+def plan_units(inputs: List[str], unit_images: int = UNIT_IMAGES, unit_frames: int = UNIT_FRAMES) -> List[Unit]:
+    units = []
+    for path in inputs:
+        if os.path.isdir(path):
+            names = [os.path.basename(f) for f in list_images(path)]
+            units.extend((path, start, stop, tuple(names[start:stop]))
+                         for start, stop in split_images(names, unit_images))
+        else:
+            capture = cv2.VideoCapture(path)
+            if not capture.isOpened():
+                raise ValueError(f'Cannot open \'{path}\'')
+            count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            capture.release()
+            units.extend((path, start, min(start + unit_frames, count), ())
+                         for start in range(0, count, unit_frames))
+    return units
+
+
+def read_frames(unit: Unit) -> Iterator[Tuple[int, str, numpy.ndarray]]:
+    # (frame number, image file name or '', gray image) of a unit; 16 bit images are kept as they are
+    path, start, stop, files = unit
+    if files:
+        for name in files:
+            image = cv2.imread(os.path.join(path, name), cv2.IMREAD_UNCHANGED)
+            if image is None:
+                continue
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            yield 0, name, image
+    else:
+        capture = cv2.VideoCapture(path)
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        for i in range(start, stop):
+            ok, image = capture.read()
+            if not ok:
+                break
+            yield i, '', cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        capture.release()
+
+
+def prefetch(frames: Iterator, depth: int = PREFETCH) -> Iterator:
+    # Decode in a thread so file reads and decompression overlap detection
+    buffer = queue.Queue(depth)
+    done = object()
+
+    def reader():
+        try:
+            for item in frames:
+                buffer.put(item)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(done)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+_detector: Optional[Detector] = None
+
+
+def _init_worker(tag_family_name: str, preset: Optional[str] = None):
+    global _detector
+    cv2.setNumThreads(1)  # Parallelism comes from the processes
+    _detector = Detector.from_preset(tag_family_name, preset) if preset else Detector(tag_family_name)
+
+
+def detect_unit(unit: Unit, output: str) -> dict:
+    """
+    Detect all frames of a unit and write its shard. Runs in a worker process.
+    Shard columns, one row per tag: frame, image (file name, '' for videos), family, tag_id,
+    corners (n, 4, 2); plus 'frames' and 'images', every frame that was read, so frames without
+    tags are distinguishable from gaps.
+    """
+    start_time = time.perf_counter()
+    frames, names, tag_frames, tag_images, families, tag_ids, corners = [], [], [], [], [], [], []
+    for i, name, image in prefetch(read_frames(unit)):
+        frames.append(i)
+        names.append(name)
+        for detection in _detector.detect(image):
+            tag_frames.append(i)
+            tag_images.append(name)
+            families.append(detection.family)
+            tag_ids.append(detection.tag_id)
+            corners.append(numpy.asarray(detection.corners, numpy.float32).reshape(4, 2))
+
+    path = os.path.join(output, 'shards', shard_name(unit))
+    temp = path + '.tmp.npz'
+    numpy.savez(temp,
+                source=numpy.array(os.path.abspath(unit[0])),
+                frames=numpy.array(frames, numpy.int64),
+                images=numpy.array(names, str),
+                frame=numpy.array(tag_frames, numpy.int64),
+                image=numpy.array(tag_images, str),
+                family=numpy.array(families, str),
+                tag_id=numpy.array(tag_ids, numpy.int32),
+                corners=numpy.array(corners, numpy.float32).reshape(-1, 4, 2))
+    os.replace(temp, path)  # A shard is either complete or absent
+    return {'unit': unit_key(unit), 'shard': os.path.basename(path), 'frames': len(frames),
+            'tags': len(tag_ids), 'seconds': round(time.perf_counter() - start_time, 3)}
+
+
+def read_manifest(output: str) -> Optional[dict]:
+    path = os.path.join(output, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(output: str, manifest: dict):
+    path = os.path.join(output, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def read_checkpoint(output: str) -> dict:
+    # unit key -> checkpoint record of every finished unit; a torn last line is ignored
+    done = {}
+    path = os.path.join(output, CHECKPOINT)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if os.path.exists(os.path.join(output, 'shards', record['shard'])):
+                    done[record['unit']] = record
+    return done
+
+
+def read_results(output: str) -> dict:
+    """
+    Concatenate the shards of the units of the last batch run into columns, sorted by source and frame.
+    The source of a tag in an image is the image file. Shards of units that run no longer planned,
+    e.g. of an image run that gained files, are left out.
+    :return: {'source', 'frame', 'family', 'tag_id', 'corners'}
+    """
+    manifest = read_manifest(output)
+    planned = set(manifest['units']) if manifest is not None else None
+    sources, columns = [], {'frame': [], 'family': [], 'tag_id': [], 'corners': []}
+    for key, record in read_checkpoint(output).items():
+        if planned is not None and key not in planned:
+            continue
+        with numpy.load(os.path.join(output, 'shards', record['shard'])) as shard:
+            source = str(shard['source'])
+            sources.append(numpy.array([os.path.join(source, name) if name else source for name in shard['image']],
+                                       str) if len(shard['frame']) else numpy.array([], str))
+            for name in columns:
+                columns[name].append(shard[name])
+    if not sources:
+        return {'source': numpy.array([], str), 'frame': numpy.array([], numpy.int64), 'family': numpy.array([], str),
+                'tag_id': numpy.array([], numpy.int32), 'corners': numpy.zeros((0, 4, 2), numpy.float32)}
+    result = {name: numpy.concatenate(arrays) for name, arrays in columns.items()}
+    result['source'] = numpy.concatenate(sources)
+    order = numpy.lexsort((result['frame'], result['source']))
+    return {name: column[order] for name, column in result.items()}
+
+
+def run(inputs: List[str], output: str, tag_family_name: str = 't16h5b1', workers: Optional[int] = None,
+        unit_images: int = UNIT_IMAGES, unit_frames: int = UNIT_FRAMES, preset: Optional[str] = None) -> dict:
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(os.path.join(output, 'shards'), exist_ok=True)
+
+    # Shards detected with another family or preset must not pass as results of this run
+    manifest = read_manifest(output)
+    settings = {'family': tag_family_name, 'preset': preset}
+    if manifest is not None and {name: manifest.get(name) for name in settings} != settings:
+        raise ValueError(f'{output} holds detections of family {manifest.get("family")} with preset '
+                         f'{manifest.get("preset")}, write family {tag_family_name} with preset {preset} elsewhere')
+
+    units = plan_units(inputs, unit_images, unit_frames)
+    write_manifest(output, dict(settings, units=[unit_key(unit) for unit in units]))
+    done = read_checkpoint(output)
+    todo = [unit for unit in units if unit_key(unit) not in done]
+    print(f'{len(units)} units, {len(units) - len(todo)} already done, {workers} workers', flush=True)
+
+    start_time = time.time()
+    frames = tags = 0
+    with open(os.path.join(output, CHECKPOINT), 'a') as checkpoint, \
+            ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(tag_family_name, preset)) as pool:
+        pending = set()
+        todo = iter(todo)
+        while True:
+            # Keep every worker busy with a bounded number of queued units
+            while len(pending) < workers * 2:
+                unit = next(todo, None)
+                if unit is None:
+                    break
+                pending.add(pool.submit(detect_unit, unit, output))
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                record = future.result()
+                checkpoint.write(json.dumps(record) + '\n')
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                frames += record['frames']
+                tags += record['tags']
+            elapsed = time.time() - start_time
+            print(f'[BATCH] {frames} frames, {tags} tags, {frames / max(elapsed, 1e-9):.1f} frames/sec', flush=True)
+
+    return {'frames': frames, 'tags': tags, 'seconds': time.time() - start_time}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Detect tags in image directories and video files.')
+    parser.add_argument('output', help='directory for the result shards and the checkpoint')
+    parser.add_argument('inputs', nargs='+', help='image directories and/or video files')
+    parser.add_argument('--family', default='t16h5b1',
+                        help='tag family to detect, several separated by commas (default: t16h5b1)')
+    parser.add_argument('--preset', help='detector preset name or JSON file, e.g. from python -m aprilgrid.tune')
+    parser.add_argument('--workers', type=int, help='detector processes (default: one per core)')
+    parser.add_argument('--unit-images', type=int, default=UNIT_IMAGES, help='image files per work unit')
+    parser.add_argument('--unit-frames', type=int, default=UNIT_FRAMES, help='video frames per work unit')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        run(args.inputs, args.output, args.family, args.workers, args.unit_images, args.unit_frames, args.preset)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        print('Interrupted, run again to resume.', file=sys.stderr)
+        sys.exit(1)
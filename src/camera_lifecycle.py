@@ -0,0 +1,172 @@
+# camera_lifecycle.py
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+from vmbpy import *
+from frame_producer import FrameProducer
+from metrics import REGISTRY
+
+STARTING = 'starting'  # Producer started, camera not streaming yet
+STREAMING = 'streaming'
+STOPPING = 'stopping'  # Camera missing, producer being torn down
+STOPPED = 'stopped'  # Camera missing, producer gone
+BACKOFF = 'backoff'  # Producer ended on its own, restart scheduled
+STATES = (STARTING, STREAMING, STOPPING, STOPPED, BACKOFF)
+
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+STABLE_TIME = 10.0  # Streaming this long resets the backoff
+POLL_INTERVAL = 0.2
+
+CAMERA_STATE = REGISTRY.gauge('coopercam_camera_state', 'Lifecycle state of a camera, 1 for the current one',
+                              ('camera', 'state'))
+CAMERA_RESTARTS = REGISTRY.counter('coopercam_camera_restarts_total',
+                                   'Producer restarts after it ended while the camera was attached', ('camera',))
+
+
+@dataclass
+class CameraRecord:
+    cam: Camera
+    state: str = STOPPED
+    since: float = 0.0  # time.time() of the last state change
+    attached: bool = True
+    producer: Optional[FrameProducer] = None
+    restarts: int = 0
+    backoff: float = MIN_BACKOFF
+    retry_at: float = 0.0
+
+
+class CameraLifecycle(threading.Thread):
+    """
+    Owns the FrameProducers of all cameras. As a camera change handler it only queues the
+    event, so vmbpy's event delivery never waits for a camera. This thread applies the events:
+    a missing camera is torn down in a thread of its own, so one camera hanging in
+    stop_streaming() holds up neither other cameras nor its own reconnect events, which are
+    applied once the teardown is done. A producer that ends on its own while its camera is
+    attached, e.g. because the camera could not be opened, is restarted with exponential backoff.
+    """
+
+    def __init__(self, create_producer: Callable[[Camera], FrameProducer],
+                 min_backoff: float = MIN_BACKOFF, max_backoff: float = MAX_BACKOFF):
+        threading.Thread.__init__(self, daemon=True)
+        self.log = Log.get_instance()
+        self.create_producer = create_producer
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.events = queue.Queue()
+        self.cameras: Dict[str, CameraRecord] = {}
+        self.lock = threading.Lock()
+        self.killswitch = threading.Event()
+
+    def __call__(self, cam: Camera, event: CameraEvent):
+        # vmbpy camera change handler
+        if event in (CameraEvent.Detected, CameraEvent.Missing):
+            self.events.put((cam, event))
+
+    def add(self, cam: Camera):
+        # A camera that is connected at startup
+        self.events.put((cam, CameraEvent.Detected))
+
+    def states(self) -> dict:
+        # {cam_id: {'state', 'since', 'restarts'}} for monitoring
+        with self.lock:
+            return {cam_id: {'state': record.state, 'since': record.since, 'restarts': record.restarts}
+                    for cam_id, record in sorted(self.cameras.items())}
+
+    def stop(self):
+        self.killswitch.set()
+
+    def _set_state(self, cam_id: str, record: CameraRecord, state: str):
+        if state == record.state:
+            return
+        with self.lock:
+            record.state = state
+            record.since = time.time()
+        for s in STATES:
+            CAMERA_STATE.labels(cam_id, s).set(1 if s == state else 0)
+        self.log.info(f'Camera \'{cam_id}\' {state}.')
+
+    def _start(self, cam_id: str, record: CameraRecord):
+        record.producer = self.create_producer(record.cam)
+        record.producer.start()
+        self._set_state(cam_id, record, STARTING)
+
+    def _teardown(self, cam_id: str, producer: FrameProducer):
+        # Runs in its own thread; may take as long as the camera needs to stop streaming
+        producer.stop()
+        producer.join()
+        self.events.put((cam_id, None))
+
+    def _handle(self, cam, event: Optional[CameraEvent]):
+        if event is None:
+            # Teardown finished; the camera may have come back meanwhile
+            cam_id = cam
+            record = self.cameras[cam_id]
+            record.producer = None
+            if record.attached:
+                self._start(cam_id, record)
+            else:
+                self._set_state(cam_id, record, STOPPED)
+            return
+
+        cam_id = cam.get_id()
+        record = self.cameras.get(cam_id)
+        if event == CameraEvent.Detected:
+            if record is None:
+                with self.lock:
+                    record = self.cameras[cam_id] = CameraRecord(cam, since=time.time())
+            record.cam = cam
+            record.attached = True
+            record.backoff = self.min_backoff
+            if record.state in (STOPPED, BACKOFF):
+                self._start(cam_id, record)
+
+        elif event == CameraEvent.Missing and record is not None:
+            record.attached = False
+            if record.state in (STARTING, STREAMING):
+                self._set_state(cam_id, record, STOPPING)
+                threading.Thread(target=self._teardown, args=(cam_id, record.producer), daemon=True,
+                                 name=f'Teardown({cam_id})').start()
+            elif record.state == BACKOFF:
+                record.producer = None
+                self._set_state(cam_id, record, STOPPED)
+
+    def _supervise(self):
+        now = time.time()
+        for cam_id, record in list(self.cameras.items()):
+            producer = record.producer
+            if record.state == STARTING and producer.streaming.is_set():
+                self._set_state(cam_id, record, STREAMING)
+            elif record.state == STREAMING and now - record.since >= STABLE_TIME:
+                record.backoff = self.min_backoff
+
+            if record.state in (STARTING, STREAMING) and not producer.is_alive():
+                # Ended without being stopped: the camera failed while it is still attached
+                record.retry_at = now + record.backoff
+                self.log.warning(f'Camera \'{cam_id}\' stopped unexpectedly, restarting in {record.backoff:.1f} s.')
+                record.backoff = min(record.backoff * 2, self.max_backoff)
+                self._set_state(cam_id, record, BACKOFF)
+            elif record.state == BACKOFF and now >= record.retry_at:
+                with self.lock:
+                    record.restarts += 1
+                CAMERA_RESTARTS.labels(cam_id).inc()
+                self._start(cam_id, record)
+
+    def run(self):
+        self.log.info('\'CameraLifecycle\' started.')
+        while not self.killswitch.is_set():
+            try:
+                self._handle(*self.events.get(timeout=POLL_INTERVAL))
+            except queue.Empty:
+                pass
+            self._supervise()
+
+        # Initiate concurrent shutdown, then wait for it to complete
+        producers = [record.producer for record in self.cameras.values() if record.producer is not None]
+        for producer in producers:
+            producer.stop()
+        for producer in producers:
+            producer.join()
+        self.log.info('\'CameraLifecycle\' terminated.')
@@ -0,0 +1,279 @@
+# camera_profile.py
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, asdict, fields
+from typing import Dict, List, Optional, Tuple
+from vmbpy import *
+
+USER_SET_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'coopercam', 'usersets.json')
+USER_SET_LOAD_TIMEOUT = 2.0
+FLOAT_TOLERANCE = 0.005  # Cameras quantize float features, e.g. ExposureTime 20000 reads back as 19997.76
+
+
+class CameraProfileError(Exception):
+    pass
+
+
+@dataclass
+class CameraProfile:
+    """
+    Declarative camera settings. Fields set to None are left untouched.
+    Profiles that are applied to the same camera in turn need distinct user_set values,
+    otherwise each one saves over the other's UserSet.
+    """
+    exposure_time: Optional[float] = 10000.0
+    gain: Optional[float] = 20.0
+    frame_rate: Optional[float] = 35.04
+    binning: Optional[int] = 1
+    pixel_format: Optional[str] = 'Mono8'
+    user_set: Optional[str] = 'UserSet1'
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'CameraProfile':
+        names = {f.name for f in fields(cls)}
+        unknown = set(values) - names
+        if unknown:
+            raise CameraProfileError(f'Unknown camera profile settings: {sorted(unknown)}')
+        return cls(**values)
+
+    def features(self) -> List[Tuple[str, object]]:
+        # Order matters: the frame rate range depends on binning, pixel format and exposure
+        settings = []
+        if self.exposure_time is not None:
+            settings.append(('ExposureAuto', 'Off'))
+        if self.binning is not None:
+            settings += [('BinningHorizontal', self.binning), ('BinningVertical', self.binning)]
+        if self.pixel_format is not None:
+            settings.append(('PixelFormat', self.pixel_format))
+        if self.exposure_time is not None:
+            settings.append(('ExposureTime', self.exposure_time))
+        if self.gain is not None:
+            settings.append(('Gain', self.gain))
+        if self.frame_rate is not None:
+            settings += [('AcquisitionFrameRateEnable', True),
+                         ('AcquisitionFrameRateMode', 'Basic'),
+                         ('AcquisitionFrameRate', self.frame_rate)]
+        return settings
+
+    def fingerprint(self) -> str:
+        return hashlib.sha1(json.dumps(self.features()).encode()).hexdigest()
+
+    def untouched_features(self) -> List[str]:
+        # Features of the fields set to None, which a UserSetLoad would overwrite as well
+        profiled = {name for name, _ in self.features()}
+        return [name for name, _ in COMPLETE_PROFILE.features() if name not in profiled]
+
+
+COMPLETE_PROFILE = CameraProfile()  # Every field set, for the names of all features a profile covers
+
+
+def load_profiles(path: str) -> Dict[str, CameraProfile]:
+    """
+    Read camera profiles from a JSON file. The file holds either a single profile or
+    a mapping of camera id to profile with an optional 'default' entry.
+    """
+    with open(path) as f:
+        values = json.load(f)
+    if all(isinstance(v, dict) for v in values.values()):
+        return {cam_id: CameraProfile.from_dict(v) for cam_id, v in values.items()}
+    return {'default': CameraProfile.from_dict(values)}
+
+
+class UserSetCache:
+    """
+    Remembers which profile fingerprint was saved into which UserSet of which camera,
+    so a known camera can be restored with a single UserSetLoad.
+    """
+
+    def __init__(self, path: str = USER_SET_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, cam_id: str, user_set: str) -> Optional[str]:
+        with self.lock:
+            return self.entries.get(cam_id, {}).get(user_set)
+
+    def set(self, cam_id: str, user_set: str, fingerprint: str):
+        with self.lock:
+            self.entries.setdefault(cam_id, {})[user_set] = fingerprint
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+
+
+_default_cache = None
+
+
+def default_user_set_cache() -> UserSetCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = UserSetCache()
+    return _default_cache
+
+
+def _read(cam: Camera, name: str):
+    if name == 'PixelFormat':
+        return str(cam.get_pixel_format())
+    return getattr(cam, name).get()
+
+
+def _write(cam: Camera, name: str, value):
+    if name == 'PixelFormat':
+        cam.set_pixel_format(PixelFormat[value])
+    else:
+        getattr(cam, name).set(value)
+
+
+def _equal(current, value) -> bool:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return str(current) == str(value)
+    return abs(float(current) - value) <= FLOAT_TOLERANCE * max(abs(value), 1.0)
+
+
+def read_features(cam: Camera, names: List[str]) -> List[Tuple[str, object]]:
+    values = []
+    for name in names:
+        try:
+            values.append((name, _read(cam, name)))
+        except (AttributeError, VmbFeatureError):
+            pass  # Not available on this camera, nothing to restore either
+    return values
+
+
+def restore_features(cam: Camera, values: List[Tuple[str, object]]):
+    for name, value in values:
+        try:
+            if not _equal(_read(cam, name), value):
+                _write(cam, name, value)
+        except (AttributeError, VmbFeatureError) as e:
+            raise CameraProfileError(f'Camera \'{cam.get_id()}\': restoring {name}={value} failed: {e}') from e
+
+
+def validate_profile(cam: Camera, profile: CameraProfile):
+    """
+    Check every setting against what the camera reports as supported.
+    :raise CameraProfileError: listing every setting that does not fit
+    """
+    problems = []
+    for name, value in profile.features():
+        try:
+            if name == 'PixelFormat':
+                if value not in [str(f) for f in cam.get_pixel_formats()]:
+                    problems.append(f'{name}={value} is not supported')
+                continue
+            feature = getattr(cam, name)
+            # The frame rate range depends on the other settings, the camera clamps it itself
+            if name != 'AcquisitionFrameRate' and hasattr(feature, 'get_range') \
+                    and isinstance(value, (int, float)) and not isinstance(value, bool):
+                low, high = feature.get_range()
+                if not low <= value <= high:
+                    problems.append(f'{name}={value} is outside of [{low}, {high}]')
+        except AttributeError:
+            problems.append(f'{name} is not available')
+        except VmbFeatureError as e:
+            problems.append(f'{name}: {e}')
+    if problems:
+        raise CameraProfileError(f'Camera \'{cam.get_id()}\': ' + '; '.join(problems))
+
+
+def write_differences(cam: Camera, profile: CameraProfile) -> int:
+    """
+    Write only the settings whose current value differs from the profile.
+    :return: number of features written
+    """
+    written = 0
+    for name, value in profile.features():
+        try:
+            if _equal(_read(cam, name), value):
+                continue
+            _write(cam, name, value)
+            written += 1
+        except (AttributeError, VmbFeatureError) as e:
+            raise CameraProfileError(f'Camera \'{cam.get_id()}\': setting {name}={value} failed: {e}') from e
+    return written
+
+
+def load_user_set(cam: Camera, user_set: str):
+    cam.UserSetSelector.set(user_set)
+    cam.UserSetLoad.run()
+    deadline = time.perf_counter() + USER_SET_LOAD_TIMEOUT
+    while not cam.UserSetLoad.is_done():
+        if time.perf_counter() > deadline:
+            raise CameraProfileError(f'Camera \'{cam.get_id()}\': UserSetLoad of {user_set} timed out')
+        time.sleep(0.001)
+
+
+def save_user_set(cam: Camera, user_set: str):
+    cam.UserSetSelector.set(user_set)
+    cam.UserSetSave.run()
+
+
+def set_user_set_default(cam: Camera, user_set: str):
+    # The camera loads this UserSet when it powers up; older firmware names the feature UserSetDefaultSelector
+    feature = cam.UserSetDefault if hasattr(cam, 'UserSetDefault') else cam.UserSetDefaultSelector
+    if str(feature.get()) != user_set:
+        feature.set(user_set)
+
+
+def apply_profile(cam: Camera, profile: CameraProfile, cache: Optional[UserSetCache] = None) -> str:
+    """
+    Bring the camera into the state described by profile, as cheaply as possible:
+    a single UserSetLoad if the profile was saved into the camera before, otherwise
+    validate, write only the differing features and save them into the UserSet, which also
+    becomes the set the camera powers up with.
+    The cache entry is bound to the device serial, so a swapped camera is configured anew;
+    the profiled features are not read back after the load, which would cost more than the
+    diff path. A UserSet changed by another host is not noticed: remove its entry from the
+    cache file. Features the profile leaves untouched are read before the load and restored
+    after it, a profile with every field set has none.
+    The camera must be opened and not streaming.
+    :return: 'userset' or 'features', the path that was taken
+    """
+    log = Log.get_instance()
+    cache = cache if cache is not None else default_user_set_cache()
+    cam_id = cam.get_id()
+    # The serial is known to vmbpy without asking the device
+    fingerprint = f'{profile.fingerprint()}:{cam.get_serial()}'
+    start = time.perf_counter()
+
+    if profile.user_set and cache.get(cam_id, profile.user_set) == fingerprint:
+        try:
+            untouched = read_features(cam, profile.untouched_features())
+            load_user_set(cam, profile.user_set)
+            restore_features(cam, untouched)
+            log.info(f'Camera \'{cam_id}\' restored from {profile.user_set} '
+                     f'in {(time.perf_counter() - start) * 1000:.1f} ms.')
+            return 'userset'
+        except (AttributeError, VmbFeatureError, CameraProfileError) as e:
+            log.warning(f'Camera \'{cam_id}\': loading {profile.user_set} failed ({e}), writing features.')
+
+    validate_profile(cam, profile)
+    written = write_differences(cam, profile)
+
+    if profile.user_set and hasattr(cam, 'UserSetSave'):
+        previous = cache.get(cam_id, profile.user_set)
+        if previous is not None and previous.partition(':')[0] != fingerprint.partition(':')[0]:
+            log.warning(f'Camera \'{cam_id}\': {profile.user_set} held another profile and is overwritten; '
+                        f'profiles used in turn on one camera need distinct user sets.')
+        try:
+            save_user_set(cam, profile.user_set)
+            cache.set(cam_id, profile.user_set, fingerprint)
+        except VmbFeatureError as e:
+            log.warning(f'Camera \'{cam_id}\': saving {profile.user_set} failed ({e}).')
+        else:
+            try:
+                set_user_set_default(cam, profile.user_set)
+            except (AttributeError, VmbFeatureError) as e:
+                log.warning(f'Camera \'{cam_id}\': making {profile.user_set} the power-up default failed ({e}).')
+
+    log.info(f'Camera \'{cam_id}\' configured, {written} of {len(profile.features())} features written '
+             f'in {(time.perf_counter() - start) * 1000:.1f} ms.')
+    return 'features'
@@ -0,0 +1,421 @@
+# detection_service.py
+import json
+import os
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+import numpy
+import cv2
+from vmbpy import *
+from aprilgrid import Detector
+from aprilgrid.detection import Detection
+from aprilgrid.quality import DETECT, REUSE, SKIP, QualityGate
+from aprilgrid.tracker import DETECT as FULL_DETECTION, TagTracker
+from frame_trace import FrameTrace, LatencyTracker
+from metrics import REGISTRY, record_detector_timings
+from pixel_format import UNPACKERS, frame_bit_depth, frame_to_image
+from scheduling import COMPUTE, SchedulingPlan
+
+TAG_FAMILY = 't16h5b1'
+SUMMARY_INTERVAL = 10.0
+WARMUP_SHAPE = (3036, 4024)  # Full sensor height, width of the deployed cameras
+WARMUP_TIMEOUT = 10.0
+
+FRAMES_DETECTED = REGISTRY.counter('coopercam_frames_detected_total', 'Frames run through the detector', ('camera',))
+TAGS_DETECTED = REGISTRY.counter('coopercam_tags_detected_total', 'Tags found by the detector', ('camera',))
+GATE_FRAMES = REGISTRY.counter('coopercam_quality_gate_frames_total',
+                               'Frames the quality gate sent to detection, answered with reused results, or skipped',
+                               ('camera', 'decision'))
+
+
+@dataclass
+class DetectionResult:
+    cam_id: str
+    frame_id: int
+    device_timestamp: int
+    shape: Tuple[int, int]  # Height, width of the image the corners refer to
+    detections: List[Detection] = field(default_factory=list)
+    detect_seconds: float = 0.0
+    time: float = 0.0  # Host wall clock when the result was ready
+    gate: str = DETECT  # Quality gate decision: detected, reused from the last detected frame, or skipped
+
+    def to_dict(self) -> dict:
+        return {
+            'camera': self.cam_id,
+            'frame_id': self.frame_id,
+            'device_timestamp': self.device_timestamp,
+            'time': self.time,
+            'detect_ms': round(self.detect_seconds * 1000, 3),
+            'gate': self.gate,
+            'tags': [{'id': int(d.tag_id), 'family': d.family,
+                      'corners': numpy.asarray(d.corners).reshape(-1, 2).round(3).tolist()}
+                     for d in self.detections],
+        }
+
+
+class JsonLinesSink:
+    """
+    Writes one JSON object per result and line to a text stream, flushed line by line so a
+    consumer reading a pipe sees every result as soon as it is ready.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, result: DetectionResult):
+        line = json.dumps(result.to_dict(), separators=(',', ':'))
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            self.stream.flush()
+
+
+def warmup_image(tag_family_name: str, shape: Tuple[int, int], bits: int = 8) -> numpy.ndarray:
+    # Tags rendered small and scaled up: cheap to make, yet every detector stage runs on it
+    from aprilgrid.synthetic import render_scene
+    image, _ = render_scene(tag_family_name, (640, 480), rng=numpy.random.default_rng(0))
+    image = cv2.resize(image, shape[::-1], interpolation=cv2.INTER_LINEAR)
+    if bits > 8:
+        image = image.astype(numpy.uint16) << (bits - 8)
+    return image
+
+
+class DetectionWorkers:
+    """
+    Runs the detector on frames in a thread pool; OpenCV releases the GIL for the heavy
+    stages. Every worker thread has its own Detector and unpack buffer.
+    With a gate_factory every camera gets a QualityGate that skips blurred frames and
+    reuses the last results while the image does not change.
+    With a warmup_shape every worker builds its Detector and runs it once on a synthetic
+    frame of that size right away, while the cameras are still being opened, so the first
+    real frames do not pay for table construction, OpenCV initialization and allocations.
+    With a track_interval every camera gets a TagTracker that follows the tags with optical
+    flow and runs a full detection only every track_interval frames or when tags are lost.
+    Tracking needs the frames of a camera in order, so then each camera's frames are queued
+    and run one after the other on whichever worker is free; different cameras still run in parallel.
+    """
+
+    def __init__(self, tag_family_name: str = TAG_FAMILY, workers: Optional[int] = None,
+                 tracker: Optional[LatencyTracker] = None,
+                 gate_factory: Optional[Callable[[], QualityGate]] = None, preset: Optional[str] = None,
+                 warmup_shape: Optional[Tuple[int, int]] = None, warmup_bits: int = 8,
+                 scheduling: Optional[SchedulingPlan] = None, track_interval: Optional[int] = None):
+        self.tag_family_name = tag_family_name
+        self.preset = preset  # Detector preset name or file, None for the defaults
+        self.gate_factory = gate_factory
+        self.gates = {}
+        self.track_interval = track_interval
+        self.tag_trackers = {}
+        self.ordered = {}  # Frames waiting per camera when tracking, in submission order
+        # One worker per core it may run on
+        self.workers = workers or (scheduling.compute_cores() if scheduling is not None else os.cpu_count()) or 1
+        self.tracker = tracker
+        self.scheduling = scheduling  # Every worker thread pins itself to the compute cores
+        if scheduling is not None:
+            scheduling.configure_opencv(self.workers)
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='Detector')
+        self.pending = threading.BoundedSemaphore(self.workers * 2)
+        self.local = threading.local()
+        self.busy = {}  # Frames in flight per camera
+        self.busy_lock = threading.Lock()
+        self.log = Log.get_instance()
+        self.start_time = time.perf_counter()
+        self.first_frame = {}  # [time of the first frame, detected yet] per camera since it (re)connected
+        if warmup_shape is not None:
+            self.warm_up(warmup_shape, warmup_bits)
+
+    def create_detector(self) -> Detector:
+        if self.preset:
+            return Detector.from_preset(self.tag_family_name, self.preset)
+        return Detector(self.tag_family_name)
+
+    def detector(self) -> Detector:
+        if not hasattr(self.local, 'detector'):
+            if self.scheduling is not None:
+                self.scheduling.apply(COMPUTE)
+            self.local.detector = self.create_detector()
+            self.local.buffers = {}
+        return self.local.detector
+
+    def warm_up(self, shape: Tuple[int, int], bits: int = 8):
+        """
+        Queue one warm-up pass per worker thread without waiting for it. Frames submitted
+        meanwhile wait behind the warm-up in the pool.
+        :param shape: height, width of the frames to expect
+        :param bits: significant bits per pixel, above 8 the unpack buffers are allocated too
+        """
+        # Every thread waits for the others, so each one takes exactly one pass
+        barrier = threading.Barrier(self.workers)
+        image = []
+        image_lock = threading.Lock()
+        done = []
+
+        def run():
+            start = time.perf_counter()
+            detector = self.detector()
+            if bits > 8:
+                self.local.buffers[shape] = numpy.empty(shape, numpy.uint16)
+            with image_lock:
+                if not image:
+                    image.append(warmup_image(self.tag_family_name, shape, bits))
+            try:
+                barrier.wait(WARMUP_TIMEOUT)
+            except threading.BrokenBarrierError:
+                pass
+            detector.detect(image[0])
+            with image_lock:
+                done.append(time.perf_counter() - start)
+                if len(done) == self.workers:
+                    self.log.info(f'Detector warm-up at {shape[1]}x{shape[0]} done on {self.workers} threads '
+                                  f'in {max(done):.2f} s.')
+
+        for _ in range(self.workers):
+            self.pool.submit(run)
+
+    def reset(self, cam_id: str):
+        # The camera was removed: a reconnect measures its time to first detection again
+        with self.busy_lock:
+            self.first_frame.pop(cam_id, None)
+            self.gates.pop(cam_id, None)
+            self.tag_trackers.pop(cam_id, None)
+
+    def tag_tracker(self, cam_id: str) -> Optional[TagTracker]:
+        if self.track_interval is None:
+            return None
+        with self.busy_lock:
+            if cam_id not in self.tag_trackers:
+                # Tracks with the warmed-up detector of whichever worker runs the frame, see _detect()
+                self.tag_trackers[cam_id] = TagTracker(self.detector(), self.track_interval)
+            return self.tag_trackers[cam_id]
+
+    def gate(self, cam_id: str) -> Optional[QualityGate]:
+        if self.gate_factory is None:
+            return None
+        with self.busy_lock:
+            if cam_id not in self.gates:
+                self.gates[cam_id] = self.gate_factory()
+            return self.gates[cam_id]
+
+    def submit(self, cam_id: str, frame: Frame, trace: Optional[FrameTrace],
+               callback: Callable[[DetectionResult], None], block: bool = True) -> bool:
+        """
+        Queue a frame for detection. With block=False the frame is refused when the pool is
+        saturated or the camera already has a frame in flight.
+        :return: whether the frame was accepted
+        """
+        if block:
+            self.pending.acquire()
+        with self.busy_lock:
+            if not block and (self.busy.get(cam_id) or not self.pending.acquire(blocking=False)):
+                return False
+            self.busy[cam_id] = self.busy.get(cam_id, 0) + 1
+            if cam_id not in self.first_frame:
+                self.first_frame[cam_id] = [time.perf_counter(), False]
+            if self.track_interval is not None:
+                # A worker already running this camera's frames takes this one after them
+                running = cam_id in self.ordered
+                self.ordered.setdefault(cam_id, deque()).append((frame, trace, callback))
+                if running:
+                    return True
+        if self.track_interval is not None:
+            self.pool.submit(self._detect_in_order, cam_id)
+        else:
+            self.pool.submit(self._detect, cam_id, frame, trace, callback)
+        return True
+
+    def _detect_in_order(self, cam_id: str):
+        while True:
+            with self.busy_lock:
+                frames = self.ordered[cam_id]
+                if not frames:
+                    del self.ordered[cam_id]
+                    return
+                frame, trace, callback = frames.popleft()
+            self._detect(cam_id, frame, trace, callback)
+
+    def _detect(self, cam_id: str, frame: Frame, trace: Optional[FrameTrace],
+                callback: Callable[[DetectionResult], None]):
+        try:
+            detector = self.detector()
+            if trace is not None:
+                trace.mark('detect_start')
+            start = time.perf_counter()
+
+            image = frame_to_image(frame, self._buffer(frame))
+            gate = self.gate(cam_id)
+            # The keyframe ties the reference image to its detections, frames of this camera run concurrently
+            decision, keyframe = (DETECT, None) if gate is None else gate.decide(image, frame_bit_depth(frame))
+            tag_tracker = self.tag_tracker(cam_id)
+            timings = None
+            if decision == DETECT:
+                if tag_tracker is None:
+                    detections = detector.detect(image)
+                    timings = detector.timings, detector.counts
+                else:
+                    with tag_tracker.lock:
+                        tag_tracker.detector = detector
+                        detections = tag_tracker.track(image)
+                        # Only full detections report detector timings
+                        if tag_tracker.mode == FULL_DETECTION:
+                            timings = detector.timings, detector.counts
+                if gate is not None:
+                    gate.update(detections, keyframe)
+            elif decision == REUSE:
+                detections = list(keyframe.detections)
+            else:
+                detections = []
+
+            result = DetectionResult(cam_id, frame.get_id(), frame.get_timestamp() or 0, image.shape[:2],
+                                     detections, time.perf_counter() - start, time.time(), decision)
+            if trace is not None:
+                trace.mark('detect_end')
+                if self.tracker is not None:
+                    self.tracker.finish(trace)
+            if decision == DETECT:
+                if timings is not None:
+                    record_detector_timings(*timings)
+                FRAMES_DETECTED.labels(cam_id).inc()
+                TAGS_DETECTED.labels(cam_id).inc(len(detections))
+            if gate is not None:
+                GATE_FRAMES.labels(cam_id, decision).inc()
+            callback(result)
+            self._first_result(cam_id)
+
+        except Exception as e:
+            Log.get_instance().error(f'Detection on camera \'{cam_id}\' failed: {e!r}')
+
+        finally:
+            with self.busy_lock:
+                self.busy[cam_id] -= 1
+            self.pending.release()
+
+    def _first_result(self, cam_id: str):
+        with self.busy_lock:
+            first = self.first_frame.get(cam_id)
+            if first is None or first[1]:
+                return
+            first[1] = True
+        now = time.perf_counter()
+        self.log.info(f'First detection on camera \'{cam_id}\' {now - first[0]:.3f} s after its first frame, '
+                      f'{now - self.start_time:.2f} s after start.')
+
+    def _buffer(self, frame: Frame) -> Optional[numpy.ndarray]:
+        if frame.get_pixel_format() not in UNPACKERS:
+            return None
+        shape = (frame.get_height(), frame.get_width())
+        buffer = self.local.buffers.get(shape)
+        if buffer is None:
+            buffer = self.local.buffers[shape] = numpy.empty(shape, numpy.uint16)
+        return buffer
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class DetectionService:
+    """
+    Headless consumer: every frame taken from the frame queue is detected by the worker pool
+    and the results are handed to the sinks. When the workers fall behind, the service stops
+    taking frames and FrameProducer drops them at the queue, where they are counted.
+    """
+
+    @property
+    def detection_workers(self) -> DetectionWorkers:
+        # Named like the attribute of FrameConsumer
+        return self.workers
+
+    def __init__(self, frame_queue: queue.Queue, sinks: list, tracker: Optional[LatencyTracker] = None,
+                 tag_family_name: str = TAG_FAMILY, workers: Optional[int] = None,
+                 summary_interval: float = SUMMARY_INTERVAL,
+                 gate_factory: Optional[Callable[[], QualityGate]] = None, preset: Optional[str] = None,
+                 warmup_shape: Optional[Tuple[int, int]] = None, scheduling: Optional[SchedulingPlan] = None,
+                 track_interval: Optional[int] = None, warmup_bits: int = 8):
+        self.log = Log.get_instance()
+        self.frame_queue = frame_queue
+        self.sinks = sinks
+        self.tracker = tracker
+        self.workers = DetectionWorkers(tag_family_name, workers, tracker, gate_factory, preset, warmup_shape,
+                                        warmup_bits, scheduling, track_interval)
+        self.summary_interval = summary_interval
+        self.killswitch = threading.Event()
+
+        self.stats_lock = threading.Lock()
+        self.frames = {}
+        self.tags = {}
+        self.detect_seconds = {}
+        self.gated = {}  # cam_id -> {REUSE: n, SKIP: n}
+
+    def stop(self):
+        self.killswitch.set()
+
+    def publish(self, result: DetectionResult):
+        with self.stats_lock:
+            self.frames[result.cam_id] = self.frames.get(result.cam_id, 0) + 1
+            self.tags[result.cam_id] = self.tags.get(result.cam_id, 0) + len(result.detections)
+            self.detect_seconds[result.cam_id] = self.detect_seconds.get(result.cam_id, 0.0) + result.detect_seconds
+            if result.gate != DETECT:
+                gated = self.gated.setdefault(result.cam_id, {REUSE: 0, SKIP: 0})
+                gated[result.gate] += 1
+        for sink in self.sinks:
+            sink.write(result)
+
+    def summary(self, elapsed: float):
+        with self.stats_lock:
+            frames, tags, seconds, gated = self.frames, self.tags, self.detect_seconds, self.gated
+            self.frames, self.tags, self.detect_seconds, self.gated = {}, {}, {}, {}
+
+        for cam_id in sorted(frames):
+            n = frames[cam_id]
+            text = (f'[DETECTION] {cam_id}: {n / elapsed:.2f} frames/sec, '
+                    f'{tags[cam_id] / n:.1f} tags/frame, {seconds[cam_id] / n * 1000:.1f} ms/frame')
+            if self.workers.gate_factory is not None:
+                g = gated.get(cam_id, {REUSE: 0, SKIP: 0})
+                text += f', {g[REUSE]} reused, {g[SKIP]} skipped'
+            self.log.info(text)
+        if self.tracker is not None:
+            self.tracker.report()
+
+    def run(self):
+        self.log.info(f'\'DetectionService\' started with {self.workers.workers} workers, '
+                      f'{cv2.getNumThreads()} OpenCV threads.')
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, stack: self.stop())
+
+        last_summary = time.time()
+        try:
+            while not self.killswitch.is_set():
+                try:
+                    cam_id, frame, trace = self.frame_queue.get(timeout=0.5)
+                except queue.Empty:
+                    cam_id = frame = None
+
+                if frame:
+                    if trace is not None:
+                        trace.mark('dequeue')
+                    self.workers.submit(cam_id, frame, trace, self.publish)
+                elif cam_id is not None:
+                    self.workers.reset(cam_id)
+
+                if time.time() - last_summary >= self.summary_interval:
+                    self.summary(time.time() - last_summary)
+                    last_summary = time.time()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.workers.shutdown()
+            for sink in self.sinks:
+                sink.close()
+
+        self.log.info('\'DetectionService\' terminated.')
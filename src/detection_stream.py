@@ -0,0 +1,264 @@
+# detection_stream.py
+import os
+import queue
+import socket
+import stat
+import struct
+import threading
+from dataclasses import dataclass
+from typing import Iterator, Optional
+import numpy
+from vmbpy import *
+from metrics import REGISTRY
+
+MAGIC = b'CTAG'
+VERSION = 2  # 2: family codes after the corners
+SUBSCRIBER_QUEUE_SIZE = 256  # Messages buffered per subscriber before its messages are dropped
+
+# Fixed message layout, little endian:
+#   header   magic, version, cam_id length, frame_id, device_timestamp, host time, tag count, message size
+#   cam_id   utf-8, zero padded to a multiple of 4 bytes
+#   ids      int32[n]
+#   corners  float32[n, 4, 2]
+#   families uint8[n], index into FAMILY_NAMES, zero padded to a multiple of 4 bytes
+HEADER = struct.Struct('<4sHHqqdII')
+
+# Family codes of the stream. Only ever append: subscribers decode the codes with this table.
+# Code 0 is a tag of unknown family.
+FAMILY_NAMES = ('', 't36h11', 't36h11b1', 't25h9', 't25h9b1', 't25h7', 't25h7b1', 't16h5', 't16h5b1')
+FAMILY_CODES = {name: code for code, name in enumerate(FAMILY_NAMES)}
+
+STREAM_SUBSCRIBERS = REGISTRY.gauge('coopercam_stream_subscribers', 'Connected detection stream subscribers')
+STREAM_MESSAGES = REGISTRY.counter('coopercam_stream_messages_total', 'Detection sets published')
+STREAM_DROPPED = REGISTRY.counter('coopercam_stream_dropped_total',
+                                  'Detection sets dropped because a subscriber fell behind')
+
+
+def _padded(size: int) -> int:
+    return (size + 3) & ~3
+
+
+def family_code(name: str) -> int:
+    if name not in FAMILY_CODES:
+        raise ValueError(f'Tag family \'{name}\' has no detection stream code')
+    return FAMILY_CODES[name]
+
+
+def encode(cam_id: str, frame_id: int, device_timestamp: int, host_time: float,
+           ids: numpy.ndarray, corners: numpy.ndarray, families: Optional[numpy.ndarray] = None) -> bytes:
+    """
+    :param ids: (n,) tag ids
+    :param corners: (n, 4, 2) corners in image coordinates
+    :param families: (n,) family codes, see FAMILY_NAMES; None for unknown
+    """
+    name = cam_id.encode()
+    ids = numpy.ascontiguousarray(ids, '<i4')
+    corners = numpy.ascontiguousarray(corners, '<f4').reshape(len(ids), 4, 2)
+    families = numpy.zeros(len(ids), numpy.uint8) if families is None else numpy.ascontiguousarray(families, numpy.uint8)
+    if families.shape != ids.shape:
+        raise ValueError(f'{len(families)} family codes for {len(ids)} tags')
+    size = HEADER.size + _padded(len(name)) + ids.nbytes + corners.nbytes + _padded(families.nbytes)
+    return b''.join((
+        HEADER.pack(MAGIC, VERSION, len(name), frame_id, device_timestamp, host_time, len(ids), size),
+        name, bytes(_padded(len(name)) - len(name)), ids.tobytes(), corners.tobytes(),
+        families.tobytes(), bytes(_padded(families.nbytes) - families.nbytes)))
+
+
+def encode_result(result) -> bytes:
+    # Serialize a detection_service.DetectionResult
+    n = len(result.detections)
+    ids = numpy.fromiter((d.tag_id for d in result.detections), numpy.int32, n)
+    families = numpy.fromiter((family_code(d.family) for d in result.detections), numpy.uint8, n)
+    corners = numpy.empty((n, 4, 2), numpy.float32)
+    for i, d in enumerate(result.detections):
+        corners[i] = numpy.asarray(d.corners, numpy.float32).reshape(4, 2)
+    return encode(result.cam_id, result.frame_id, result.device_timestamp, result.time, ids, corners, families)
+
+
+@dataclass
+class DetectionSet:
+    cam_id: str
+    frame_id: int
+    device_timestamp: int
+    time: float
+    ids: numpy.ndarray  # int32 (n,), a view on the received message
+    corners: numpy.ndarray  # float32 (n, 4, 2), a view on the received message
+    families: numpy.ndarray  # uint8 (n,) family codes, a view on the received message
+
+    def family_names(self) -> list:
+        return [FAMILY_NAMES[code] if code < len(FAMILY_NAMES) else '' for code in self.families.tolist()]
+
+
+def decode(buffer) -> DetectionSet:
+    """
+    Decode one complete message. ids and corners are views on buffer, nothing is copied.
+    """
+    magic, version, name_size, frame_id, device_timestamp, host_time, n, size = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'Not a detection stream message (magic {magic!r}, version {version})')
+    offset = HEADER.size
+    cam_id = bytes(buffer[offset:offset + name_size]).decode()
+    offset += _padded(name_size)
+    ids = numpy.frombuffer(buffer, '<i4', n, offset)
+    offset += ids.nbytes
+    corners = numpy.frombuffer(buffer, '<f4', n * 8, offset).reshape(n, 4, 2)
+    offset += corners.nbytes
+    families = numpy.frombuffer(buffer, numpy.uint8, n, offset)
+    return DetectionSet(cam_id, frame_id, device_timestamp, host_time, ids, corners, families)
+
+
+class _Subscriber(threading.Thread):
+    # Sends the messages of one connection; the publisher never waits for it
+    def __init__(self, connection: socket.socket, name: str, queue_size: int):
+        threading.Thread.__init__(self, name=f'DetectionStream-{name}', daemon=True)
+        self.connection = connection
+        self.messages = queue.Queue(queue_size)
+        self.dropped = 0
+        self.alive = True
+
+    def offer(self, message: bytes):
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+            STREAM_DROPPED.inc()
+
+    def close(self):
+        self.alive = False
+        try:
+            self.messages.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def run(self):
+        try:
+            while self.alive:
+                message = self.messages.get()
+                if message is None:
+                    break
+                self.connection.sendall(message)
+        except OSError:
+            pass
+        finally:
+            self.alive = False
+            self.connection.close()
+
+
+class DetectionPublisher(threading.Thread):
+    """
+    Fans detection results out to any number of local subscribers over a Unix domain socket.
+    Each message is encoded once; every subscriber has a bounded queue and a sender thread,
+    so a slow subscriber loses messages instead of stalling detection. Usable as a
+    DetectionService sink.
+    """
+
+    def __init__(self, path: str, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        threading.Thread.__init__(self, name='DetectionPublisher', daemon=True)
+        self.log = Log.get_instance()
+        self.path = path
+        self.queue_size = queue_size
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.connections = 0
+
+        # A socket file left behind by a previous run would make bind() fail
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        self.start()
+
+    def run(self):
+        self.log.info(f'\'DetectionPublisher\' listening on {self.path}.')
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                break
+            connection.shutdown(socket.SHUT_RD)
+            self.connections += 1
+            subscriber = _Subscriber(connection, str(self.connections), self.queue_size)
+            subscriber.start()
+            with self.lock:
+                self.subscribers.append(subscriber)
+                STREAM_SUBSCRIBERS.set(len(self.subscribers))
+
+    def publish(self, message: bytes):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s.alive]
+            subscribers = list(self.subscribers)
+            STREAM_SUBSCRIBERS.set(len(subscribers))
+        STREAM_MESSAGES.inc()
+        for subscriber in subscribers:
+            subscriber.offer(message)
+
+    def write(self, result):
+        self.publish(encode_result(result))
+
+    def close(self):
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)  # Wakes up accept()
+        except OSError:
+            pass
+        self.server.close()
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, []
+            STREAM_SUBSCRIBERS.set(0)
+        for subscriber in subscribers:
+            subscriber.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class DetectionSubscriber:
+    """
+    Client side of DetectionPublisher. Every message is received into its own buffer and
+    decoded into views on it, so the arrays stay valid for as long as they are referenced.
+
+        with DetectionSubscriber('/tmp/coopercam.sock') as stream:
+            for s in stream:
+                print(s.cam_id, s.frame_id, s.ids)
+    """
+
+    def __init__(self, path: str):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __iter__(self) -> Iterator[DetectionSet]:
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+            yield message
+
+    def _receive_into(self, view: memoryview) -> bool:
+        while len(view):
+            count = self.sock.recv_into(view)
+            if not count:
+                return False
+            view = view[count:]
+        return True
+
+    def receive(self) -> Optional[DetectionSet]:
+        # Next detection set, None once the publisher closed the stream
+        header = bytearray(HEADER.size)
+        if not self._receive_into(memoryview(header)):
+            return None
+        size = HEADER.unpack_from(header)[-1]
+        if size < HEADER.size:
+            raise ValueError(f'Invalid detection stream message size {size}')
+        message = bytearray(size)
+        message[:HEADER.size] = header
+        if not self._receive_into(memoryview(message)[HEADER.size:]):
+            return None
+        return decode(message)
+
+    def close(self):
+        self.sock.close()
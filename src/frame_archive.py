@@ -0,0 +1,662 @@
+# frame_archive.py
+"""
+Compressed recording of raw frames, the lossless counterpart of FrameRecorder.
+
+    python main.py --record DIR --codec zstd:3 --archive-workers 6
+    python frame_archive.py RECORDING OUT --codecs zlib:1,zstd:3,png:1,ffv1
+
+The camera callback only copies the payload into a free slot, like FrameRecorder does; the
+frames are compressed on a pool of worker threads (zlib, zstd and OpenCV release the GIL)
+and written by this thread in the order they were submitted. The slots bound the memory in
+use: a slot is given back once its frame is written, so at most slot_count raw frames and
+their compressed copies are held at any time, and frames arriving while all slots are busy
+are dropped and counted.
+
+Codecs, selected as 'name' or 'name:level':
+    zlib   payload bytes as they came from the camera, level 1-9 (default 1)
+    zstd   the same with Zstandard, level 1-22 (default 3); needs the zstandard package
+    png    one PNG per frame, 8 or 16 bit, level 0-9 (default 1)
+    ffv1   one FFV1 video per camera and frame size, 8 or 16 bit; needs OpenCV with FFmpeg.
+           A video is encoded frame after frame, so each camera has a single worker of its own.
+Packed Mono10p/Mono12p frames are unpacked for png and ffv1 and packed again when read, so every
+codec gives back the exact payload. The directory holds 'index.bin', 'cameras.json' as written by
+FrameRecorder and 'archive.json' naming the codec; ArchiveReader reads it with random access by
+index or by camera and frame id, and --source replay plays it back. Archiving into an existing
+archive of the same codec continues it, in new data and video files.
+"""
+import json
+import os
+from abc import ABC, abstractmethod
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Union
+import numpy
+import cv2
+from vmbpy import *
+from frame_recorder import INDEX_FLUSH_INTERVAL, SLOT_COUNT, last_segment, read_cameras, resume_index
+from pixel_format import UNPACKERS, pack_mono10p, pack_mono12p
+
+SEGMENT_SIZE = 1024 ** 3  # Compressed data files are started anew beyond this size
+ARCHIVE_FILE = 'archive.json'
+DEFAULT_CODEC = 'zlib:1'
+
+# One fixed size record per archived frame, appended to 'index.bin' in submission order.
+# For ffv1 the segment is the video file and the offset the frame's position in it.
+INDEX_DTYPE = numpy.dtype([
+    ('frame_id', '<u8'),
+    ('device_timestamp', '<u8'),
+    ('host_timestamp', '<u8'),
+    ('camera', '<u2'),
+    ('segment', '<u2'),
+    ('pixel_format', '<u4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('offset', '<u8'),
+    ('size', '<u8'),
+    ('raw_size', '<u8'),
+])
+
+PACKERS = {
+    PixelFormat.Mono10p: pack_mono10p,
+    PixelFormat.Mono12p: pack_mono12p,
+}
+
+
+def payload_image(payload: numpy.ndarray, pixel_format: int, width: int, height: int) -> numpy.ndarray:
+    # 2D uint8 or uint16 image of a mono payload
+    fmt = PixelFormat(pixel_format)
+    unpack = UNPACKERS.get(fmt)
+    if unpack is not None:
+        return unpack(payload, width, height)
+    if payload.size == width * height:
+        return payload.reshape(height, width)
+    if payload.size == 2 * width * height:
+        return payload.view('<u2').reshape(height, width)
+    raise ValueError(f'Cannot store {fmt} frames as images')
+
+
+def image_payload(image: numpy.ndarray, pixel_format: int) -> numpy.ndarray:
+    # Inverse of payload_image
+    pack = PACKERS.get(PixelFormat(pixel_format))
+    if pack is not None:
+        return pack(image)
+    return numpy.ascontiguousarray(image, image.dtype.newbyteorder('<')).view(numpy.uint8).reshape(-1)
+
+
+def segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f'segment-{segment:05d}.bin')
+
+
+def video_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f'video-{segment:05d}.mkv')
+
+
+class Codec(ABC):
+    """
+    Compresses one payload at a time; encode is called from several worker threads at once.
+    """
+    name = ''
+    default_level: Optional[int] = None
+    levels = range(0)
+
+    def __init__(self, level: Optional[int] = None):
+        self.level = self.default_level if level is None else level
+        if self.level is not None and self.level not in self.levels:
+            raise ValueError(f'{self.name} level must be within {self.levels.start}-{self.levels.stop - 1}')
+
+    @property
+    def spec(self) -> str:
+        return self.name if self.level is None else f'{self.name}:{self.level}'
+
+    @abstractmethod
+    def encode(self, payload: numpy.ndarray, pixel_format: int, width: int, height: int) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data, pixel_format: int, width: int, height: int, raw_size: int) -> numpy.ndarray:
+        pass
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    default_level = 1
+    levels = range(1, 10)
+
+    def encode(self, payload, pixel_format, width, height):
+        return zlib.compress(payload, self.level)
+
+    def decode(self, data, pixel_format, width, height, raw_size):
+        return numpy.frombuffer(zlib.decompress(data, bufsize=raw_size), numpy.uint8)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    default_level = 3
+    levels = range(1, 23)
+
+    def __init__(self, level: Optional[int] = None):
+        Codec.__init__(self, level)
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('The zstd codec needs the zstandard package (pip install zstandard)')
+        self.zstandard = zstandard
+        self.local = threading.local()  # Compressor objects must not be shared between threads
+
+    def encode(self, payload, pixel_format, width, height):
+        if not hasattr(self.local, 'compressor'):
+            self.local.compressor = self.zstandard.ZstdCompressor(level=self.level)
+        return self.local.compressor.compress(payload)
+
+    def decode(self, data, pixel_format, width, height, raw_size):
+        decompressor = self.zstandard.ZstdDecompressor()
+        return numpy.frombuffer(decompressor.decompress(data, max_output_size=raw_size), numpy.uint8)
+
+
+class PngCodec(Codec):
+    name = 'png'
+    default_level = 1
+    levels = range(0, 10)
+
+    def encode(self, payload, pixel_format, width, height):
+        image = payload_image(payload, pixel_format, width, height)
+        ok, data = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, self.level])
+        if not ok:
+            raise ValueError('PNG encoding failed')
+        return data
+
+    def decode(self, data, pixel_format, width, height, raw_size):
+        image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_UNCHANGED)
+        return image_payload(image, pixel_format)
+
+
+class VideoCodec(ABC):
+    """
+    Encodes the frames of a camera into video files, in order: each camera has one worker of its own.
+    The archive keeps the position of every frame in its file instead of a payload.
+    """
+    name = ''
+
+    def __init__(self, level: Optional[int] = None):
+        if level is not None:
+            raise ValueError(f'{self.name} has no levels')
+
+    @property
+    def spec(self) -> str:
+        return self.name
+
+    @abstractmethod
+    def open_writer(self, path: str, image: numpy.ndarray) -> cv2.VideoWriter:
+        # Writer for frames of the size and depth of image
+        pass
+
+    @abstractmethod
+    def open_reader(self, path: str) -> cv2.VideoCapture:
+        # Reader giving back the frames exactly as they were written
+        pass
+
+
+class Ffv1Codec(VideoCodec):
+    name = 'ffv1'
+
+    def __init__(self, level: Optional[int] = None):
+        VideoCodec.__init__(self, level)
+        if not cv2.videoio_registry.hasBackend(cv2.CAP_FFMPEG):
+            raise ValueError('The ffv1 codec needs OpenCV built with FFmpeg')
+
+    def open_writer(self, path, image):
+        height, width = image.shape
+        depth = cv2.CV_16U if image.dtype == numpy.uint16 else cv2.CV_8U
+        writer = cv2.VideoWriter(path, cv2.CAP_FFMPEG, cv2.VideoWriter_fourcc(*'FFV1'), 30.0, (width, height),
+                                 [cv2.VIDEOWRITER_PROP_DEPTH, depth, cv2.VIDEOWRITER_PROP_IS_COLOR, 0])
+        if not writer.isOpened():
+            raise ValueError(f'Cannot open an FFV1 writer for {path}')
+        return writer
+
+    def open_reader(self, path):
+        # Without RGB conversion the 8 or 16 bit gray frames come back unchanged
+        capture = cv2.VideoCapture(path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_CONVERT_RGB, 0])
+        if not capture.isOpened():
+            raise IOError(f'Cannot open {path}')
+        return capture
+
+
+CODECS = {codec.name: codec for codec in (ZlibCodec, ZstdCodec, PngCodec, Ffv1Codec)}
+
+
+def create_codec(spec: str) -> Union[Codec, VideoCodec]:
+    # 'zlib', 'zlib:6', 'png:1', ...
+    name, _, level = spec.partition(':')
+    if name not in CODECS:
+        raise ValueError(f'Unknown codec \'{name}\', choose from {", ".join(CODECS)}')
+    return CODECS[name](int(level) if level else None)
+
+
+class VideoStream:
+    # The open FFV1 file of one camera, used by that camera's worker only
+    def __init__(self, segment: int, writer: cv2.VideoWriter, shape: tuple, dtype):
+        self.segment = segment
+        self.writer = writer
+        self.shape = shape
+        self.dtype = dtype
+        self.count = 0
+
+
+class FrameArchive(threading.Thread):
+    """
+    Compress raw frame payloads on a worker pool and write them in submission order.
+    Takes the place of FrameRecorder: submit() is called from the camera callback and never
+    blocks; if no slot is free the frame is dropped and counted.
+    An existing archive in the directory is continued if it has the same codec.
+    """
+
+    def __init__(self, directory: str, codec: str = DEFAULT_CODEC, workers: Optional[int] = None,
+                 slot_count: int = SLOT_COUNT, segment_size: int = SEGMENT_SIZE):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.log = Log.get_instance()
+        self.directory = directory
+        self.codec = create_codec(codec)
+        self.workers = workers or os.cpu_count() or 1
+        self.slot_count = slot_count
+        self.segment_size = segment_size
+
+        self.write_queue = queue.Queue()
+        self.free_slots = queue.Queue()
+        self.slots_allocated = 0
+        self.slots_lock = threading.Lock()
+
+        self.video = isinstance(self.codec, VideoCodec)
+        if self.video:
+            self.pool = None
+            self.camera_pools: Dict[str, ThreadPoolExecutor] = {}
+        else:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='Archive')
+        self.videos: Dict[str, VideoStream] = {}
+        self.video_segments = []  # Paths of the video files of this run
+        self.video_lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        archive_path = os.path.join(directory, ARCHIVE_FILE)
+        if os.path.exists(archive_path):
+            with open(archive_path) as f:
+                spec = json.load(f)['codec']
+            if spec.partition(':')[0] != self.codec.name:
+                raise ValueError(f'{directory} is archived with {spec}, archive {self.codec.spec} elsewhere')
+        elif os.path.exists(os.path.join(directory, 'index.bin')):
+            raise ValueError(f'{directory} holds a raw FrameRecorder recording, archive elsewhere')
+        self.cameras = resume_index(directory, INDEX_DTYPE)
+        self.camera_index = {cam_id: i for i, cam_id in enumerate(self.cameras)}
+
+        # Continue after the files of an earlier run instead of overwriting them
+        self.segment = last_segment(directory, 'segment-*.bin')
+        self.first_video_segment = last_segment(directory, 'video-*.mkv') + 1
+        self.segment_file = None
+        self.write_offset = 0
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+        self.stats_lock = threading.Lock()
+        self.max_queue_depth = 0
+        self.start_time = None
+
+        if not os.path.exists(archive_path):
+            with open(archive_path, 'w') as f:
+                json.dump({'codec': self.codec.spec}, f)
+        self.index_file = open(os.path.join(directory, 'index.bin'), 'ab')
+
+    def _get_slot(self, size: int, block: bool = False) -> Optional[numpy.ndarray]:
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            with self.slots_lock:
+                full = self.slots_allocated >= self.slot_count
+                if not full:
+                    self.slots_allocated += 1
+            if full and not block:
+                return None
+            slot = self.free_slots.get() if full else numpy.empty(size, numpy.uint8)
+
+        if slot.size < size:
+            slot = numpy.empty(size, numpy.uint8)
+        return slot
+
+    def submit(self, cam_id: str, frame: Frame) -> bool:
+        # Called from the camera callback. Never blocks: drops the frame if compression is behind.
+        return self.submit_payload(cam_id, numpy.frombuffer(frame.get_buffer(), numpy.uint8), frame.get_id(),
+                                   frame.get_timestamp() or 0, int(frame.get_pixel_format()),
+                                   frame.get_width(), frame.get_height())
+
+    def submit_payload(self, cam_id: str, payload: numpy.ndarray, frame_id: int, device_ts: int,
+                       pixel_format: int, width: int, height: int, host_ts: Optional[int] = None,
+                       block: bool = False) -> bool:
+        # With block=True waits for a free slot instead of dropping, for archiving files
+        slot = self._get_slot(payload.size, block)
+        # Runs on the callback thread of every camera
+        with self.stats_lock:
+            self.submitted += 1
+            if slot is None:
+                self.dropped += 1
+        if slot is None:
+            return False
+
+        numpy.copyto(slot[:payload.size], payload)
+        data = slot[:payload.size]
+        if self.video:
+            if cam_id not in self.camera_pools:
+                self.camera_pools[cam_id] = ThreadPoolExecutor(1, thread_name_prefix=f'Archive({cam_id})')
+            future = self.camera_pools[cam_id].submit(self._encode_video, cam_id, data, pixel_format, width, height)
+        else:
+            future = self.pool.submit(self._encode, data, pixel_format, width, height)
+        self.write_queue.put((cam_id, frame_id, device_ts, host_ts if host_ts is not None else time.time_ns(),
+                              pixel_format, width, height, payload.size, slot, future))
+        with self.stats_lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.write_queue.qsize())
+        return True
+
+    def _encode(self, payload: numpy.ndarray, pixel_format: int, width: int, height: int) -> bytes:
+        t0 = time.perf_counter()
+        data = self.codec.encode(payload, pixel_format, width, height)
+        with self.stats_lock:
+            self.encode_seconds += time.perf_counter() - t0
+        return data
+
+    def _encode_video(self, cam_id: str, payload: numpy.ndarray, pixel_format: int, width: int, height: int):
+        # Runs on the camera's own worker; returns (segment, position) of the frame
+        t0 = time.perf_counter()
+        image = payload_image(payload, pixel_format, width, height)
+        stream = self.videos.get(cam_id)
+        if stream is None or stream.shape != image.shape or stream.dtype != image.dtype:
+            # A new file whenever the frame size or bit depth changes
+            if stream is not None:
+                stream.writer.release()
+            with self.video_lock:
+                segment = self.first_video_segment + len(self.video_segments)
+                self.video_segments.append(video_path(self.directory, segment))
+            writer = self.codec.open_writer(video_path(self.directory, segment), image)
+            stream = self.videos[cam_id] = VideoStream(segment, writer, image.shape, image.dtype)
+        stream.writer.write(image)
+        stream.count += 1
+        with self.stats_lock:
+            self.encode_seconds += time.perf_counter() - t0
+        return stream.segment, stream.count - 1
+
+    def stop(self):
+        self.write_queue.put(None)
+
+    def video_bytes(self) -> int:
+        with self.video_lock:
+            paths = list(self.video_segments)
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def stats(self) -> dict:
+        compressed = self.video_bytes() if self.video else self.bytes_written
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        return {
+            'codec': self.codec.spec,
+            'submitted': self.submitted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'bytes_in': self.bytes_in,
+            'bytes_written': compressed,
+            'ratio': self.bytes_in / compressed if compressed else 0.0,
+            # Raw megabytes per second of worker time, and per second of wall time
+            'encode_mb_per_sec': self.bytes_in / 1e6 / self.encode_seconds if self.encode_seconds else 0.0,
+            'mb_per_sec': self.bytes_in / 1e6 / elapsed if elapsed else 0.0,
+            'queue_depth': self.write_queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'slots_free': self.free_slots.qsize(),
+            'slots_allocated': self.slots_allocated,
+        }
+
+    def _open_segment(self):
+        self._close_segment()
+        self.segment += 1
+        self.segment_file = open(segment_path(self.directory, self.segment), 'wb')
+        self.write_offset = 0
+
+    def _close_segment(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
+
+    def _camera(self, cam_id: str) -> int:
+        if cam_id not in self.camera_index:
+            self.camera_index[cam_id] = len(self.cameras)
+            self.cameras.append(cam_id)
+            with open(os.path.join(self.directory, 'cameras.json'), 'w') as f:
+                json.dump(self.cameras, f)
+        return self.camera_index[cam_id]
+
+    def _write(self, item, record: numpy.ndarray):
+        cam_id, frame_id, device_ts, host_ts, pixel_format, width, height, raw_size, slot, future = item
+        try:
+            result = future.result()
+        except Exception as e:
+            self.failed += 1
+            self.log.error(f'Archiving frame {frame_id} of camera \'{cam_id}\' failed: {e}')
+            return
+        finally:
+            self.free_slots.put(slot)
+
+        if self.video:
+            (segment, offset), size = result, 0
+        else:
+            if self.segment_file is None or self.write_offset + len(result) > self.segment_size:
+                self._open_segment()
+            segment, offset, size = self.segment, self.write_offset, len(result)
+            self.segment_file.write(result)
+            self.write_offset += size
+
+        record[0] = (frame_id, device_ts, host_ts, self._camera(cam_id), segment,
+                     pixel_format, width, height, offset, size, raw_size)
+        self.index_file.write(record.tobytes())
+
+        self.written += 1
+        self.bytes_in += raw_size
+        self.bytes_written += size
+
+    def _shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        else:
+            for pool in self.camera_pools.values():
+                pool.shutdown()
+            for stream in self.videos.values():
+                stream.writer.release()
+        self._close_segment()
+        self.index_file.close()
+
+    def run(self):
+        self.log.info(f"Thread 'FrameArchive({self.directory}, {self.codec.spec})' started.")
+        self.start_time = time.perf_counter()
+        record = numpy.zeros(1, INDEX_DTYPE)
+        last_flush = time.time()
+        try:
+            while True:
+                try:
+                    item = self.write_queue.get(timeout=INDEX_FLUSH_INTERVAL)
+                except queue.Empty:
+                    item = False
+
+                if item is None:
+                    break
+                if item:
+                    self._write(item, record)
+
+                if time.time() - last_flush >= INDEX_FLUSH_INTERVAL:
+                    if self.segment_file is not None:
+                        self.segment_file.flush()
+                    self.index_file.flush()
+                    last_flush = time.time()
+        finally:
+            self._shutdown()
+
+        self.log.info(f"Thread 'FrameArchive({self.directory}, {self.codec.spec})' terminated. {self.stats()}")
+
+
+def is_archive(directory: str) -> bool:
+    return os.path.exists(os.path.join(directory, ARCHIVE_FILE))
+
+
+class ArchiveReader:
+    """
+    Random access to a directory written by FrameArchive, with the interface of RecordingReader:
+    payload(i) gives back the exact payload the camera delivered.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index = numpy.fromfile(os.path.join(directory, 'index.bin'), dtype=INDEX_DTYPE)
+        self.cameras = read_cameras(directory)
+        with open(os.path.join(directory, ARCHIVE_FILE)) as f:
+            self.codec = create_codec(json.load(f)['codec'])
+        self.files = {}
+        self.captures = {}  # segment: [VideoCapture, position of the next frame it reads]
+
+        # Per camera, the frame ids in ascending order and their index positions
+        self.frame_ids = {}
+        for camera, cam_id in enumerate(self.cameras):
+            records = numpy.flatnonzero(self.index['camera'] == camera)
+            order = numpy.argsort(self.index['frame_id'][records], kind='stable')
+            self.frame_ids[cam_id] = (self.index['frame_id'][records][order], records[order])
+
+    def __len__(self):
+        return len(self.index)
+
+    def camera(self, i: int) -> str:
+        return self.cameras[int(self.index[i]['camera'])]
+
+    def find(self, cam_id: str, frame_id: int) -> int:
+        # Index position of a frame; the last one archived if the camera restarted its frame ids
+        ids, records = self.frame_ids[cam_id]
+        i = numpy.searchsorted(ids, frame_id, side='right') - 1
+        if i < 0 or ids[i] != frame_id:
+            raise KeyError(f'Frame {frame_id} of camera \'{cam_id}\' is not in the archive')
+        return int(records[i])
+
+    def _data(self, segment: int, offset: int, size: int) -> bytes:
+        if segment not in self.files:
+            self.files[segment] = open(segment_path(self.directory, segment), 'rb')
+        f = self.files[segment]
+        f.seek(offset)
+        return f.read(size)
+
+    def _video_frame(self, segment: int, position: int) -> numpy.ndarray:
+        if segment not in self.captures:
+            self.captures[segment] = [self.codec.open_reader(video_path(self.directory, segment)), 0]
+        capture, next_position = self.captures[segment]
+        # FFV1 has only key frames, so seeking is exact; reading in order needs no seek
+        if position != next_position:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, position)
+        ok, image = capture.read()
+        if not ok:
+            raise IOError(f'Cannot read frame {position} of {video_path(self.directory, segment)}')
+        self.captures[segment][1] = position + 1
+        return image
+
+    def payload(self, i: int) -> numpy.ndarray:
+        record = self.index[i]
+        pixel_format, width, height = int(record['pixel_format']), int(record['width']), int(record['height'])
+        if isinstance(self.codec, VideoCodec):
+            image = self._video_frame(int(record['segment']), int(record['offset']))
+            return image_payload(image.reshape(height, width), pixel_format)
+        data = self._data(int(record['segment']), int(record['offset']), int(record['size']))
+        return self.codec.decode(data, pixel_format, width, height, int(record['raw_size']))
+
+    def frame(self, cam_id: str, frame_id: int) -> numpy.ndarray:
+        return self.payload(self.find(cam_id, frame_id))
+
+    def image(self, i: int) -> numpy.ndarray:
+        record = self.index[i]
+        return payload_image(self.payload(i), int(record['pixel_format']), int(record['width']),
+                             int(record['height']))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        for capture, _ in self.captures.values():
+            capture.release()
+        self.files.clear()
+        self.captures.clear()
+
+
+def open_recording(directory: str):
+    # Reader for a FrameRecorder or FrameArchive directory
+    if is_archive(directory):
+        return ArchiveReader(directory)
+    from frame_recorder import RecordingReader
+    return RecordingReader(directory)
+
+
+def compare(recording: str, output: str, codecs: list, workers: Optional[int] = None,
+            frames: Optional[int] = None, verify: bool = False) -> list:
+    """
+    Archive the frames of a recording with every codec and report ratio and throughput.
+    Frames are submitted as fast as the archive takes them, waiting for free slots instead
+    of dropping, so the throughput is what the workers sustain.
+    :param verify: read every frame back and compare it with the original payload
+    """
+    reader = open_recording(recording)
+    count = min(len(reader), frames) if frames else len(reader)
+    results = []
+    for spec in codecs:
+        directory = os.path.join(output, spec.replace(':', '-'))
+        archive = FrameArchive(directory, spec, workers)
+        archive.start()
+        for i in range(count):
+            record = reader.index[i]
+            # No reference to the payload outlives the loop, a RecordingReader cannot close while views exist
+            archive.submit_payload(reader.camera(i), reader.payload(i), int(record['frame_id']),
+                                   int(record['device_timestamp']),
+                                   int(record['pixel_format']), int(record['width']), int(record['height']),
+                                   int(record['host_timestamp']), block=True)
+        archive.stop()
+        archive.join()
+        stats = archive.stats()
+        workers = len(archive.camera_pools) if archive.video else archive.workers
+
+        if verify:
+            archived = ArchiveReader(directory)
+            stats['verified'] = all(numpy.array_equal(archived.payload(i), reader.payload(i)) for i in range(count))
+            archived.close()
+        results.append(stats)
+        text = (f'[ARCHIVE] {spec:8s} {stats["written"]} frames, ratio {stats["ratio"]:.2f}, '
+                f'{stats["mb_per_sec"]:.0f} MB/s with {workers} workers, '
+                f'{stats["encode_mb_per_sec"]:.0f} MB/s per worker')
+        if verify:
+            text += ', lossless' if stats['verified'] else ', MISMATCH'
+        print(text, flush=True)
+    reader.close()
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare archive codecs on a recording.')
+    parser.add_argument('recording', help='FrameRecorder or FrameArchive directory')
+    parser.add_argument('output', help='directory for one archive per codec')
+    parser.add_argument('--codecs', default='zlib:1,zstd:3,png:1,ffv1',
+                        help='comma separated codecs, name or name:level (default: zlib:1,zstd:3,png:1,ffv1)')
+    parser.add_argument('--workers', type=int, help='compression threads (default: one per core)')
+    parser.add_argument('--frames', type=int, help='archive only the first FRAMES frames')
+    parser.add_argument('--verify', action='store_true', help='read every frame back and compare it')
+    args = parser.parse_args()
+    Log.get_instance().enable(LOG_CONFIG_WARNING_CONSOLE_ONLY)
+    available = []
+    for spec in args.codecs.split(','):
+        try:
+            create_codec(spec)
+            available.append(spec)
+        except ValueError as e:
+            print(f'[ARCHIVE] {spec:8s} skipped: {e}')
+    compare(args.recording, args.output, available, args.workers, args.frames, args.verify)
@@ -1,19 +1,21 @@
 import queue
+import signal
 import time
 import numpy
 import cv2
 import threading
+from typing import Optional
 from vmbpy import *  # Or import only the necessary modules for your class
-import sys
-import os
-script_dir = os.path.dirname(os.path.realpath(__file__))
-relative_path = os.path.join(script_dir, '..')
-normalized_path = os.path.abspath(relative_path) 
-sys.path.append(normalized_path)
+from aprilgrid.quality import SKIP
+from frame_trace import LatencyTracker
+from pixel_format import UNPACKERS, frame_bit_depth, frame_to_image
+from preview_compositor import PreviewCompositor
+from metrics import REGISTRY
 
-from aprilgrid import Detector
-# Initialize the detector
-detector = Detector('t16h5b1')
+DISPLAY_FPS = REGISTRY.gauge('coopercam_display_fps', 'Preview frames shown per second')
+DISPLAY_RATE = 30.0  # Preview refresh rate, independent of the capture rate
+OVERLAY_TIMEOUT = 0.5  # Detections older than this are no longer drawn
+OVERLAY_COLOR = (0, 255, 0)
 
 def create_dummy_frame() -> numpy.ndarray:
     cv_frame = numpy.zeros((50, 640, 1), numpy.uint8)
@@ -25,72 +27,206 @@ def create_dummy_frame() -> numpy.ndarray:
     return cv_frame
 
 class FrameConsumer:
-    def __init__(self, frame_queue: queue.Queue):
+    def __init__(self, frame_queue: queue.Queue, tracker: Optional[LatencyTracker] = None,
+                 display_rate: float = DISPLAY_RATE, detection_workers=None, window: bool = True):
         self.log = Log.get_instance()
         self.frame_queue = frame_queue
+        self.tracker = tracker
+        # Optional DetectionWorkers fed with frames the workers have room for; never waited on
+        self.detection_workers = detection_workers
+        self.detections = {}  # Newest (DetectionResult, arrival time) per camera
+        self.detections_lock = threading.Lock()
+        self.overlay_version = 0
+        if not display_rate > 0:
+            raise ValueError(f'display_rate must be greater than 0, not {display_rate}')
+        self.display_interval = 1.0 / display_rate
+        self.frames = {}  # Newest frame per camera that was not drawn yet
+        self.traces = {}  # Traces of dequeued frames that were not shown yet
+        self.shown_version = None  # (compositor, overlay) version on screen, -1 for the dummy image
+        self.report_interval = 5.0
+        self.compositor = PreviewCompositor()
+        # Without a window the preview is only kept up to date while a preview server has clients
+        self.window = window
+        self.preview_server = None  # MjpegServer streaming the compositor, stopped with the consumer
+        self.killswitch = threading.Event()
+        self.unpack_buffers = {}
         self.last_time = time.time()
         self.frame_count = 0
         self.frame_accumulated = 0  # To accumulate frame count for averaging
 
+    def unpack_buffer(self, cam_id: str, frame: Frame) -> Optional[numpy.ndarray]:
+        # Packed frames are unpacked into a buffer that is reused for every frame of the camera
+        if frame.get_pixel_format() not in UNPACKERS:
+            return None
+        shape = (frame.get_height(), frame.get_width())
+        buffer = self.unpack_buffers.get(cam_id)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.unpack_buffers[cam_id] = numpy.empty(shape, numpy.uint16)
+        return buffer
+
+    def update_detections(self, result):
+        # Called from detector threads with a DetectionResult
+        if result.gate == SKIP:
+            # A blurred frame says nothing about the tags: keep the last overlay until it times out
+            return
+        with self.detections_lock:
+            self.detections[result.cam_id] = (result, time.time())
+            self.overlay_version += 1
+
+    def handle(self, cam_id: str, frame: Optional[Frame], trace):
+        # Add/Remove frame from current state.
+        if frame:
+            self.frames[cam_id] = frame
+            if trace is not None:
+                trace.mark('dequeue')
+                self.traces[cam_id] = trace
+            if self.detection_workers is not None:
+                accepted = self.detection_workers.submit(cam_id, frame, trace, self.update_detections, block=False)
+                if accepted and trace is not None:
+                    # The detection worker finishes the trace of a frame it took
+                    self.traces.pop(cam_id, None)
+
+        else:
+            self.frames.pop(cam_id, None)
+            self.traces.pop(cam_id, None)
+            self.compositor.remove_camera(cam_id)
+            self.unpack_buffers.pop(cam_id, None)
+            with self.detections_lock:
+                self.detections.pop(cam_id, None)
+            if self.detection_workers is not None:
+                self.detection_workers.reset(cam_id)
+
+    def current_detections(self) -> list:
+        now = time.time()
+        with self.detections_lock:
+            for cam_id in [c for c, (_, t) in self.detections.items() if now - t > OVERLAY_TIMEOUT]:
+                del self.detections[cam_id]
+                self.overlay_version += 1
+            return [result for result, _ in self.detections.values()]
+
+    def draw_overlay(self, canvas: numpy.ndarray, results: list) -> numpy.ndarray:
+        # Tag outlines and ids are drawn on a color copy of the small canvas, never on full frames
+        image = cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR)
+        for result in results:
+            rect = self.compositor.slot_rect(result.cam_id)
+            if rect is None or not result.detections:
+                continue
+            x, y, w, h = rect
+            scale = numpy.array([w / result.shape[1], h / result.shape[0]], numpy.float32)
+            offset = numpy.array([x, y], numpy.float32)
+            for detection in result.detections:
+                corners = numpy.asarray(detection.corners, numpy.float32).reshape(-1, 2) * scale + offset
+                points = corners.round().astype(numpy.int32)
+                cv2.polylines(image, [points], True, OVERLAY_COLOR, 1, cv2.LINE_AA)
+                cv2.circle(image, tuple(int(v) for v in points[0]), 2, OVERLAY_COLOR, -1)
+                center = tuple(int(v) for v in corners.mean(axis=0))
+                cv2.putText(image, str(detection.tag_id), center, cv2.FONT_HERSHEY_SIMPLEX, 0.4, OVERLAY_COLOR, 1)
+        return image
+
+    def wait_for_frames(self, deadline: float):
+        # Sleep until a frame arrives or the deadline passes, then take everything that is queued.
+        timeout = deadline - time.perf_counter()
+        try:
+            if timeout > 0:
+                self.handle(*self.frame_queue.get(timeout=timeout))
+            while True:
+                self.handle(*self.frame_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+    def stop(self):
+        self.killswitch.set()
+
+    def render(self, caption: str) -> bool:
+        # Draw only the cameras that delivered a new frame since the last render.
+        drawn = self.window or (self.preview_server is not None and self.preview_server.watched())
+        if not drawn:
+            # Nobody looks: only keep the camera list, so clients can pick a camera
+            for cam_id in self.frames:
+                self.compositor.add_camera(cam_id)
+            self.frames.clear()
+        for cam_id, frame in self.frames.items():
+            image = frame_to_image(frame, self.unpack_buffer(cam_id, frame))
+            self.compositor.update(cam_id, image, frame_bit_depth(frame))
+        self.frames.clear()
+
+        results = self.current_detections() if self.detection_workers is not None else []
+        version = (self.compositor.version, self.overlay_version) if len(self.compositor) else -1
+        changed = version != self.shown_version
+        if changed and not self.window:
+            self.shown_version = version
+        elif changed:
+            if len(self.compositor) and results:
+                cv2.imshow(caption, self.draw_overlay(self.compositor.canvas, results))
+            elif len(self.compositor):
+                cv2.imshow(caption, self.compositor.canvas)
+            # If there are no frames available, show dummy image instead
+            else:
+                cv2.imshow(caption, create_dummy_frame())
+            self.shown_version = version
+
+        if self.tracker is not None:
+            # Frames nobody looked at are finished without a 'display' checkpoint
+            for trace in self.traces.values():
+                if drawn:
+                    trace.mark('display')
+                self.tracker.finish(trace)
+        self.traces.clear()
+        return changed
+
     def run(self):
         IMAGE_CAPTION = 'Downscaled Preview: Press <Enter> to exit'
         KEY_CODE_ENTER = 13
 
-        frames = {}
+        last_report = time.time()
+        next_render = time.perf_counter()
         alive = True
 
         self.log.info('\'FrameConsumer\' started.')
+        if not self.window and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, stack: self.stop())
 
-        while alive:
-            # Update current state by dequeuing all currently available frames.
-            frames_left = self.frame_queue.qsize()
-            while frames_left:
-                try:
-                    cam_id, frame = self.frame_queue.get_nowait()
-
-                except queue.Empty:
-                    break
-
-                # Add/Remove frame from current state.
-                if frame:
-                    frames[cam_id] = frame
+        while alive and not self.killswitch.is_set():
+            self.wait_for_frames(next_render)
+            now = time.perf_counter()
+            if now < next_render:
+                continue
 
-                else:
-                    frames.pop(cam_id, None)
+            # Display tick. Skip ticks that were missed instead of rendering them back to back.
+            next_render += self.display_interval
+            if next_render < now:
+                next_render = now + self.display_interval
 
-                frames_left -= 1
+            rendered = self.render(IMAGE_CAPTION)
 
-            # Construct image by stitching frames together.
-            if frames:
-                cv_images = [frames[cam_id].as_opencv_image() for cam_id in sorted(frames.keys())]
-                
-                newimg = []
-                for img in cv_images:
-                   resized_img = cv2.resize(img, (1006, 759))
-                   newimg.append(resized_img)
+            if self.tracker is not None and time.time() - last_report >= self.report_interval:
+                self.tracker.report()
+                last_report = time.time()
 
-                cv2.imshow(IMAGE_CAPTION, numpy.concatenate(newimg, axis=1))
-            # If there are no frames available, show dummy image instead
-            else:
-                cv2.imshow(IMAGE_CAPTION, create_dummy_frame())
-
-            self.frame_count += 1
-            self.frame_accumulated += 1  # Increment the accumulated frame count
+            if rendered:
+                self.frame_count += 1
+                self.frame_accumulated += 1  # Increment the accumulated frame count
             current_time = time.time()
             elapsed = current_time - self.last_time
 
             if self.frame_accumulated >= 70:  # Check if we have processed 70 frames
                 avg_fps = self.frame_count / elapsed  # Calculate the FPS for the last 70 frames
                 print(f"[DISPLAY FPS (avg over 70 frames)] {avg_fps:.2f} frames/sec")
+                DISPLAY_FPS.set(avg_fps)
                 
                 # Reset the counters
                 self.frame_count = 0
                 self.frame_accumulated = 0  # Reset accumulated frame count
                 self.last_time = current_time  # Reset the time for the next set of 70 frames
 
-            # Check for shutdown condition
-            if KEY_CODE_ENTER == cv2.waitKey(10):
+            # The GUI is serviced once per display tick. Check for shutdown condition
+            if self.window and KEY_CODE_ENTER == cv2.waitKey(1):
                 cv2.destroyAllWindows()
                 alive = False
 
+        if self.detection_workers is not None:
+            self.detection_workers.shutdown()
+        if self.preview_server is not None:
+            self.preview_server.stop()
+
         self.log.info('\'FrameConsumer\' terminated.')
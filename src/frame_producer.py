@@ -5,76 +5,121 @@ import threading
 import time
 from typing import Optional
 from vmbpy import *  # Ensure the necessary VmbPy imports are here
+from camera_profile import CameraProfile, CameraProfileError, apply_profile
+from frame_trace import FrameTrace
+from metrics import REGISTRY
+from scheduling import CAPTURE
 
-def try_put_frame(q: queue.Queue, cam: Camera, frame: Optional[Frame]):
+TEMPERATURE_POLL_INTERVAL = 10.0
+
+FRAMES_CAPTURED = REGISTRY.counter('coopercam_frames_captured_total', 'Complete frames received', ('camera',))
+FRAMES_INCOMPLETE = REGISTRY.counter('coopercam_frames_incomplete_total',
+                                     'Frames received with a status other than Complete', ('camera', 'status'))
+FRAMES_DROPPED = REGISTRY.counter('coopercam_frames_dropped_total',
+                                  'Frames dropped before reaching the next stage', ('camera', 'stage'))
+CAPTURE_FPS = REGISTRY.gauge('coopercam_capture_fps', 'Complete frames per second', ('camera',))
+DEVICE_TEMPERATURE = REGISTRY.gauge('coopercam_device_temperature_celsius', 'DeviceTemperature', ('camera',))
+
+def try_put_frame(q: queue.Queue, cam: Camera, frame: Optional[Frame], trace: Optional[FrameTrace] = None) -> bool:
     try:
-        q.put_nowait((cam.get_id(), frame))
+        if trace is not None:
+            trace.mark('enqueue')
+        q.put_nowait((cam.get_id(), frame, trace))
+        return True
     except queue.Full:
-        pass
+        return False
 
 class FrameProducer(threading.Thread):
-    def __init__(self, cam: Camera, frame_queue: queue.Queue):
+    def __init__(self, cam: Camera, frame_queue: queue.Queue, recorder=None,
+                 profile: Optional[CameraProfile] = None, scheduling=None):
         threading.Thread.__init__(self)
 
         self.log = Log.get_instance()
         self.cam = cam
         self.frame_queue = frame_queue
+        self.recorder = recorder
+        self.profile = profile if profile is not None else CameraProfile()
+        self.scheduling = scheduling  # SchedulingPlan applied to this thread and the camera threads it starts
         self.killswitch = threading.Event()
+        self.streaming = threading.Event()  # Set once the camera streams
         
         self.last_time = time.time()
         self.frame_count = 0
 
+        cam_id = cam.get_id()
+        self.frames_captured = FRAMES_CAPTURED.labels(cam_id)
+        self.frames_dropped = FRAMES_DROPPED.labels(cam_id, 'queue')
+        self.capture_fps = CAPTURE_FPS.labels(cam_id)
+
     def __call__(self, cam: Camera, stream: Stream, frame: Frame):
-        if frame.get_status() == FrameStatus.Complete:
+        status = frame.get_status()
+        if status == FrameStatus.Complete:
+            trace = FrameTrace(cam.get_id(), frame.get_id(), frame.get_timestamp())
+            self.frames_captured.inc()
+            if self.recorder is not None:
+                self.recorder.submit(cam.get_id(), frame)
 
             if not self.frame_queue.full():
                 frame_cpy = copy.deepcopy(frame)
-                try_put_frame(self.frame_queue, cam, frame_cpy)
+                if not try_put_frame(self.frame_queue, cam, frame_cpy, trace):
+                    self.frames_dropped.inc()
+            else:
+                self.frames_dropped.inc()
             
             self.frame_count += 1
             current_time = time.time()
             elapsed = current_time - self.last_time
 
             if elapsed >= 1.0:
-                print(f"[CAPTURE FPS] {self.frame_count:.2f} frames/sec")
+                fps = self.frame_count / elapsed
+                self.capture_fps.set(fps)
+                self.log.debug(f"Camera '{cam.get_id()}' capturing {fps:.2f} frames/sec.")
                 self.frame_count = 0
                 self.last_time = current_time
+        else:
+            FRAMES_INCOMPLETE.labels(cam.get_id(), str(status)).inc()
 
         cam.queue_frame(frame)
 
+    def poll_temperature(self):
+        try:
+            DEVICE_TEMPERATURE.labels(self.cam.get_id()).set(self.cam.DeviceTemperature.get())
+        except (AttributeError, VmbFeatureError):
+            pass
+
     def stop(self):
         self.killswitch.set()
 
-    def setup_camera(self):
+    def setup_camera(self) -> bool:
+        # Streaming with settings other than the profile's would record unknown data, so a
+        # camera that cannot be configured is not started; the lifecycle retries it with backoff
         try:
-            self.cam.ExposureAuto.set('Off')
-            self.cam.ExposureTime.set(10000) 
-            self.cam.Gain.set(20)
-            self.cam.AcquisitionFrameRateEnable.set(True)
-            self.cam.AcquisitionFrameRate.set(35.04)
-            self.cam.AcquisitionFrameRateMode.set('Basic')
-            self.cam.BinningVertical.set(1)
-            self.cam.BinningHorizontal.set(1)
-            self.cam.set_pixel_format(PixelFormat.Mono8)
-        except (AttributeError, VmbFeatureError):
-            print("Error configuring camera!")
-            pass
+            apply_profile(self.cam, self.profile)
+            return True
+        except CameraProfileError as e:
+            self.log.error(f"Camera '{self.cam.get_id()}' not started, configuring it failed: {e}")
+            return False
 
     def run(self):
         self.log.info(f"Thread 'FrameProducer({self.cam.get_id()})' started.")
+        if self.scheduling is not None:
+            self.scheduling.apply(CAPTURE)
         try:
             with self.cam:
-                self.setup_camera()
+                if self.setup_camera():
+                    try:
+                        self.cam.start_streaming(self)
+                        self.streaming.set()
+                        # Poll slow-changing camera state while streaming
+                        self.poll_temperature()
+                        while not self.killswitch.wait(TEMPERATURE_POLL_INTERVAL):
+                            self.poll_temperature()
 
-                try:
-                    self.cam.start_streaming(self)
-                    self.killswitch.wait()
+                    finally:
+                        self.cam.stop_streaming()
 
-                finally:
-                    self.cam.stop_streaming()
-
-        except VmbCameraError:
-            pass
+        except VmbCameraError as e:
+            self.log.error(f"Camera '{self.cam.get_id()}' failed: {e}")
 
         finally:
             try_put_frame(self.frame_queue, self.cam, None)
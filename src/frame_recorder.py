@@ -0,0 +1,272 @@
+# frame_recorder.py
+import glob
+import json
+import mmap
+import os
+import queue
+import threading
+import time
+from typing import Optional
+import numpy
+from vmbpy import *
+
+SEGMENT_SIZE = 4 * 1024 ** 3  # Preallocated size of every segment file
+SLOT_COUNT = 16  # Frames that may be in flight between the camera callback and the writer
+INDEX_FLUSH_INTERVAL = 1.0
+
+# One fixed size record per recorded frame, appended to 'index.bin'
+INDEX_DTYPE = numpy.dtype([
+    ('frame_id', '<u8'),
+    ('device_timestamp', '<u8'),
+    ('host_timestamp', '<u8'),
+    ('camera', '<u2'),
+    ('segment', '<u2'),
+    ('pixel_format', '<u4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('offset', '<u8'),
+    ('size', '<u8'),
+])
+
+
+def segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f'segment-{segment:05d}.raw')
+
+
+def read_index(directory: str) -> numpy.ndarray:
+    return numpy.fromfile(os.path.join(directory, 'index.bin'), dtype=INDEX_DTYPE)
+
+
+def read_cameras(directory: str) -> list:
+    with open(os.path.join(directory, 'cameras.json')) as f:
+        return json.load(f)
+
+
+def last_segment(directory: str, pattern: str = 'segment-*.raw') -> int:
+    # Highest segment number of the files in directory, -1 if there are none
+    numbers = [int(os.path.basename(path).split('-')[1].split('.')[0])
+               for path in glob.glob(os.path.join(directory, pattern))]
+    return max(numbers, default=-1)
+
+
+def resume_index(directory: str, dtype: numpy.dtype) -> list:
+    """
+    Prepare appending to the index of an existing recording: a record cut short by a crash
+    is removed, and the camera list is checked against the records.
+    :return: the recorded camera ids, empty for a new recording
+    """
+    path = os.path.join(directory, 'index.bin')
+    if not os.path.exists(path):
+        return []
+    size = os.path.getsize(path)
+    if size % dtype.itemsize:
+        with open(path, 'r+b') as f:
+            f.truncate(size - size % dtype.itemsize)
+    index = numpy.fromfile(path, dtype=dtype)
+    cameras = read_cameras(directory) if os.path.exists(os.path.join(directory, 'cameras.json')) else []
+    if len(index) and int(index['camera'].max()) >= len(cameras):
+        raise ValueError(f'Recording {directory} is inconsistent: cameras.json misses cameras of index.bin')
+    return cameras
+
+
+class FrameRecorder(threading.Thread):
+    """
+    Append raw frame payloads to preallocated, memory-mapped segment files.
+    The camera callback only copies the payload into a free slot; all file work is
+    done by this thread. If no slot is free the frame is dropped and counted.
+    An existing recording in the directory is continued: new frames go to new segments
+    and their records are appended to the index.
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE, slot_count: int = SLOT_COUNT):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.log = Log.get_instance()
+        self.directory = directory
+        self.segment_size = segment_size
+        self.slot_count = slot_count
+
+        self.write_queue = queue.Queue()
+        self.free_slots = queue.Queue()
+        self.slots_allocated = 0
+        self.slots_lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, 'archive.json')):
+            raise ValueError(f'{directory} holds a compressed FrameArchive, record raw frames elsewhere')
+        self.cameras = resume_index(directory, INDEX_DTYPE)
+        self.camera_index = {cam_id: i for i, cam_id in enumerate(self.cameras)}
+
+        # Continue after the segments of an earlier recording instead of overwriting them
+        self.segment = last_segment(directory)
+        self.segment_file = None
+        self.segment_map = None
+        self.segment_view = None
+        self.write_offset = 0
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.bytes_written = 0
+        self.max_queue_depth = 0
+        self.stats_lock = threading.Lock()  # submit() runs on the callback thread of every camera
+
+        self.index_file = open(os.path.join(directory, 'index.bin'), 'ab')
+
+    def _get_slot(self, size: int) -> Optional[numpy.ndarray]:
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            with self.slots_lock:
+                if self.slots_allocated >= self.slot_count:
+                    return None
+                self.slots_allocated += 1
+            slot = numpy.empty(size, numpy.uint8)
+
+        if slot.size < size:
+            slot = numpy.empty(size, numpy.uint8)
+        return slot
+
+    def submit(self, cam_id: str, frame: Frame) -> bool:
+        # Called from the camera callback. Never blocks: drops the frame if the writer is behind.
+        payload = numpy.frombuffer(frame.get_buffer(), numpy.uint8)
+        slot = self._get_slot(payload.size)
+        with self.stats_lock:
+            self.submitted += 1
+            if slot is None:
+                self.dropped += 1
+        if slot is None:
+            return False
+
+        numpy.copyto(slot[:payload.size], payload)
+        self.write_queue.put((cam_id, frame.get_id(), frame.get_timestamp() or 0, time.time_ns(),
+                              int(frame.get_pixel_format()), frame.get_width(), frame.get_height(),
+                              payload.size, slot))
+        with self.stats_lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.write_queue.qsize())
+        return True
+
+    def stop(self):
+        self.write_queue.put(None)
+
+    def stats(self) -> dict:
+        return {
+            'submitted': self.submitted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'bytes_written': self.bytes_written,
+            'queue_depth': self.write_queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'slots_free': self.free_slots.qsize(),
+            'slots_allocated': self.slots_allocated,
+        }
+
+    def _open_segment(self, min_size: int):
+        self._close_segment()
+        self.segment += 1
+        size = max(self.segment_size, min_size)
+        self.segment_file = open(segment_path(self.directory, self.segment), 'w+b')
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.segment_file.fileno(), 0, size)
+        else:
+            self.segment_file.truncate(size)
+        self.segment_map = mmap.mmap(self.segment_file.fileno(), size)
+        self.segment_view = numpy.frombuffer(self.segment_map, numpy.uint8)
+        self.write_offset = 0
+
+    def _close_segment(self):
+        if self.segment_map is None:
+            return
+        # The numpy view must be released before the map can be closed
+        self.segment_view = None
+        self.segment_map.flush()
+        self.segment_map.close()
+        self.segment_map = None
+        # Give back the preallocated space that was never used
+        self.segment_file.truncate(self.write_offset)
+        self.segment_file.close()
+        self.segment_file = None
+
+    def _camera(self, cam_id: str) -> int:
+        if cam_id not in self.camera_index:
+            self.camera_index[cam_id] = len(self.cameras)
+            self.cameras.append(cam_id)
+            with open(os.path.join(self.directory, 'cameras.json'), 'w') as f:
+                json.dump(self.cameras, f)
+        return self.camera_index[cam_id]
+
+    def _write(self, item, record: numpy.ndarray):
+        cam_id, frame_id, device_ts, host_ts, pixel_format, width, height, size, slot = item
+
+        if self.segment_map is None or self.write_offset + size > len(self.segment_map):
+            self._open_segment(size)
+
+        offset = self.write_offset
+        numpy.copyto(self.segment_view[offset:offset + size], slot[:size])
+        self.write_offset += size
+        self.free_slots.put(slot)
+
+        record[0] = (frame_id, device_ts, host_ts, self._camera(cam_id), self.segment,
+                     pixel_format, width, height, offset, size)
+        self.index_file.write(record.tobytes())
+
+        self.written += 1
+        self.bytes_written += size
+
+    def run(self):
+        self.log.info(f"Thread 'FrameRecorder({self.directory})' started.")
+        record = numpy.zeros(1, INDEX_DTYPE)
+        last_flush = time.time()
+        try:
+            while True:
+                try:
+                    item = self.write_queue.get(timeout=INDEX_FLUSH_INTERVAL)
+                except queue.Empty:
+                    item = False
+
+                if item is None:
+                    break
+                if item:
+                    self._write(item, record)
+
+                if time.time() - last_flush >= INDEX_FLUSH_INTERVAL:
+                    self.index_file.flush()
+                    last_flush = time.time()
+        finally:
+            self._close_segment()
+            self.index_file.close()
+
+        self.log.info(f"Thread 'FrameRecorder({self.directory})' terminated. {self.stats()}")
+
+
+class RecordingReader:
+    """
+    Random access to a directory written by FrameRecorder. Payloads are views on the
+    memory-mapped segments and must be released before close().
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index = read_index(directory)
+        self.cameras = read_cameras(directory)
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def payload(self, i: int) -> numpy.ndarray:
+        record = self.index[i]
+        segment = int(record['segment'])
+        if segment not in self.maps:
+            with open(segment_path(self.directory, segment), 'rb') as f:
+                self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = int(record['offset'])
+        return numpy.frombuffer(self.maps[segment], numpy.uint8, int(record['size']), offset)
+
+    def camera(self, i: int) -> str:
+        return self.cameras[int(self.index[i]['camera'])]
+
+    def close(self):
+        maps, self.maps = self.maps, {}
+        for segment_map in maps.values():
+            segment_map.close()
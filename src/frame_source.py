@@ -0,0 +1,490 @@
+# frame_source.py
+import glob
+import os
+import queue
+import random
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import Optional
+import numpy
+from vmbpy import *
+
+
+class FrameSource(ABC):
+    """
+    The part of VmbSystem the pipeline depends on. Application opens a source as a
+    context manager, starts a FrameProducer per camera and registers itself as
+    camera change handler.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+    @abstractmethod
+    def get_all_cameras(self) -> tuple:
+        pass
+
+    @abstractmethod
+    def register_camera_change_handler(self, handler):
+        pass
+
+    @abstractmethod
+    def unregister_camera_change_handler(self, handler):
+        pass
+
+
+class VmbSource(FrameSource):
+    def __init__(self):
+        self.vmb = VmbSystem.get_instance()
+
+    def __enter__(self):
+        self.vmb.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.vmb.__exit__(exc_type, exc_value, exc_traceback)
+
+    def get_all_cameras(self) -> tuple:
+        return self.vmb.get_all_cameras()
+
+    def register_camera_change_handler(self, handler):
+        self.vmb.register_camera_change_handler(handler)
+
+    def unregister_camera_change_handler(self, handler):
+        self.vmb.unregister_camera_change_handler(handler)
+
+
+class SimulatedFrame:
+    """
+    Stand-in for vmbpy.Frame backed by a numpy buffer.
+    """
+
+    def __init__(self, size: int):
+        self.buffer = numpy.zeros(size, numpy.uint8)
+        self.size = size
+        self.frame_id = 0
+        self.timestamp = 0
+        self.width = 0
+        self.height = 0
+        self.pixel_format = PixelFormat.Mono8
+        self.status = FrameStatus.Complete
+
+    def reserve(self, size: int) -> numpy.ndarray:
+        if self.buffer.size < size:
+            self.buffer = numpy.zeros(size, numpy.uint8)
+        self.size = size
+        return self.buffer[:size]
+
+    def get_status(self) -> FrameStatus:
+        return self.status
+
+    def get_id(self) -> int:
+        return self.frame_id
+
+    def get_timestamp(self) -> int:
+        return self.timestamp
+
+    def get_width(self) -> int:
+        return self.width
+
+    def get_height(self) -> int:
+        return self.height
+
+    def get_pixel_format(self) -> PixelFormat:
+        return self.pixel_format
+
+    def get_buffer(self) -> numpy.ndarray:
+        return self.buffer[:self.size]
+
+    def as_numpy_ndarray(self) -> numpy.ndarray:
+        # Like vmbpy: uint8 for Mono8, uint16 for the unpacked formats above 8 bit
+        pixels = self.width * self.height
+        if self.pixel_format in (PixelFormat.Mono10, PixelFormat.Mono12, PixelFormat.Mono14, PixelFormat.Mono16):
+            if self.size != 2 * pixels:
+                raise ValueError(f'{self.size} bytes are no {self.width}x{self.height} {self.pixel_format} frame')
+            return self.buffer[:self.size].view('<u2').reshape(self.height, self.width, 1)
+        return self.buffer[:pixels].reshape(self.height, self.width, 1)
+
+    def as_opencv_image(self) -> numpy.ndarray:
+        return self.as_numpy_ndarray()
+
+
+class SimulatedFeature:
+    def __init__(self, value, value_range: Optional[tuple] = None):
+        self.value = value
+        self.value_range = value_range
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        if self.value_range is not None and not self.value_range[0] <= value <= self.value_range[1]:
+            raise VmbFeatureError(f'{value} is outside of {self.value_range}')
+        self.value = value
+
+    def get_range(self) -> tuple:
+        return self.value_range
+
+
+class SimulatedCamera(ABC):
+    """
+    Stand-in for vmbpy.Camera. A thread fills the queued frame buffers and calls the
+    streaming handler with the same (cam, stream, frame) contract as vmbpy. Like a real
+    camera, a frame is lost when the handler has not queued back any buffer in time.
+    """
+
+    def __init__(self, cam_id: str, width: int, height: int, frame_rate: Optional[float]):
+        self.cam_id = cam_id
+        self.width = width
+        self.height = height
+        self.frame_rate = frame_rate
+        # Accepted so that camera setup code runs unchanged; they do not affect the stream
+        self.features = {
+            'ExposureAuto': SimulatedFeature('Off'),
+            'ExposureTime': SimulatedFeature(10000.0, (10.0, 10000000.0)),
+            'Gain': SimulatedFeature(0.0, (0.0, 27.0)),
+            'AcquisitionFrameRateEnable': SimulatedFeature(frame_rate is not None),
+            'AcquisitionFrameRate': SimulatedFeature(frame_rate or 0.0, (0.0, 1000.0)),
+            'AcquisitionFrameRateMode': SimulatedFeature('Basic'),
+            'BinningHorizontal': SimulatedFeature(1, (1, 8)),
+            'BinningVertical': SimulatedFeature(1, (1, 8)),
+            'DeviceTemperature': SimulatedFeature(40.0),
+        }
+        self.pixel_format = PixelFormat.Mono8
+
+        self.handler = None
+        self.free_frames = queue.Queue()
+        self.killswitch = threading.Event()
+        self.thread = None
+
+        self.frame_id = 0
+        self.frames_lost = 0
+        self.start_time = time.perf_counter_ns()
+
+    def __getattr__(self, name):
+        features = self.__dict__.get('features', {})
+        if name in features:
+            return features[name]
+        raise AttributeError(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+    def get_id(self) -> str:
+        return self.cam_id
+
+    def get_serial(self) -> str:
+        return self.cam_id
+
+    def get_name(self) -> str:
+        return self.cam_id
+
+    def get_pixel_format(self) -> PixelFormat:
+        return self.pixel_format
+
+    def get_pixel_formats(self) -> tuple:
+        return (PixelFormat.Mono8,)
+
+    def set_pixel_format(self, fmt: PixelFormat):
+        if fmt not in self.get_pixel_formats():
+            raise VmbFeatureError(f'{fmt} is not supported by {self.cam_id}')
+        self.pixel_format = fmt
+
+    def is_streaming(self) -> bool:
+        return self.thread is not None
+
+    def start_streaming(self, handler, buffer_count: int = 5, allocation_mode=None):
+        self.handler = handler
+        self.killswitch.clear()
+        for _ in range(buffer_count):
+            self.free_frames.put(SimulatedFrame(self.width * self.height))
+        self.thread = threading.Thread(target=self._stream, daemon=True)
+        self.thread.start()
+
+    def stop_streaming(self):
+        if self.thread is None:
+            return
+        self.killswitch.set()
+        self.thread.join()
+        self.thread = None
+        self.free_frames = queue.Queue()
+
+    def queue_frame(self, frame: SimulatedFrame):
+        self.free_frames.put(frame)
+
+    def interval(self) -> Optional[float]:
+        # Seconds until the next frame, None to stream as fast as frames are queued back
+        return 1.0 / self.frame_rate if self.frame_rate else None
+
+    @abstractmethod
+    def fill(self, frame: SimulatedFrame) -> bool:
+        # Write the next image into frame. Returns False at the end of the stream.
+        pass
+
+    def _stream(self):
+        next_time = time.perf_counter()
+        while not self.killswitch.is_set():
+            interval = self.interval()
+            if interval is None:
+                try:
+                    frame = self.free_frames.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            else:
+                next_time += interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    if self.killswitch.wait(delay):
+                        break
+                elif delay < -interval:
+                    next_time = time.perf_counter()
+                try:
+                    frame = self.free_frames.get_nowait()
+                except queue.Empty:
+                    self.frames_lost += 1
+                    self.frame_id += 1
+                    continue
+
+            if not self.fill(frame):
+                self.free_frames.put(frame)
+                break
+
+            frame.frame_id = self.frame_id
+            frame.timestamp = time.perf_counter_ns() - self.start_time
+            frame.pixel_format = self.pixel_format
+            frame.status = FrameStatus.Complete
+            self.frame_id += 1
+            self.handler(self, None, frame)
+
+
+class SyntheticCamera(SimulatedCamera):
+    """
+    Generates a moving noise pattern at a configurable resolution and frame rate.
+    """
+
+    def __init__(self, cam_id: str, width: int = 4024, height: int = 3036, frame_rate: Optional[float] = 35.0):
+        SimulatedCamera.__init__(self, cam_id, width, height, frame_rate)
+        rng = numpy.random.default_rng(zlib.crc32(cam_id.encode()))
+        # The images are windows into a wider pattern, so producing a frame is a single copy
+        self.pattern = rng.integers(0, 256, (height, width + 256), numpy.uint8)
+
+    def fill(self, frame: SimulatedFrame) -> bool:
+        shift = self.frame_id % 256
+        image = frame.reserve(self.width * self.height).reshape(self.height, self.width)
+        numpy.copyto(image, self.pattern[:, shift:shift + self.width])
+        frame.width = self.width
+        frame.height = self.height
+        return True
+
+
+class ReplayCamera(SimulatedCamera):
+    """
+    Replays a FrameRecorder or FrameArchive directory, a directory of image files or a video file.
+    With realtime=True the original frame timing is kept, otherwise frames are
+    delivered as fast as the pipeline queues buffers back.
+    """
+
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.pgm')
+
+    def __init__(self, cam_id: str, path: str, realtime: bool = True, loop: bool = False,
+                 recorded_cam_id: Optional[str] = None):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.recorded_cam_id = recorded_cam_id or cam_id
+        self.position = 0
+        self.last_host_timestamp = None
+        self.capture = None
+        self.reader = None
+        self.files = []
+
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, 'index.bin')):
+            from frame_archive import open_recording
+            self.reader = open_recording(path)
+            if self.recorded_cam_id not in self.reader.cameras:
+                raise ValueError(f'Recording {path} has no camera \'{self.recorded_cam_id}\', '
+                                 f'only {", ".join(self.reader.cameras) or "none"}')
+            self.records = [i for i in range(len(self.reader)) if self.reader.camera(i) == self.recorded_cam_id]
+            if not self.records:
+                raise ValueError(f'Recording {path} holds no frames of camera \'{self.recorded_cam_id}\'')
+            first = self.reader.index[self.records[0]]
+            width, height, frame_rate = int(first['width']), int(first['height']), None
+        elif os.path.isdir(path):
+            self.files = sorted(f for f in glob.glob(os.path.join(path, '*'))
+                                if f.lower().endswith(self.IMAGE_EXTENSIONS))
+            if not self.files:
+                raise ValueError(f'{path} holds no images ({", ".join(self.IMAGE_EXTENSIONS)})')
+            height, width = self._read_image(0).shape
+            frame_rate = 35.0
+        else:
+            import cv2
+            self.capture = cv2.VideoCapture(path)
+            if not self.capture.isOpened():
+                raise ValueError(f'Cannot open {path} as a recording, image directory or video file')
+            width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            frame_rate = self.capture.get(cv2.CAP_PROP_FPS) or 35.0
+
+        SimulatedCamera.__init__(self, cam_id, width, height, frame_rate if realtime else None)
+
+    def _read_image(self, i: int) -> numpy.ndarray:
+        import cv2
+        return cv2.imread(self.files[i], cv2.IMREAD_GRAYSCALE)
+
+    def __len__(self):
+        if self.reader is not None:
+            return len(self.records)
+        if self.files:
+            return len(self.files)
+        import cv2
+        return int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def interval(self) -> Optional[float]:
+        if not self.realtime:
+            return None
+        if self.reader is not None and self.position < len(self.records):
+            host_timestamp = int(self.reader.index[self.records[self.position]]['host_timestamp'])
+            last, self.last_host_timestamp = self.last_host_timestamp, host_timestamp
+            return 0.0 if last is None else max(host_timestamp - last, 0) / 1e9
+        return SimulatedCamera.interval(self)
+
+    def _rewind(self) -> bool:
+        if not self.loop:
+            return False
+        self.position = 0
+        self.last_host_timestamp = None
+        if self.capture is not None:
+            import cv2
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return True
+
+    def fill(self, frame: SimulatedFrame) -> bool:
+        if self.reader is not None:
+            if self.position >= len(self.records) and not self._rewind():
+                return False
+            record = self.reader.index[self.records[self.position]]
+            payload = self.reader.payload(self.records[self.position])
+            numpy.copyto(frame.reserve(payload.size), payload)
+            frame.width, frame.height = int(record['width']), int(record['height'])
+            self.pixel_format = PixelFormat(int(record['pixel_format']))
+
+        elif self.files:
+            if self.position >= len(self.files) and not self._rewind():
+                return False
+            image = self._read_image(self.position)
+            numpy.copyto(frame.reserve(image.size).reshape(image.shape), image)
+            frame.height, frame.width = image.shape
+
+        else:
+            import cv2
+            ok, image = self.capture.read()
+            if not ok:
+                if not self._rewind():
+                    return False
+                ok, image = self.capture.read()
+                if not ok:
+                    return False
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            numpy.copyto(frame.reserve(image.size).reshape(image.shape), image)
+            frame.height, frame.width = image.shape
+
+        self.position += 1
+        return True
+
+
+class SimulatedSource(FrameSource):
+    """
+    FrameSource over simulated cameras. detach() and attach() emulate hot-plug events;
+    with hotplug_interval set, a random camera is detached and re-attached periodically.
+    """
+
+    def __init__(self, cameras: list, hotplug_interval: Optional[float] = None):
+        self.cameras = {cam.get_id(): cam for cam in cameras}
+        self.attached = set(self.cameras)
+        self.handlers = []
+        self.lock = threading.Lock()
+        self.hotplug_interval = hotplug_interval
+        self.killswitch = threading.Event()
+        self.hotplug_thread = None
+
+    def __enter__(self):
+        if self.hotplug_interval:
+            self.killswitch.clear()
+            self.hotplug_thread = threading.Thread(target=self._hotplug, daemon=True)
+            self.hotplug_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.hotplug_thread is not None:
+            self.killswitch.set()
+            self.hotplug_thread.join()
+            self.hotplug_thread = None
+
+    def get_all_cameras(self) -> tuple:
+        with self.lock:
+            return tuple(self.cameras[cam_id] for cam_id in sorted(self.attached))
+
+    def register_camera_change_handler(self, handler):
+        self.handlers.append(handler)
+
+    def unregister_camera_change_handler(self, handler):
+        self.handlers.remove(handler)
+
+    def _notify(self, cam_id: str, event: CameraEvent):
+        for handler in list(self.handlers):
+            handler(self.cameras[cam_id], event)
+
+    def detach(self, cam_id: str):
+        with self.lock:
+            if cam_id not in self.attached:
+                return
+            self.attached.discard(cam_id)
+        # A real camera stops delivering frames when it is unplugged
+        self.cameras[cam_id].killswitch.set()
+        self._notify(cam_id, CameraEvent.Missing)
+
+    def attach(self, cam_id: str):
+        with self.lock:
+            if cam_id in self.attached:
+                return
+            self.attached.add(cam_id)
+        self._notify(cam_id, CameraEvent.Detected)
+
+    def _hotplug(self):
+        while not self.killswitch.wait(self.hotplug_interval):
+            cam_id = random.choice(sorted(self.cameras))
+            self.detach(cam_id)
+            if self.killswitch.wait(min(self.hotplug_interval, 1.0)):
+                break
+            self.attach(cam_id)
+
+
+def synthetic_source(count: int, width: int, height: int, frame_rate: Optional[float],
+                     hotplug_interval: Optional[float] = None) -> SimulatedSource:
+    cameras = [SyntheticCamera(f'SIM_{i}', width, height, frame_rate) for i in range(count)]
+    return SimulatedSource(cameras, hotplug_interval)
+
+
+def replay_source(path: str, realtime: bool = True, loop: bool = False,
+                  hotplug_interval: Optional[float] = None) -> SimulatedSource:
+    if os.path.isdir(path) and os.path.exists(os.path.join(path, 'index.bin')):
+        from frame_archive import open_recording
+        reader = open_recording(path)
+        # Cameras that were connected but never delivered a frame are not replayed
+        recorded = [reader.cameras[i] for i in sorted(set(reader.index['camera'].tolist()))]
+        reader.close()
+        if not recorded:
+            raise ValueError(f'Recording {path} holds no frames')
+        cameras = [ReplayCamera(cam_id, path, realtime, loop) for cam_id in recorded]
+    else:
+        cameras = [ReplayCamera(f'REPLAY_{os.path.basename(os.path.normpath(path))}', path, realtime, loop)]
+    return SimulatedSource(cameras, hotplug_interval)
@@ -0,0 +1,166 @@
+# frame_trace.py
+import math
+import threading
+import time
+from typing import Optional
+from vmbpy import *
+
+# Host side checkpoints of a frame, in the order they are normally reached
+STAGES = ('callback', 'enqueue', 'dequeue', 'detect_start', 'detect_end', 'display')
+
+# Latency segments as (name, from, to). 'sensor' is the device timestamp mapped onto the host clock.
+SEGMENTS = (
+    ('transfer', 'sensor', 'callback'),
+    ('callback', 'callback', 'enqueue'),
+    ('queue', 'enqueue', 'dequeue'),
+    ('detect_wait', 'dequeue', 'detect_start'),
+    ('detect', 'detect_start', 'detect_end'),
+    ('display', 'dequeue', 'display'),
+    ('total_detect', 'sensor', 'detect_end'),
+    ('total_display', 'sensor', 'display'),
+)
+
+HISTOGRAM_MIN_NS = 10_000  # 10 us
+HISTOGRAM_MAX_NS = 10_000_000_000  # 10 s
+HISTOGRAM_RATIO = 1.05  # Bucket width, bounds the percentile error to 5%
+
+
+class FrameTrace:
+    """
+    Checkpoint times of a single frame. All host times are time.perf_counter_ns(),
+    0 means the checkpoint was not reached.
+    """
+    __slots__ = ('cam_id', 'frame_id', 'device_timestamp') + STAGES
+
+    def __init__(self, cam_id: str, frame_id: int, device_timestamp: Optional[int]):
+        self.cam_id = cam_id
+        self.frame_id = frame_id
+        self.device_timestamp = device_timestamp or 0
+        self.callback = time.perf_counter_ns()
+        self.enqueue = 0
+        self.dequeue = 0
+        self.detect_start = 0
+        self.detect_end = 0
+        self.display = 0
+
+    def mark(self, stage: str):
+        setattr(self, stage, time.perf_counter_ns())
+
+
+class LatencyHistogram:
+    """
+    Log-bucketed histogram of nanosecond durations. Recording is one log() and one list increment.
+    """
+
+    def __init__(self):
+        self.scale = 1.0 / math.log(HISTOGRAM_RATIO)
+        self.size = int(math.log(HISTOGRAM_MAX_NS / HISTOGRAM_MIN_NS) * self.scale) + 2
+        self.counts = [0] * self.size
+        self.total = 0
+        self.sum_ns = 0
+
+    def record(self, ns: int):
+        if ns < HISTOGRAM_MIN_NS:
+            i = 0
+        else:
+            i = min(int(math.log(ns / HISTOGRAM_MIN_NS) * self.scale) + 1, self.size - 1)
+        self.counts[i] += 1
+        self.total += 1
+        self.sum_ns += ns
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q: percentile in [0, 100]
+        :return: upper bucket bound in milliseconds, 0 if empty
+        """
+        if not self.total:
+            return 0.0
+        rank = q / 100.0 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return HISTOGRAM_MIN_NS * HISTOGRAM_RATIO ** i / 1e6
+        return HISTOGRAM_MAX_NS / 1e6
+
+    def mean(self) -> float:
+        return self.sum_ns / self.total / 1e6 if self.total else 0.0
+
+
+class LatencyTracker:
+    """
+    Aggregates finished FrameTraces into per-camera, per-segment histograms.
+
+    Device timestamps run on the camera clock. They are mapped onto the host clock with
+    the smallest offset seen so far, so 'transfer' is the delay above the fastest
+    observed transfer rather than an absolute sensor-to-host time.
+    """
+
+    def __init__(self, alarm_p99_ms: Optional[float] = None, alarm_segment: str = 'total_display'):
+        self.log = Log.get_instance()
+        self.alarm_p99_ms = alarm_p99_ms
+        self.alarm_segment = alarm_segment
+        self.lock = threading.Lock()
+        self.clock_offsets = {}
+        self.histograms = {}  # Since start
+        self.window = {}  # Since the last report()
+
+    def _histogram(self, table: dict, cam_id: str, segment: str) -> LatencyHistogram:
+        key = (cam_id, segment)
+        if key not in table:
+            table[key] = LatencyHistogram()
+        return table[key]
+
+    def finish(self, trace: FrameTrace):
+        times = {stage: getattr(trace, stage) for stage in STAGES}
+        with self.lock:
+            if trace.device_timestamp:
+                offset = trace.callback - trace.device_timestamp
+                best = self.clock_offsets.get(trace.cam_id)
+                if best is None or offset < best:
+                    self.clock_offsets[trace.cam_id] = best = offset
+                times['sensor'] = trace.device_timestamp + best
+            else:
+                times['sensor'] = 0
+
+            for segment, start, end in SEGMENTS:
+                if times[start] and times[end]:
+                    ns = times[end] - times[start]
+                    self._histogram(self.histograms, trace.cam_id, segment).record(ns)
+                    self._histogram(self.window, trace.cam_id, segment).record(ns)
+
+    def summary(self, window: bool = False) -> dict:
+        # {cam_id: {segment: {'count', 'mean', 'p50', 'p99'}}} in milliseconds
+        table = self.window if window else self.histograms
+        result = {}
+        with self.lock:
+            for (cam_id, segment), hist in sorted(table.items()):
+                result.setdefault(cam_id, {})[segment] = {
+                    'count': hist.total,
+                    'mean': hist.mean(),
+                    'p50': hist.percentile(50),
+                    'p99': hist.percentile(99),
+                }
+        return result
+
+    def reset_window(self):
+        with self.lock:
+            self.window = {}
+
+    def report(self) -> dict:
+        """
+        Log the latencies since the last report, warn about cameras whose p99 exceeds
+        the alarm threshold, and start a new window.
+        """
+        summary = self.summary(window=True)
+        self.reset_window()
+
+        for cam_id, segments in summary.items():
+            text = ', '.join(f'{segment} p50 {s["p50"]:.1f} p99 {s["p99"]:.1f}' for segment, s in segments.items())
+            self.log.info(f'[LATENCY ms] {cam_id}: {text}')
+
+            alarm = segments.get(self.alarm_segment)
+            if self.alarm_p99_ms is not None and alarm and alarm['p99'] > self.alarm_p99_ms:
+                self.log.warning(f'[LATENCY ALARM] {cam_id}: {self.alarm_segment} p99 {alarm["p99"]:.1f} ms '
+                                 f'exceeds {self.alarm_p99_ms:.1f} ms')
+        return summary
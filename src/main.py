@@ -1,3 +1,10 @@
+import argparse
+import os
+import sys
+
+# The aprilgrid package lives next to src; heavy modules are imported once they are needed
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+
 from application import Application
 from vmbpy import *
 
@@ -7,7 +14,209 @@ def print_preamble():
     print('////////////////////////////////////////\n')
     print(flush=True)
 
+def positive_float(text: str) -> float:
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f'must be greater than 0, not {text}')
+    return value
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--record', metavar='DIR',
+                        help='record raw frames of all cameras into DIR')
+    parser.add_argument('--codec', metavar='CODEC',
+                        help='compress --record frames losslessly: zlib, zstd, png or ffv1, optionally with '
+                             ':LEVEL, e.g. zstd:3 (default: raw, uncompressed)')
+    parser.add_argument('--archive-workers', type=int,
+                        help='compression threads for --codec (default: one per core)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='JSON camera profile(s) to apply instead of the built-in settings')
+    parser.add_argument('--display-fps', type=positive_float, default=30.0,
+                        help='preview refresh rate, independent of the capture rate (default: 30)')
+    parser.add_argument('--detect', action='store_true',
+                        help='draw tag detections on the preview window')
+    parser.add_argument('--headless', action='store_true',
+                        help='no preview window: detect tags on all frames and stream the results')
+    parser.add_argument('--output', metavar='FILE', default='-',
+                        help='JSON lines file for --headless results (default: stdout)')
+    parser.add_argument('--publish', metavar='SOCKET',
+                        help='also publish --headless results in binary form on the Unix socket SOCKET')
+    parser.add_argument('--family', default='t16h5b1',
+                        help='tag family to detect, several separated by commas (default: t16h5b1)')
+    parser.add_argument('--preset', help='detector preset name or JSON file, e.g. from python -m aprilgrid.tune')
+    parser.add_argument('--workers', type=int, help='detector threads (default: one per compute core)')
+    parser.add_argument('--quality-gate', action='store_true',
+                        help='skip motion blurred frames and reuse results while the image does not change')
+    parser.add_argument('--max-change', type=float, default=1.0,
+                        help='mean gray level change up to which --quality-gate reuses results (default: 1)')
+    parser.add_argument('--relative-sharpness', type=float, default=0.35,
+                        help='sharpness relative to recent frames below which --quality-gate skips (default: 0.35)')
+    parser.add_argument('--track', type=int, metavar='N',
+                        help='follow tags with optical flow between frames, detect fully every N frames')
+    parser.add_argument('--no-warmup', action='store_true',
+                        help='do not run the detector on a synthetic frame while the cameras are opened')
+    parser.add_argument('--summary-interval', type=float, default=10.0,
+                        help='seconds between throughput summaries in --headless mode')
+    parser.add_argument('--latency-alarm', type=float, metavar='MS',
+                        help='warn when the p99 sensor-to-display latency of a camera exceeds MS')
+    parser.add_argument('--capture-cpus', metavar='LIST',
+                        help='cores for capture threads, e.g. 0-1 (default: the first quarter of the cores)')
+    parser.add_argument('--compute-cpus', metavar='LIST',
+                        help='cores for detector threads, e.g. 2-7 (default: the remaining cores)')
+    parser.add_argument('--no-scheduling', action='store_true',
+                        help='leave thread placement, priorities and OpenCV threads to the OS and OpenCV')
+    parser.add_argument('--preview-port', type=int, metavar='PORT',
+                        help='serve the preview of every camera as MJPEG on http://127.0.0.1:PORT/')
+    parser.add_argument('--preview-fps', type=positive_float, default=10.0,
+                        help='images per second and camera for --preview-port at most (default: 10)')
+    parser.add_argument('--no-window', action='store_true',
+                        help='no preview window, e.g. to watch --preview-port without a desktop session')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--source', choices=('camera', 'synthetic', 'replay'), default='camera',
+                        help='where frames come from (default: connected cameras)')
+    parser.add_argument('--replay', metavar='PATH',
+                        help='recording directory, image directory or video file for --source replay')
+    parser.add_argument('--max-speed', action='store_true',
+                        help='replay as fast as the pipeline accepts frames instead of in real time')
+    parser.add_argument('--loop', action='store_true', help='restart the replay at its end')
+    parser.add_argument('--cameras', type=int, default=2, help='number of synthetic cameras')
+    parser.add_argument('--width', type=int, default=4024, help='synthetic image width')
+    parser.add_argument('--height', type=int, default=3036, help='synthetic image height')
+    parser.add_argument('--fps', type=float, default=35.0,
+                        help='synthetic frame rate, 0 for as fast as possible')
+    parser.add_argument('--hotplug', type=float, metavar='SECONDS',
+                        help='emulate a camera detach/attach every SECONDS')
+    args = parser.parse_args()
+    if args.source == 'replay' and not args.replay:
+        parser.error('--source replay needs --replay PATH')
+    if args.replay and not os.path.exists(args.replay):
+        parser.error(f'--replay {args.replay} does not exist')
+    if args.headless and (args.preview_port or args.no_window):
+        parser.error('--preview-port and --no-window need the preview, not --headless')
+    return args
+
+def create_source(args):
+    if args.source == 'synthetic':
+        from frame_source import synthetic_source
+        return synthetic_source(args.cameras, args.width, args.height, args.fps or None, args.hotplug)
+    if args.source == 'replay':
+        from frame_source import replay_source
+        return replay_source(args.replay, not args.max_speed, args.loop, args.hotplug)
+    return None
+
+def create_gate_factory(args):
+    if not args.quality_gate:
+        return None
+    from functools import partial
+    from aprilgrid.quality import QualityGate
+    return partial(QualityGate, max_change=args.max_change, relative_sharpness=args.relative_sharpness)
+
+def create_scheduling(args):
+    if args.no_scheduling:
+        return None
+    from scheduling import SchedulingPlan, parse_cpus
+    return SchedulingPlan.automatic(parse_cpus(args.capture_cpus) if args.capture_cpus else None,
+                                    parse_cpus(args.compute_cpus) if args.compute_cpus else None)
+
+def warmup_shape(args):
+    # Height, width the detectors are warmed up at
+    if args.no_warmup:
+        return None
+    if args.source == 'synthetic':
+        return args.height, args.width
+    from detection_service import WARMUP_SHAPE
+    return WARMUP_SHAPE
+
+def warmup_bits(args, profiles=None) -> int:
+    # Significant bits of the frames to expect, above 8 the workers allocate their unpack buffers too
+    from pixel_format import MONO_BITS
+    if args.source == 'synthetic':
+        return 8
+    if args.source == 'replay':
+        if not os.path.exists(os.path.join(args.replay, 'index.bin')):
+            return 8
+        from frame_archive import open_recording
+        reader = open_recording(args.replay)
+        formats = [PixelFormat(f) for f in set(reader.index['pixel_format'].tolist())]
+        reader.close()
+    else:
+        from camera_profile import CameraProfile
+        names = [p.pixel_format for p in (profiles or {'default': CameraProfile()}).values()]
+        formats = [PixelFormat[name] for name in names if name in PixelFormat.__members__]
+    return max((MONO_BITS.get(f, 8) for f in formats), default=8)
+
+def create_consumer_factory(args, scheduling=None, profiles=None):
+    gate_factory = create_gate_factory(args)
+    if not args.headless:
+        if not (args.detect or args.preview_port or args.no_window):
+            return None
+        from frame_consumer import FrameConsumer
+
+        def factory(frame_queue, tracker):
+            workers = None
+            if args.detect:
+                from detection_service import DetectionWorkers
+                workers = DetectionWorkers(args.family, args.workers, tracker, gate_factory=gate_factory,
+                                           preset=args.preset, warmup_shape=warmup_shape(args), warmup_bits=warmup_bits(args, profiles),
+                                           scheduling=scheduling, track_interval=args.track)
+            consumer = FrameConsumer(frame_queue, tracker, args.display_fps, workers, not args.no_window)
+            if args.preview_port:
+                from mjpeg_server import MjpegServer
+                consumer.preview_server = MjpegServer(consumer.compositor, port=args.preview_port,
+                                                      rate=args.preview_fps)
+                consumer.preview_server.start()
+            return consumer
+        return factory
+
+    from detection_service import DetectionService, JsonLinesSink
+    if args.output == '-':
+        # Results own stdout; anything else printed goes to stderr
+        stream = sys.stdout
+        sys.stdout = sys.stderr
+    else:
+        stream = open(args.output, 'a', buffering=1)
+    sinks = [JsonLinesSink(stream)]
+    if args.publish:
+        from detection_stream import DetectionPublisher
+        sinks.append(DetectionPublisher(args.publish))
+
+    def factory(frame_queue, tracker):
+        return DetectionService(frame_queue, sinks, tracker, args.family, args.workers, args.summary_interval,
+                                gate_factory, args.preset, warmup_shape(args), scheduling, args.track,
+                                warmup_bits(args, profiles))
+    return factory
+
 if __name__ == '__main__':
+    args = parse_args()
+    scheduling = create_scheduling(args)
+    profiles = None
+    if args.profile:
+        from camera_profile import load_profiles
+        profiles = load_profiles(args.profile)
+    consumer_factory = create_consumer_factory(args, scheduling, profiles)
     print_preamble()
-    app = Application()
+
+    recorder = None
+    if args.record and args.codec:
+        from frame_archive import FrameArchive
+        recorder = FrameArchive(args.record, args.codec, args.archive_workers)
+    elif args.record:
+        from frame_recorder import FrameRecorder
+        recorder = FrameRecorder(args.record)
+
+    from frame_trace import LatencyTracker
+    tracker = LatencyTracker(args.latency_alarm)
+
+    metrics_server = None
+    if args.metrics_port:
+        from metrics import MetricsServer
+        metrics_server = MetricsServer(port=args.metrics_port)
+        metrics_server.start()
+
+    app = Application(create_source(args), recorder, profiles, tracker, args.display_fps, consumer_factory,
+                      scheduling)
     app.run()
+
+    if metrics_server is not None:
+        metrics_server.stop()
@@ -0,0 +1,173 @@
+# metrics.py
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Sequence, Tuple
+from vmbpy import *
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9464
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricChild:
+    """
+    One labelled value of a metric. Hot paths keep a reference to their child so an
+    update is a lock and an addition.
+    """
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Metric:
+    def __init__(self, name: str, kind: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], MetricChild] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values, **kwargs) -> MetricChild:
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, MetricChild())
+        return child
+
+    def remove(self, *values):
+        with self.lock:
+            self.children.pop(tuple(str(v) for v in values), None)
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            children = sorted(self.children.items())
+        for key, child in children:
+            if key:
+                labels = ','.join(f'{name}="{_escape(v)}"' for name, v in zip(self.labelnames, key))
+                lines.append(f'{self.name}{{{labels}}} {child.value:g}')
+            else:
+                lines.append(f'{self.name} {child.value:g}')
+        return '\n'.join(lines)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _metric(self, name: str, kind: str, help_text: str, labelnames: Sequence[str]) -> Metric:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Metric(name, kind, help_text, labelnames)
+            return self.metrics[name]
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Metric:
+        return self._metric(name, 'counter', help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Metric:
+        return self._metric(name, 'gauge', help_text, labelnames)
+
+    def register_collector(self, collector: Callable[[], None]):
+        # Called before every scrape, typically to refresh gauges from other components
+        with self.lock:
+            self.collectors.append(collector)
+
+    def unregister_collector(self, collector: Callable[[], None]):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def render(self) -> str:
+        with self.lock:
+            collectors = list(self.collectors)
+            metrics = list(self.metrics.values())
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                Log.get_instance().warning(f'Metrics collector failed: {e}')
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+DETECTOR_STAGE_SECONDS = REGISTRY.counter(
+    'coopercam_detector_stage_seconds_total', 'Time spent in each detector stage', ('stage',))
+DETECTOR_RUNS = REGISTRY.counter('coopercam_detector_runs_total', 'Detector invocations')
+DETECTOR_QUADS = REGISTRY.counter(
+    'coopercam_detector_quads_total', 'Quad candidates, those rejected by the border prefilter, and detections',
+    ('kind',))
+
+
+def record_detector_timings(timings: Dict[str, float], counts: Optional[Dict[str, int]] = None):
+    """
+    :param timings: Detector.timings of the last detect() call, seconds per stage
+    :param counts: Detector.counts of the same call
+    """
+    DETECTOR_RUNS.inc()
+    for stage, seconds in timings.items():
+        DETECTOR_STAGE_SECONDS.labels(stage).inc(seconds)
+    for kind, count in (counts or {}).items():
+        DETECTOR_QUADS.labels(kind).inc(count)
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serves the registry in Prometheus text format on http://host:port/metrics.
+    """
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        threading.Thread.__init__(self, daemon=True)
+        self.log = Log.get_instance()
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = registry.render().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def run(self):
+        host, port = self.server.server_address[:2]
+        self.log.info(f"Thread 'MetricsServer' serving http://{host}:{port}/metrics.")
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
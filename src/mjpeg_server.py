@@ -0,0 +1,180 @@
+# mjpeg_server.py
+import html
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+from urllib.parse import quote, unquote
+import cv2
+from vmbpy import *
+from metrics import REGISTRY
+from preview_compositor import PreviewCompositor
+
+PREVIEW_HOST = '127.0.0.1'
+PREVIEW_PORT = 8080
+PREVIEW_RATE = 10.0  # JPEGs per second and camera at most, independent of capture and display rates
+JPEG_QUALITY = 80
+KEEPALIVE_INTERVAL = 2.0  # An unchanged image is sent again after this long, which detects gone clients
+BOUNDARY = 'frame'
+
+PREVIEW_VIEWERS = REGISTRY.gauge('coopercam_preview_viewers', 'Clients connected to a MJPEG preview stream',
+                                 ('camera',))
+PREVIEW_ENCODED = REGISTRY.counter('coopercam_preview_jpegs_total', 'Preview images JPEG encoded', ('camera',))
+
+
+class MjpegServer(threading.Thread):
+    """
+    Serves the downscaled preview of every camera as an MJPEG stream on http://host:port/stream/<cam_id>,
+    with an overview page on http://host:port/.
+    One encoder thread takes the slots of the watched cameras from the PreviewCompositor at most
+    rate times per second, encodes each changed slot once and hands the same bytes to every client of
+    that camera; clients that fall behind skip to the newest image. With no client connected the
+    encoder sleeps and nothing is copied or encoded.
+    """
+
+    def __init__(self, compositor: PreviewCompositor, host: str = PREVIEW_HOST, port: int = PREVIEW_PORT,
+                 rate: float = PREVIEW_RATE, quality: int = JPEG_QUALITY):
+        threading.Thread.__init__(self, daemon=True)
+        self.log = Log.get_instance()
+        self.compositor = compositor
+        if not rate > 0:
+            raise ValueError(f'rate must be greater than 0, not {rate}')
+        self.interval = 1.0 / rate
+        self.quality = quality
+        self.viewers: Dict[str, int] = {}  # Connected clients per camera
+        self.images: Dict[str, Tuple[bytes, int]] = {}  # Newest JPEG and its sequence number per camera
+        self.versions: Dict[str, int] = {}  # Compositor slot version of the newest JPEG per camera
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.killswitch = threading.Event()
+        self.encoder = threading.Thread(target=self.encode, daemon=True, name='MjpegEncoder')
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                path = handler.path.split('?')[0]
+                if path == '/':
+                    server.send_index(handler)
+                elif path.startswith('/stream/'):
+                    server.send_stream(handler, unquote(path[len('/stream/'):]))
+                else:
+                    handler.send_error(404)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def watched(self) -> bool:
+        with self.condition:
+            return bool(self.viewers)
+
+    def _add_viewer(self, cam_id: str):
+        with self.condition:
+            count = self.viewers[cam_id] = self.viewers.get(cam_id, 0) + 1
+            PREVIEW_VIEWERS.labels(cam_id).set(count)
+            self.condition.notify_all()  # Wakes up a paused encoder
+        self.log.info(f'Preview client connected to camera \'{cam_id}\', {count} watching.')
+
+    def _remove_viewer(self, cam_id: str):
+        with self.condition:
+            self.viewers[cam_id] -= 1
+            PREVIEW_VIEWERS.labels(cam_id).set(self.viewers[cam_id])
+            if not self.viewers[cam_id]:
+                # Nobody watches: forget the image, a new client must not get a stale one first
+                del self.viewers[cam_id]
+                self.images.pop(cam_id, None)
+                self.versions.pop(cam_id, None)
+        self.log.info(f'Preview client of camera \'{cam_id}\' disconnected.')
+
+    def send_index(self, handler: BaseHTTPRequestHandler):
+        images = ''.join(f'<figure><img src="/stream/{quote(cam_id)}">'
+                         f'<figcaption>{html.escape(cam_id)}</figcaption></figure>'
+                         for cam_id in list(self.compositor.cam_ids))
+        body = (f'<!DOCTYPE html><html><head><title>coopercam preview</title></head><body>'
+                f'{images or "<p>No camera connected.</p>"}</body></html>').encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/html; charset=utf-8')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def send_stream(self, handler: BaseHTTPRequestHandler, cam_id: str):
+        if cam_id not in self.compositor.cam_ids:
+            handler.send_error(404, f'No camera \'{cam_id}\'')
+            return
+        handler.send_response(200)
+        handler.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+        handler.send_header('Cache-Control', 'no-cache, private')
+        handler.send_header('Pragma', 'no-cache')
+        handler.end_headers()
+
+        self._add_viewer(cam_id)
+        sent = 0
+        try:
+            while not self.killswitch.is_set():
+                with self.condition:
+                    self.condition.wait_for(lambda: self.killswitch.is_set() or
+                                            self.images.get(cam_id, (None, 0))[1] != sent, KEEPALIVE_INTERVAL)
+                    jpeg, sequence = self.images.get(cam_id, (None, 0))
+                if jpeg is None:
+                    continue
+                # Unchanged after the keepalive interval: sent again, a closed connection shows up on write
+                sent = sequence
+                handler.wfile.write(f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n'
+                                    f'Content-Length: {len(jpeg)}\r\n\r\n'.encode())
+                handler.wfile.write(jpeg)
+                handler.wfile.write(b'\r\n')
+                handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self._remove_viewer(cam_id)
+
+    def encode(self):
+        next_tick = time.perf_counter()
+        while not self.killswitch.is_set():
+            with self.condition:
+                # Paused while nobody watches
+                self.condition.wait_for(lambda: self.viewers or self.killswitch.is_set())
+                watched = [(cam_id, self.versions.get(cam_id)) for cam_id in self.viewers]
+
+            for cam_id, known_version in watched:
+                snapshot = self.compositor.slot_snapshot(cam_id, known_version)
+                if snapshot is None:
+                    continue  # No new frame since the last JPEG, or camera gone
+                image, version = snapshot
+                ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+                if not ok:
+                    continue
+                PREVIEW_ENCODED.labels(cam_id).inc()
+                with self.condition:
+                    if cam_id in self.viewers:
+                        self.sequence += 1
+                        self.images[cam_id] = (jpeg.tobytes(), self.sequence)
+                        self.versions[cam_id] = version
+                        self.condition.notify_all()
+
+            # Rate cap. Skip ticks that were missed instead of encoding them back to back.
+            next_tick += self.interval
+            now = time.perf_counter()
+            if next_tick < now:
+                next_tick = now
+            self.killswitch.wait(next_tick - now)
+
+    def run(self):
+        host, port = self.server.server_address[:2]
+        self.log.info(f"Thread 'MjpegServer' serving http://{host}:{port}/ at up to "
+                      f'{1.0 / self.interval:g} images per second and camera.')
+        self.encoder.start()
+        self.server.serve_forever()
+
+    def stop(self):
+        self.killswitch.set()
+        with self.condition:
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+        if self.encoder.is_alive():
+            self.encoder.join()
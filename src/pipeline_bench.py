@@ -0,0 +1,242 @@
+# pipeline_bench.py
+"""
+End-to-end load test of the capture pipeline with simulated cameras.
+
+    python pipeline_bench.py --cameras 4 --width 4024 --height 3036 --fps 35 --detect --duration 30
+    python pipeline_bench.py --cameras 1,2,4,8 --width 2048 --height 1536 --json sweep.json
+
+The real Application, FrameProducer, frame queue, recorder and DetectionService run
+unchanged; only the vmbpy cameras are replaced by SyntheticCameras that call the
+producers with the same (cam, stream, frame) contract. After a warm-up the run is
+measured for a fixed time and reported per camera count: sustained throughput, frames
+lost at every stage, latency percentiles, CPU and memory use. A comma separated
+--cameras list runs one measurement per count, for capacity planning.
+"""
+import argparse
+import json
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+from typing import List, Optional
+from vmbpy import *
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+from application import Application
+from frame_producer import FRAMES_CAPTURED, FRAMES_DROPPED
+from frame_source import synthetic_source
+from frame_trace import LatencyTracker
+
+WARMUP = 3.0
+DURATION = 10.0
+
+
+class DrainConsumer:
+    """
+    Consumer without display or detection: takes every frame off the queue and releases it,
+    so the run measures capture, copy and queueing alone.
+    """
+
+    def __init__(self, frame_queue: queue.Queue, tracker: Optional[LatencyTracker] = None):
+        self.frame_queue = frame_queue
+        self.tracker = tracker
+        self.killswitch = threading.Event()
+        self.frames = 0
+
+    def stop(self):
+        self.killswitch.set()
+
+    def run(self):
+        while not self.killswitch.is_set():
+            try:
+                cam_id, frame, trace = self.frame_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if frame and trace is not None:
+                trace.mark('dequeue')
+                if self.tracker is not None:
+                    self.tracker.finish(trace)
+            self.frames += 1
+
+
+def memory_mb() -> dict:
+    # Current and peak resident set size of this process
+    status = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    status[key] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    peak = status.get('VmHWM', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    return {'rss': status.get('VmRSS', peak), 'peak': peak}
+
+
+class Snapshot:
+    # Cumulative counters at one point in time; the report is the difference of two
+    def __init__(self, cameras: list, recorder=None):
+        self.time = time.perf_counter()
+        self.cpu = time.process_time()
+        self.emitted = {cam.get_id(): cam.frame_id for cam in cameras}
+        self.lost = {cam.get_id(): cam.frames_lost for cam in cameras}
+        self.captured = {cam_id: int(FRAMES_CAPTURED.labels(cam_id).value) for cam_id in self.emitted}
+        self.dropped = {cam_id: int(FRAMES_DROPPED.labels(cam_id, 'queue').value) for cam_id in self.emitted}
+        self.recorded = recorder.stats() if recorder is not None else None
+
+
+def measure(cameras: int, width: int, height: int, fps: Optional[float], detect: bool = False,
+            tag_family_name: str = 't16h5b1', workers: Optional[int] = None, preset: Optional[str] = None,
+            record: Optional[str] = None, warmup: float = WARMUP, duration: float = DURATION,
+            scheduling=None) -> dict:
+    """
+    Run the pipeline with simulated cameras and measure it after the warm-up.
+    :param fps: frame rate of every camera, None for as fast as the pipeline takes frames
+    :param record: also record all frames into this directory
+    :param scheduling: SchedulingPlan for the capture, consumer and detector threads
+    :return: totals, per camera counters and latency percentiles in milliseconds
+    """
+    source = synthetic_source(cameras, width, height, fps)
+    tracker = LatencyTracker()
+    recorder = None
+    if record:
+        from frame_recorder import FrameRecorder
+        recorder = FrameRecorder(record)
+
+    consumers = []
+
+    def consumer_factory(frame_queue, tracker):
+        if detect:
+            from detection_service import DetectionService
+            consumer = DetectionService(frame_queue, [], tracker, tag_family_name, workers,
+                                        summary_interval=float('inf'), preset=preset, warmup_shape=(height, width),
+                                        scheduling=scheduling)
+        else:
+            consumer = DrainConsumer(frame_queue, tracker)
+        consumers.append(consumer)
+        return consumer
+
+    app = Application(source, recorder, tracker=tracker, consumer_factory=consumer_factory, scheduling=scheduling)
+    snapshots = []
+    stopped = threading.Event()
+
+    def timer():
+        # Application.run() builds the consumer first, wait for it before timing
+        while not consumers and not stopped.wait(0.01):
+            pass
+        if stopped.wait(warmup):
+            return
+        tracker.reset_window()
+        snapshots.append(Snapshot(source.cameras.values(), recorder))
+        if stopped.wait(duration):
+            return
+        snapshots.append(Snapshot(source.cameras.values(), recorder))
+        snapshots.append(tracker.summary(window=True))
+        consumers[0].stop()
+
+    thread = threading.Thread(target=timer, daemon=True)
+    thread.start()
+    try:
+        app.run()
+    finally:
+        stopped.set()
+        thread.join()
+    if len(snapshots) < 3:
+        raise RuntimeError('Pipeline stopped before the measurement finished')
+
+    start, end, latency = snapshots
+    elapsed = end.time - start.time
+    result = {
+        'cameras': cameras, 'width': width, 'height': height, 'fps': fps, 'detect': detect,
+        'seconds': elapsed,
+        'cpu_cores': (end.cpu - start.cpu) / elapsed,  # All threads of the process
+        'memory_mb': memory_mb(),
+        'per_camera': {},
+    }
+    for cam_id in sorted(start.emitted):
+        emitted = end.emitted[cam_id] - start.emitted[cam_id]
+        captured = end.captured[cam_id] - start.captured[cam_id]
+        dropped = end.dropped[cam_id] - start.dropped[cam_id]
+        result['per_camera'][cam_id] = {
+            'emitted': emitted,
+            'lost_camera': end.lost[cam_id] - start.lost[cam_id],  # No buffer queued back in time
+            'captured': captured,
+            'dropped_queue': dropped,  # Frame queue full, the consumer fell behind
+            'latency': latency.get(cam_id, {}),
+        }
+
+    total = {key: sum(c[key] for c in result['per_camera'].values())
+             for key in ('emitted', 'lost_camera', 'captured', 'dropped_queue')}
+    total['consumed'] = total['captured'] - total['dropped_queue']
+    total['fps'] = total['consumed'] / elapsed
+    total['megapixels_per_sec'] = total['fps'] * width * height / 1e6
+    if start.recorded is not None:
+        total['recorded'] = end.recorded['written'] - start.recorded['written']
+        total['dropped_recorder'] = end.recorded['dropped'] - start.recorded['dropped']
+    result['total'] = total
+    return result
+
+
+def percent(part: int, whole: int) -> str:
+    return f'{100.0 * part / whole:.1f}%' if whole else '-'
+
+
+def print_report(result: dict):
+    total = result['total']
+    fps = f'{result["fps"]:g} fps' if result['fps'] else 'max speed'
+    print(f'[BENCH] {result["cameras"]} x {result["width"]}x{result["height"]} @ {fps}'
+          f'{", detection" if result["detect"] else ""}, {result["seconds"]:.1f} s measured')
+    print(f'[BENCH]   throughput {total["fps"]:.1f} frames/sec, {total["megapixels_per_sec"]:.1f} MP/sec')
+    text = (f'[BENCH]   lost at camera {percent(total["lost_camera"], total["emitted"])}, '
+            f'dropped at queue {percent(total["dropped_queue"], total["captured"])}')
+    if 'recorded' in total:
+        text += f', dropped at recorder {percent(total["dropped_recorder"], total["captured"])}'
+    print(text)
+    print(f'[BENCH]   cpu {result["cpu_cores"]:.2f} of {os.cpu_count()} cores, '
+          f'rss {result["memory_mb"]["rss"]:.0f} MB, peak {result["memory_mb"]["peak"]:.0f} MB')
+    for cam_id, camera in result['per_camera'].items():
+        segments = ', '.join(f'{segment} p50 {values["p50"]:.1f} p99 {values["p99"]:.1f}'
+                             for segment, values in camera['latency'].items())
+        print(f'[BENCH]   {cam_id}: {camera["captured"] - camera["dropped_queue"]} frames, {segments} ms')
+    sys.stdout.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the capture pipeline with simulated cameras.')
+    parser.add_argument('--cameras', default='2', help='number of cameras, or a comma separated list to sweep')
+    parser.add_argument('--width', type=int, default=4024, help='image width')
+    parser.add_argument('--height', type=int, default=3036, help='image height')
+    parser.add_argument('--fps', type=float, default=35.0, help='frame rate per camera, 0 for as fast as possible')
+    parser.add_argument('--detect', action='store_true', help='run tag detection on all frames')
+    parser.add_argument('--family', default='t16h5b1',
+                        help='tag family to detect, several separated by commas (default: t16h5b1)')
+    parser.add_argument('--preset', help='detector preset name or JSON file')
+    parser.add_argument('--workers', type=int, help='detector threads (default: one per core)')
+    parser.add_argument('--record', metavar='DIR', help='also record all frames into DIR')
+    parser.add_argument('--warmup', type=float, default=WARMUP, help='seconds before measuring')
+    parser.add_argument('--duration', type=float, default=DURATION, help='seconds measured per run')
+    parser.add_argument('--schedule', action='store_true',
+                        help='pin capture and detector threads to separate cores as main.py does')
+    parser.add_argument('--json', metavar='FILE', help='write all results to FILE')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results: List[dict] = []
+    scheduling = None
+    if args.schedule:
+        from scheduling import SchedulingPlan
+        scheduling = SchedulingPlan.automatic()
+    for count in (int(n) for n in args.cameras.split(',')):
+        result = measure(count, args.width, args.height, args.fps or None, args.detect, args.family, args.workers,
+                         args.preset, args.record, args.warmup, args.duration, scheduling)
+        print_report(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,119 @@
+# pixel_format.py
+from typing import Optional
+import numpy
+from vmbpy import *
+
+# Significant bits of the mono formats frame_to_image understands
+MONO_BITS = {
+    PixelFormat.Mono8: 8,
+    PixelFormat.Mono10: 10,
+    PixelFormat.Mono12: 12,
+    PixelFormat.Mono14: 14,
+    PixelFormat.Mono16: 16,
+    PixelFormat.Mono10p: 10,
+    PixelFormat.Mono12p: 12,
+}
+
+
+def _output(width: int, height: int, out: Optional[numpy.ndarray]) -> numpy.ndarray:
+    if out is None:
+        return numpy.empty((height, width), numpy.uint16)
+    if out.shape != (height, width) or out.dtype != numpy.uint16 or not out.flags.c_contiguous:
+        raise ValueError(f'out must be a contiguous uint16 array of shape {(height, width)}')
+    return out
+
+
+def _words(packed, count: int, offset: int, stride: int) -> numpy.ndarray:
+    # Unaligned little-endian 16 bit reads, one per pixel group, straight from the packed bytes
+    return numpy.ndarray((count,), '<u2', packed, offset, (stride,))
+
+
+def unpack_mono10p(packed, width: int, height: int, out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+    """
+    Unpack Mono10p (4 pixels in 5 bytes) into uint16.
+    :param packed: buffer holding at least width * height * 10 / 8 bytes
+    :param out: optional reusable (height, width) uint16 array
+    """
+    if (width * height) % 4:
+        raise ValueError('Mono10p needs a pixel count divisible by 4')
+    out = _output(width, height, out)
+    groups = width * height // 4
+    p = out.reshape(-1, 4)
+
+    # Pixel k of a group starts at bit 10k, i.e. bit 2k of the 16 bit word at byte k
+    for k in range(4):
+        numpy.right_shift(_words(packed, groups, k, 5), 2 * k, out=p[:, k])
+        p[:, k] &= 0x3FF
+    return out
+
+
+def unpack_mono12p(packed, width: int, height: int, out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+    """
+    Unpack Mono12p (2 pixels in 3 bytes) into uint16.
+    :param packed: buffer holding at least width * height * 12 / 8 bytes
+    :param out: optional reusable (height, width) uint16 array
+    """
+    if (width * height) % 2:
+        raise ValueError('Mono12p needs an even pixel count')
+    out = _output(width, height, out)
+    groups = width * height // 2
+    p = out.reshape(-1, 2)
+
+    # Pixel 0 is the low 12 bits of the word at byte 0, pixel 1 the high 12 bits of the word at byte 1
+    numpy.bitwise_and(_words(packed, groups, 0, 3), 0xFFF, out=p[:, 0])
+    numpy.right_shift(_words(packed, groups, 1, 3), 4, out=p[:, 1])
+    return out
+
+
+def pack_mono10p(image: numpy.ndarray) -> numpy.ndarray:
+    # Inverse of unpack_mono10p, used to produce test data
+    p = image.reshape(-1, 4).astype(numpy.uint16)
+    b = numpy.empty((p.shape[0], 5), numpy.uint8)
+    b[:, 0] = p[:, 0] & 0xFF
+    b[:, 1] = (p[:, 0] >> 8) | ((p[:, 1] & 0x3F) << 2)
+    b[:, 2] = (p[:, 1] >> 6) | ((p[:, 2] & 0x0F) << 4)
+    b[:, 3] = (p[:, 2] >> 4) | ((p[:, 3] & 0x03) << 6)
+    b[:, 4] = p[:, 3] >> 2
+    return b.reshape(-1)
+
+
+def pack_mono12p(image: numpy.ndarray) -> numpy.ndarray:
+    # Inverse of unpack_mono12p, used to produce test data
+    p = image.reshape(-1, 2).astype(numpy.uint16)
+    b = numpy.empty((p.shape[0], 3), numpy.uint8)
+    b[:, 0] = p[:, 0] & 0xFF
+    b[:, 1] = (p[:, 0] >> 8) | ((p[:, 1] & 0x0F) << 4)
+    b[:, 2] = p[:, 1] >> 4
+    return b.reshape(-1)
+
+
+# Packed formats (GenICam PFNC, LSB first) and their unpackers
+UNPACKERS = {
+    PixelFormat.Mono10p: unpack_mono10p,
+    PixelFormat.Mono12p: unpack_mono12p,
+}
+
+
+def frame_bit_depth(frame: Frame) -> int:
+    return MONO_BITS.get(frame.get_pixel_format(), 8)
+
+
+def frame_to_image(frame: Frame, out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+    """
+    2D image of a mono frame: uint8 for Mono8, uint16 holding the sensor values otherwise.
+    Mono8 and unpacked formats are returned as views on the frame buffer; packed formats
+    are unpacked into out if given.
+    """
+    fmt = frame.get_pixel_format()
+    unpack = UNPACKERS.get(fmt)
+    if unpack is not None:
+        return unpack(frame.get_buffer(), frame.get_width(), frame.get_height(), out)
+    image = frame.as_numpy_ndarray()
+    return image.reshape(image.shape[0], image.shape[1]) if image.ndim == 3 and image.shape[2] == 1 else image
+
+
+def to_display(image: numpy.ndarray, bits: int) -> numpy.ndarray:
+    # Scale a (downscaled) high bit depth image to uint8 for showing it
+    if image.dtype == numpy.uint8:
+        return image
+    return (image >> (bits - 8)).astype(numpy.uint8)
@@ -0,0 +1,105 @@
+# preview_compositor.py
+import threading
+from typing import Dict, Optional, Tuple
+import numpy
+import cv2
+
+SLOT_SIZE = (1006, 759)  # Width, height of every camera in the preview
+
+
+class PreviewCompositor:
+    """
+    Keeps the preview as one preallocated canvas with a fixed slot per camera. A new frame
+    is decimated straight into its camera's slot; the layout only changes when cameras are
+    added or removed, and then the other slots are moved instead of being redrawn.
+    """
+
+    def __init__(self, slot_size: Tuple[int, int] = SLOT_SIZE):
+        self.slot_width, self.slot_height = slot_size
+        self.cam_ids = []
+        self.canvas = numpy.zeros((self.slot_height, 0), numpy.uint8)
+        self.scratch: Dict[str, numpy.ndarray] = {}
+        self.version = 0  # Incremented on every change of the canvas
+        self.slot_versions: Dict[str, int] = {}  # Version of the last update of every camera's slot
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cam_ids)
+
+    def _layout(self, cam_ids: list):
+        # Reallocate the canvas for a new set of cameras, keeping the content of remaining slots
+        canvas = numpy.zeros((self.slot_height, self.slot_width * len(cam_ids)), numpy.uint8)
+        for i, cam_id in enumerate(cam_ids):
+            if cam_id in self.cam_ids:
+                j = self.cam_ids.index(cam_id)
+                canvas[:, i * self.slot_width:(i + 1) * self.slot_width] = \
+                    self.canvas[:, j * self.slot_width:(j + 1) * self.slot_width]
+        self.canvas = canvas
+        self.cam_ids = cam_ids
+        self.version += 1
+
+    def add_camera(self, cam_id: str):
+        with self.lock:
+            if cam_id not in self.cam_ids:
+                self._layout(sorted(self.cam_ids + [cam_id]))
+
+    def remove_camera(self, cam_id: str):
+        with self.lock:
+            if cam_id in self.cam_ids:
+                self._layout([c for c in self.cam_ids if c != cam_id])
+            self.scratch.pop(cam_id, None)
+            self.slot_versions.pop(cam_id, None)
+
+    def slot_rect(self, cam_id: str) -> Optional[Tuple[int, int, int, int]]:
+        # x, y, width, height of the camera's slot on the canvas
+        if cam_id not in self.cam_ids:
+            return None
+        return self.cam_ids.index(cam_id) * self.slot_width, 0, self.slot_width, self.slot_height
+
+    def update(self, cam_id: str, image: numpy.ndarray, bits: int = 8):
+        """
+        Downscale a full resolution mono image into the camera's slot.
+        :param bits: significant bits of a uint16 image
+        """
+        with self.lock:
+            if cam_id not in self.cam_ids:
+                self._layout(sorted(self.cam_ids + [cam_id]))
+            x = self.cam_ids.index(cam_id) * self.slot_width
+            slot = self.canvas[:, x:x + self.slot_width]
+
+            # Cheap decimation first: pick every step-th pixel, no filtering of the full frame
+            h, w = image.shape[:2]
+            step = max(1, min(h // self.slot_height, w // self.slot_width))
+            small = image[::step, ::step]
+            if small.ndim == 3:
+                small = cv2.cvtColor(numpy.ascontiguousarray(small), cv2.COLOR_BGR2GRAY)
+
+            # Only the already small image is resampled if the ratio is not an integer
+            if small.shape != slot.shape:
+                scratch = self.scratch.get(cam_id)
+                if scratch is None or scratch.dtype != small.dtype:
+                    scratch = self.scratch[cam_id] = numpy.empty(slot.shape, small.dtype)
+                small = cv2.resize(small, (self.slot_width, self.slot_height), dst=scratch,
+                                   interpolation=cv2.INTER_AREA)
+
+            if small.dtype == numpy.uint8:
+                numpy.copyto(slot, small)
+            else:
+                numpy.right_shift(small, bits - 8, out=slot, casting='unsafe')
+            self.version += 1
+            self.slot_versions[cam_id] = self.version
+
+    def snapshot(self) -> Tuple[numpy.ndarray, int]:
+        # A copy of the canvas that stays consistent while other threads keep updating
+        with self.lock:
+            return self.canvas.copy(), self.version
+
+    def slot_snapshot(self, cam_id: str, known_version: Optional[int] = None) -> Optional[Tuple[numpy.ndarray, int]]:
+        # A copy of one camera's slot and its version; None if the camera is gone or the slot still
+        # holds known_version, so unchanged slots are not even copied
+        with self.lock:
+            version = self.slot_versions.get(cam_id)
+            if version is None or version == known_version:
+                return None
+            x = self.cam_ids.index(cam_id) * self.slot_width
+            return self.canvas[:, x:x + self.slot_width].copy(), version
@@ -0,0 +1,122 @@
+# scheduling.py
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+from vmbpy import *
+
+CAPTURE = 'capture'  # FrameProducers and, inherited from them, the camera callback threads
+CONSUMER = 'consumer'  # The loop that takes frames off the queue
+COMPUTE = 'compute'  # Detector workers
+
+CAPTURE_NICE = -5  # Needs CAP_SYS_NICE, without it capture stays at the default priority
+COMPUTE_NICE = 5
+CAPTURE_CORE_SHARE = 4  # One core in this many is reserved for capture
+
+
+def parse_cpus(text: str) -> Set[int]:
+    # '0-3,6' -> {0, 1, 2, 3, 6}
+    cpus = set()
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.add(int(part))
+    return cpus
+
+
+def format_cpus(cpus: Optional[Set[int]]) -> str:
+    if not cpus:
+        return 'all cpus'
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return 'cpus ' + ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+@dataclass
+class SchedulingPlan:
+    """
+    Core sets and priorities per role. Linux applies affinity and nice values per thread,
+    so every thread applies the plan of its role itself; threads it creates afterwards,
+    like the vmbpy callback threads of a camera, inherit both.
+    Detector workers are threads that share OpenCV's process wide thread pool, which is
+    sized once so that workers times OpenCV threads does not exceed the compute cores.
+    """
+    capture_cpus: Optional[Set[int]] = None  # None: not pinned
+    compute_cpus: Optional[Set[int]] = None
+    capture_nice: int = CAPTURE_NICE
+    compute_nice: int = COMPUTE_NICE
+
+    applied: list = field(default_factory=list)  # (role, thread name, cpus, nice, problems)
+
+    @classmethod
+    def automatic(cls, capture_cpus: Optional[Set[int]] = None,
+                  compute_cpus: Optional[Set[int]] = None) -> 'SchedulingPlan':
+        """
+        Reserve the first quarter of the available cores (at least one) for capture and the
+        rest for compute. With a single core nothing is pinned, only priorities are set.
+        """
+        cpus = available_cpus()
+        if capture_cpus is None and compute_cpus is None and len(cpus) > 1:
+            count = max(len(cpus) // CAPTURE_CORE_SHARE, 1)
+            capture_cpus, compute_cpus = set(cpus[:count]), set(cpus[count:])
+        return cls(capture_cpus, compute_cpus)
+
+    def __post_init__(self):
+        self.lock = threading.Lock()
+
+    def cpus(self, role: str) -> Optional[Set[int]]:
+        # The consumer converts and draws frames or feeds the detectors, it must not take cores from capture
+        return self.capture_cpus if role == CAPTURE else self.compute_cpus
+
+    def nice(self, role: str) -> int:
+        return {CAPTURE: self.capture_nice, CONSUMER: 0, COMPUTE: self.compute_nice}[role]
+
+    def apply(self, role: str):
+        # Pin and prioritize the calling thread
+        cpus, nice = self.cpus(role), self.nice(role)
+        problems = []
+        if cpus and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(0, cpus)
+            except OSError as e:
+                problems.append(f'affinity: {e.strerror}')
+        if nice and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+            except OSError as e:
+                problems.append(f'nice {nice}: {e.strerror}')
+        with self.lock:
+            self.applied.append((role, threading.current_thread().name, cpus, nice, problems))
+        if problems:
+            Log.get_instance().warning(f'Scheduling of {role} thread \'{threading.current_thread().name}\' '
+                                       f'incomplete: {", ".join(problems)}.')
+
+    def compute_cores(self) -> int:
+        return len(self.compute_cpus) if self.compute_cpus else len(available_cpus())
+
+    def opencv_threads(self, workers: int) -> int:
+        return max(self.compute_cores() // max(workers, 1), 1)
+
+    def configure_opencv(self, workers: int):
+        import cv2
+        cv2.setNumThreads(self.opencv_threads(workers))
+
+    def report(self, workers: Optional[int] = None):
+        log = Log.get_instance()
+        text = (f'Scheduling: capture on {format_cpus(self.capture_cpus)} with nice {self.capture_nice}, '
+                f'consumer and compute on {format_cpus(self.compute_cpus)} with nice 0 and {self.compute_nice}')
+        if workers:
+            text += f', {workers} detector workers with {self.opencv_threads(workers)} OpenCV threads each'
+        log.info(text + '.')
@@ -0,0 +1,87 @@
+import os
+from types import SimpleNamespace
+import numpy
+import pytest
+from detection_stream import FAMILY_NAMES, HEADER, DetectionPublisher, DetectionSubscriber, decode, encode, encode_result
+
+
+def detection_set(n: int, seed: int = 0):
+    rng = numpy.random.default_rng(seed)
+    ids = rng.integers(0, 500, n).astype(numpy.int32)
+    corners = rng.uniform(0, 4000, (n, 4, 2)).astype(numpy.float32)
+    return ids, corners
+
+
+@pytest.mark.parametrize('cam_id', ['', 'A', 'DEV_1AB22C00', 'ütf-8'])
+@pytest.mark.parametrize('n', [0, 1, 7])
+def test_roundtrip(cam_id, n):
+    ids, corners = detection_set(n)
+    message = encode(cam_id, 12345678901, 2 ** 62, 1.7e9 + 0.25, ids, corners)
+    assert len(message) % 4 == 0
+    assert HEADER.unpack_from(message)[-1] == len(message)
+
+    s = decode(message)
+    assert (s.cam_id, s.frame_id, s.device_timestamp, s.time) == (cam_id, 12345678901, 2 ** 62, 1.7e9 + 0.25)
+    numpy.testing.assert_array_equal(s.ids, ids)
+    numpy.testing.assert_array_equal(s.corners, corners)
+    assert s.family_names() == [''] * n
+
+
+@pytest.mark.parametrize('n', [1, 3, 4, 5])
+def test_families_roundtrip(n):
+    ids, corners = detection_set(n)
+    families = numpy.arange(n, dtype=numpy.uint8) % len(FAMILY_NAMES)
+    message = encode('A', 1, 2, 3.0, ids, corners, families)
+    assert len(message) % 4 == 0
+    s = decode(message)
+    numpy.testing.assert_array_equal(s.families, families)
+    numpy.testing.assert_array_equal(s.corners, corners)
+
+
+def test_encode_rejects_mismatched_families():
+    with pytest.raises(ValueError):
+        encode('A', 1, 2, 3.0, *detection_set(3), numpy.zeros(2, numpy.uint8))
+
+
+def test_decode_rejects_other_data():
+    message = bytearray(encode('A', 1, 2, 3.0, *detection_set(2)))
+    message[:4] = b'XXXX'
+    with pytest.raises(ValueError):
+        decode(message)
+
+
+def test_encode_result():
+    ids, corners = detection_set(3)
+    result = SimpleNamespace(cam_id='A', frame_id=5, device_timestamp=6, time=7.0,
+                             detections=[SimpleNamespace(tag_id=int(i), corners=c.reshape(4, 1, 2), family='t16h5b1')
+                                         for i, c in zip(ids, corners)])
+    s = decode(encode_result(result))
+    numpy.testing.assert_array_equal(s.ids, ids)
+    numpy.testing.assert_array_equal(s.corners, corners)
+    assert s.family_names() == ['t16h5b1'] * 3
+
+    result.detections[0].family = 'unknown'
+    with pytest.raises(ValueError):
+        encode_result(result)
+
+
+def test_publish_subscribe(tmp_path):
+    path = str(tmp_path / 'stream.sock')
+    publisher = DetectionPublisher(path)
+    subscriber = DetectionSubscriber(path)
+    sets = [detection_set(n, seed=n) for n in (0, 2, 5)]
+    # The publisher accepts the connection on its own thread
+    while not publisher.subscribers:
+        publisher.join(0.01)
+    for frame_id, (ids, corners) in enumerate(sets):
+        publisher.publish(encode('A', frame_id, 0, 0.0, ids, corners))
+    received = [subscriber.receive() for _ in sets]
+    publisher.close()
+    assert subscriber.receive() is None
+    subscriber.close()
+
+    for frame_id, ((ids, corners), s) in enumerate(zip(sets, received)):
+        assert s.frame_id == frame_id
+        numpy.testing.assert_array_equal(s.ids, ids)
+        numpy.testing.assert_array_equal(s.corners, corners)
+    assert not os.path.exists(path)
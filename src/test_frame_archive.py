@@ -0,0 +1,95 @@
+import json
+import numpy
+import pytest
+from vmbpy import *
+from frame_archive import ArchiveReader, FrameArchive, create_codec
+from frame_recorder import FrameRecorder
+from pixel_format import pack_mono12p
+
+WIDTH, HEIGHT = 64, 48
+
+
+def available(spec: str) -> bool:
+    try:
+        create_codec(spec)
+        return True
+    except ValueError:
+        return False
+
+
+CODECS = [pytest.param(spec, marks=pytest.mark.skipif(not available(spec), reason=f'{spec} not available'))
+          for spec in ('zlib:1', 'zstd:3', 'png:1', 'ffv1')]
+
+
+def make_payload(seed: int, pixel_format: PixelFormat) -> numpy.ndarray:
+    rng = numpy.random.default_rng(seed)
+    if pixel_format == PixelFormat.Mono8:
+        return rng.integers(0, 256, WIDTH * HEIGHT, numpy.uint8)
+    image = rng.integers(0, 1 << 12, (HEIGHT, WIDTH), numpy.uint16)
+    if pixel_format == PixelFormat.Mono12p:
+        return pack_mono12p(image)
+    return image.astype('<u2').view(numpy.uint8).reshape(-1)
+
+
+def archive(directory, codec, frames):
+    # frames: (cam_id, frame_id, pixel_format, payload)
+    archive = FrameArchive(str(directory), codec, workers=2)
+    archive.start()
+    for cam_id, frame_id, pixel_format, payload in frames:
+        assert archive.submit_payload(cam_id, payload, frame_id, 1000 * frame_id, int(pixel_format),
+                                      WIDTH, HEIGHT, block=True)
+    archive.stop()
+    archive.join()
+    assert archive.stats()['failed'] == 0
+
+
+def make_frames(first: int, cam_ids, count: int = 3):
+    return [(cam_id, first + i, pixel_format, make_payload(first + i, pixel_format))
+            for pixel_format in (PixelFormat.Mono8, PixelFormat.Mono12, PixelFormat.Mono12p)
+            for i in range(count) for cam_id in cam_ids]
+
+
+def assert_archived(directory, frames):
+    reader = ArchiveReader(str(directory))
+    assert len(reader) == len(frames)
+    for i, (cam_id, frame_id, pixel_format, payload) in enumerate(frames):
+        assert reader.camera(i) == cam_id
+        assert int(reader.index[i]['frame_id']) == frame_id
+        assert int(reader.index[i]['pixel_format']) == int(pixel_format)
+        numpy.testing.assert_array_equal(reader.payload(i), payload)
+    reader.close()
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_roundtrip(tmp_path, codec):
+    frames = make_frames(0, ['A', 'B'])
+    archive(tmp_path, codec, frames)
+    assert_archived(tmp_path, frames)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_reuse_appends(tmp_path, codec):
+    first = make_frames(0, ['A'])
+    second = make_frames(100, ['B', 'A'])
+    archive(tmp_path, codec, first)
+    archive(tmp_path, codec, second)
+    assert_archived(tmp_path, first + second)
+
+
+def test_refuses_other_codec(tmp_path):
+    archive(tmp_path, 'zlib:1', make_frames(0, ['A'], 1))
+    with pytest.raises(ValueError):
+        FrameArchive(str(tmp_path), 'png:1')
+    with open(tmp_path / 'archive.json') as f:
+        assert json.load(f)['codec'] == 'zlib:1'
+
+
+def test_refuses_raw_recording(tmp_path):
+    recorder = FrameRecorder(str(tmp_path))
+    recorder.start()
+    recorder.stop()
+    recorder.join()
+    (tmp_path / 'index.bin').touch()
+    with pytest.raises(ValueError):
+        FrameArchive(str(tmp_path))
+    assert not (tmp_path / 'archive.json').exists()
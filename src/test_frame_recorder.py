@@ -0,0 +1,119 @@
+import json
+import numpy
+import pytest
+from vmbpy import *
+from frame_recorder import FrameRecorder, RecordingReader
+from frame_source import ReplayCamera, SimulatedFrame
+from pixel_format import frame_to_image
+
+
+def make_frame(frame_id: int, width: int = 64, height: int = 48, pixel_format=PixelFormat.Mono8) -> SimulatedFrame:
+    rng = numpy.random.default_rng(frame_id)
+    size = width * height * (2 if pixel_format == PixelFormat.Mono12 else 1)
+    frame = SimulatedFrame(size)
+    frame.reserve(size)[:] = rng.integers(0, 256, size, numpy.uint8)
+    frame.frame_id = frame_id
+    frame.timestamp = 1000 * frame_id
+    frame.width, frame.height, frame.pixel_format = width, height, pixel_format
+    return frame
+
+
+def record(directory, cam_ids, frames, **kwargs):
+    recorder = FrameRecorder(str(directory), **kwargs)
+    recorder.start()
+    for frame in frames:
+        for cam_id in cam_ids:
+            assert recorder.submit(cam_id, frame)
+    recorder.stop()
+    recorder.join()
+    return recorder
+
+
+def test_roundtrip(tmp_path):
+    frames = [make_frame(i) for i in range(5)] + [make_frame(5, pixel_format=PixelFormat.Mono12)]
+    record(tmp_path, ['A', 'B'], frames)
+
+    reader = RecordingReader(str(tmp_path))
+    assert len(reader) == 12
+    for i, frame in enumerate(frames):
+        for j, cam_id in enumerate(['A', 'B']):
+            k = 2 * i + j
+            assert reader.camera(k) == cam_id
+            assert int(reader.index[k]['frame_id']) == frame.frame_id
+            assert int(reader.index[k]['pixel_format']) == int(frame.pixel_format)
+            numpy.testing.assert_array_equal(reader.payload(k), frame.get_buffer())
+    reader.close()
+
+
+def test_close_unmaps_segments(tmp_path):
+    record(tmp_path, ['A'], [make_frame(0)])
+    reader = RecordingReader(str(tmp_path))
+    assert reader.payload(0).size == 64 * 48
+    maps = list(reader.maps.values())
+    reader.close()
+    assert maps and all(segment_map.closed for segment_map in maps)
+
+
+def test_segments_roll_over(tmp_path):
+    frames = [make_frame(i) for i in range(6)]
+    record(tmp_path, ['A'], frames, segment_size=2 * 64 * 48)
+
+    reader = RecordingReader(str(tmp_path))
+    assert sorted(set(reader.index['segment'].tolist())) == [0, 1, 2]
+    for i, frame in enumerate(frames):
+        numpy.testing.assert_array_equal(reader.payload(i), frame.get_buffer())
+    reader.close()
+
+
+def test_reuse_appends(tmp_path):
+    first = [make_frame(i) for i in range(5)]
+    second = [make_frame(100 + i) for i in range(5)]
+    record(tmp_path, ['A'], first)
+    record(tmp_path, ['B', 'A'], second)
+
+    reader = RecordingReader(str(tmp_path))
+    assert reader.cameras == ['A', 'B']
+    assert len(reader) == 15
+    for i, frame in enumerate(first):
+        numpy.testing.assert_array_equal(reader.payload(i), frame.get_buffer())
+    for i, frame in enumerate(second):
+        assert reader.camera(5 + 2 * i) == 'B'
+        numpy.testing.assert_array_equal(reader.payload(5 + 2 * i), frame.get_buffer())
+        numpy.testing.assert_array_equal(reader.payload(6 + 2 * i), frame.get_buffer())
+    reader.close()
+
+
+def test_truncated_index_record_is_dropped(tmp_path):
+    record(tmp_path, ['A'], [make_frame(i) for i in range(3)])
+    with open(tmp_path / 'index.bin', 'ab') as f:
+        f.write(b'\0' * 7)
+    record(tmp_path, ['A'], [make_frame(3)])
+
+    reader = RecordingReader(str(tmp_path))
+    assert reader.index['frame_id'].tolist() == [0, 1, 2, 3]
+    numpy.testing.assert_array_equal(reader.payload(3), make_frame(3).get_buffer())
+    reader.close()
+
+
+def test_refuses_archive_directory(tmp_path):
+    with open(tmp_path / 'archive.json', 'w') as f:
+        json.dump({'codec': 'zlib:1'}, f)
+    with pytest.raises(ValueError):
+        FrameRecorder(str(tmp_path))
+
+
+def test_replay_images(tmp_path):
+    frames = [make_frame(0), make_frame(1, pixel_format=PixelFormat.Mono12), make_frame(2)]
+    record(tmp_path, ['A'], frames)
+
+    camera = ReplayCamera('A', str(tmp_path), realtime=False)
+    for frame in frames:
+        replayed = SimulatedFrame(0)
+        assert camera.fill(replayed)
+        replayed.pixel_format = camera.pixel_format
+        expected = frame.get_buffer()
+        if frame.pixel_format == PixelFormat.Mono12:
+            expected = expected.view('<u2')
+        numpy.testing.assert_array_equal(frame_to_image(replayed), expected.reshape(48, 64))
+    assert not camera.fill(SimulatedFrame(0))
+    camera.reader.close()
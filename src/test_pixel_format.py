@@ -0,0 +1,49 @@
+import numpy
+import pytest
+from pixel_format import pack_mono10p, pack_mono12p, unpack_mono10p, unpack_mono12p
+
+
+@pytest.mark.parametrize('pack, unpack, bits', [(pack_mono10p, unpack_mono10p, 10),
+                                                (pack_mono12p, unpack_mono12p, 12)])
+def test_roundtrip(pack, unpack, bits):
+    rng = numpy.random.default_rng(bits)
+    image = rng.integers(0, 1 << bits, (6, 8), numpy.uint16)
+    packed = pack(image)
+    assert packed.size == image.size * bits // 8
+    numpy.testing.assert_array_equal(unpack(packed, 8, 6), image)
+
+
+@pytest.mark.parametrize('pack, unpack, bits', [(pack_mono10p, unpack_mono10p, 10),
+                                                (pack_mono12p, unpack_mono12p, 12)])
+def test_extreme_values(pack, unpack, bits):
+    # All bits set and alternating patterns catch shifts into the neighbouring pixel
+    image = numpy.array([[0, (1 << bits) - 1, 0x155 & ((1 << bits) - 1), 0x2AA & ((1 << bits) - 1)]], numpy.uint16)
+    numpy.testing.assert_array_equal(unpack(pack(image), 4, 1), image)
+
+
+def test_mono12p_byte_layout():
+    # GenICam PFNC, LSB first: pixels 0xABC, 0xDEF are packed as BC FA DE
+    packed = pack_mono12p(numpy.array([[0xABC, 0xDEF]], numpy.uint16))
+    assert packed.tolist() == [0xBC, 0xFA, 0xDE]
+
+
+def test_mono10p_byte_layout():
+    # Four 10 bit pixels in five bytes, LSB first
+    packed = pack_mono10p(numpy.array([[0x3FF, 0, 0, 0]], numpy.uint16))
+    assert packed.tolist() == [0xFF, 0x03, 0, 0, 0]
+
+
+def test_unpack_into_out():
+    image = numpy.arange(16, dtype=numpy.uint16).reshape(2, 8) * 200
+    out = numpy.empty((2, 8), numpy.uint16)
+    assert unpack_mono12p(pack_mono12p(image), 8, 2, out) is out
+    numpy.testing.assert_array_equal(out, image)
+
+
+def test_invalid_sizes():
+    with pytest.raises(ValueError):
+        unpack_mono10p(bytes(10), 3, 2)
+    with pytest.raises(ValueError):
+        unpack_mono12p(bytes(10), 3, 1)
+    with pytest.raises(ValueError):
+        unpack_mono12p(pack_mono12p(numpy.zeros((2, 4), numpy.uint16)), 4, 2, numpy.empty((4, 2), numpy.uint16))